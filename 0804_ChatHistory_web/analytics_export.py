@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+分析用列式导出
+把 messages / conversations 按天分区导出为 Parquet（或 Arrow IPC）文件，离线分析直接读取这些文件，
+不再访问生产数据库。数据库以只读方式打开，按主键 / 键集分批读取，每批一个短的读事务。
+
+导出位置（高水位）保存在输出目录的 _export_state.json 中，重复执行只导出新增和变化的数据：
+- messages 按自增ID增量导出，按 created_at 的日期分区
+- conversations 按变更序号 change_seq 增量导出变化过的对话快照，按 updated_at 的日期分区；
+  change_seq 由触发器在写事务内分配，随提交顺序递增（updated_at 在写入前确定，延迟写入时
+  晚提交的对话可能带着更早的 updated_at，按它增量会漏掉）；
+  同一对话可能出现多次，分析时按 id 取 change_seq 最大的一条
+
+目录结构:
+  <输出目录>/messages/day=2025-08-06/part-guyuejinyu-000000000001-000000050000.parquet
+  <输出目录>/conversations/day=2025-08-06/part-guyuejinyu-20250807T030000123456-0001.parquet
+
+分片模式下逐个分片导出，文件名和导出位置按分片区分。
+已归档到月度归档库的消息不在主库中，需要在归档之前导出（例如每天定时执行）。
+
+用法: python3 analytics_export.py <输出目录> [--format parquet|arrow] [--batch 50000]
+依赖 pyarrow（可选依赖，未安装时该工具不可用）
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import urllib.parse
+from collections import defaultdict
+from datetime import datetime
+
+from compression import Compressor, UnknownDictionary
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # pyarrow 为可选依赖，只有本工具需要
+    pyarrow = None
+
+STATE_FILE = '_export_state.json'
+DEFAULT_BATCH_SIZE = 50000
+FORMATS = {'parquet': 'parquet', 'arrow': 'arrow'}
+
+# 导出的列：(列名, 类型)，timestamp 列由字符串解析为时间
+MESSAGE_COLUMNS = [
+    ('id', 'int64'),
+    ('conversation_id', 'string'),
+    ('user_id', 'string'),
+    ('character_id', 'string'),
+    ('user_message', 'string'),
+    ('ai_response', 'string'),
+    ('is_image_request', 'bool'),
+    ('image_url', 'string'),
+    ('created_at', 'timestamp'),
+]
+CONVERSATION_COLUMNS = [
+    ('id', 'string'),
+    ('user_id', 'string'),
+    ('character_id', 'string'),
+    ('title', 'string'),
+    ('created_at', 'timestamp'),
+    ('updated_at', 'timestamp'),
+    ('message_count', 'int64'),
+    ('last_message_at', 'timestamp'),
+    ('archive_month', 'string'),
+    ('change_seq', 'int64'),
+]
+
+
+def open_readonly(db_path):
+    """以只读方式打开数据库（URI mode=ro + query_only），导出过程不会写入生产库"""
+    uri = f"file:{urllib.parse.quote(os.path.abspath(db_path))}?mode=ro"
+    conn = sqlite3.connect(uri, uri=True)
+    conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+def load_state(output_dir):
+    """读取导出位置，首次导出时为空"""
+    path = os.path.join(output_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(output_dir, state):
+    """原子地保存导出位置（先写临时文件再替换）"""
+    path = os.path.join(output_dir, STATE_FILE)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def _parse_timestamp(value):
+    if value is None:
+        return None
+    return datetime.fromisoformat(str(value))
+
+
+def _arrow_schema(columns):
+    types = {'int64': pyarrow.int64, 'string': pyarrow.string, 'bool': pyarrow.bool_,
+             'timestamp': lambda: pyarrow.timestamp('us')}
+    return pyarrow.schema([(name, types[kind]()) for name, kind in columns])
+
+
+def _arrow_table(rows, columns):
+    """把一批元组行转换为 Arrow 表"""
+    data = {}
+    for index, (name, kind) in enumerate(columns):
+        values = [row[index] for row in rows]
+        if kind == 'timestamp':
+            values = [_parse_timestamp(value) for value in values]
+        elif kind == 'bool':
+            values = [None if value is None else bool(value) for value in values]
+        data[name] = values
+    return pyarrow.table(data, schema=_arrow_schema(columns))
+
+
+def write_partition(output_dir, table_name, day, file_stem, rows, columns, export_format):
+    """写入一个分区文件（先写临时文件再重命名，读取方不会看到写了一半的文件）"""
+    partition_dir = os.path.join(output_dir, table_name, f"day={day}")
+    os.makedirs(partition_dir, exist_ok=True)
+    path = os.path.join(partition_dir, f"{file_stem}.{FORMATS[export_format]}")
+    table = _arrow_table(rows, columns)
+    if export_format == 'parquet':
+        pyarrow.parquet.write_table(table, path + '.tmp', compression='zstd')
+    else:
+        options = pyarrow.ipc.IpcWriteOptions(compression='zstd')
+        with pyarrow.ipc.new_file(path + '.tmp', table.schema, options=options) as writer:
+            writer.write_table(table)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def _by_day(rows, timestamp_index):
+    """按时间戳列的日期分组（保持原有顺序）"""
+    days = defaultdict(list)
+    for row in rows:
+        days[str(row[timestamp_index] or 'unknown')[:10]].append(row)
+    return days
+
+
+def _decompress(conn, compressor, value):
+    try:
+        return compressor.decompress(value)
+    except UnknownDictionary:
+        compressor.load_dictionaries(conn)
+        return compressor.decompress(value)
+
+
+def export_messages(conn, output_dir, source, state, batch_size, export_format, on_batch):
+    """按ID增量导出消息，每批写完后调用 on_batch() 保存导出位置，返回导出的条数"""
+    compressor = Compressor()
+    compressor.load_dictionaries(conn)
+    names = [name for name, _ in MESSAGE_COLUMNS]
+    response_index, created_index = names.index('ai_response'), names.index('created_at')
+    total = 0
+
+    while True:
+        rows = conn.execute(f'''
+            SELECT {', '.join(names)} FROM messages WHERE id > ? ORDER BY id LIMIT ?
+        ''', (state.get('messages_last_id', 0), batch_size)).fetchall()
+        if not rows:
+            return total
+        rows = [row[:response_index] + (_decompress(conn, compressor, row[response_index]),) +
+                row[response_index + 1:] for row in rows]
+
+        # 文件名由ID范围决定，中途失败后重跑会覆盖同名文件而不会重复导出
+        for day, day_rows in sorted(_by_day(rows, created_index).items()):
+            stem = f"part-{source}-{day_rows[0][0]:012d}-{day_rows[-1][0]:012d}"
+            write_partition(output_dir, 'messages', day, stem, day_rows, MESSAGE_COLUMNS, export_format)
+        state['messages_last_id'] = rows[-1][0]
+        total += len(rows)
+        on_batch()
+
+
+def export_conversations(conn, output_dir, source, state, batch_size, export_format, on_batch, run_id):
+    """按 change_seq 增量导出变化过的对话快照，每批写完后调用 on_batch()，返回导出的条数"""
+    names = [name for name, _ in CONVERSATION_COLUMNS]
+    updated_index, seq_index = names.index('updated_at'), names.index('change_seq')
+    # 旧版本按 (updated_at, id) 记录的位置不可靠，升级后从头导出一次全部对话快照
+    state.pop('conversations_last_key', None)
+    total = part = 0
+
+    while True:
+        rows = conn.execute(f'''
+            SELECT {', '.join(names)} FROM conversations
+            WHERE change_seq > ?
+            ORDER BY change_seq
+            LIMIT ?
+        ''', (state.get('conversations_last_seq', 0), batch_size)).fetchall()
+        if not rows:
+            return total
+
+        for day, day_rows in sorted(_by_day(rows, updated_index).items()):
+            part += 1
+            stem = f"part-{source}-{run_id}-{part:04d}"
+            write_partition(output_dir, 'conversations', day, stem, day_rows, CONVERSATION_COLUMNS, export_format)
+        state['conversations_last_seq'] = rows[-1][seq_index]
+        total += len(rows)
+        on_batch()
+
+
+def export_database(db_path, output_dir, export_format='parquet', batch_size=DEFAULT_BATCH_SIZE):
+    """把一个数据库（单库或一个分片）增量导出到 output_dir，返回 (消息条数, 对话条数)"""
+    if pyarrow is None:
+        raise RuntimeError("未安装 pyarrow，无法导出 Parquet / Arrow 文件（pip install pyarrow）")
+    if export_format not in FORMATS:
+        raise ValueError(f"不支持的导出格式: {export_format}")
+
+    os.makedirs(output_dir, exist_ok=True)
+    source = os.path.splitext(os.path.basename(db_path))[0]
+    state = load_state(output_dir)
+    position = state.setdefault(source, {})
+
+    def on_batch():
+        save_state(output_dir, state)
+
+    conn = open_readonly(db_path)
+    try:
+        messages = export_messages(conn, output_dir, source, position, batch_size, export_format, on_batch)
+        run_id = f"{datetime.now():%Y%m%dT%H%M%S%f}"
+        conversations = export_conversations(
+            conn, output_dir, source, position, batch_size, export_format, on_batch, run_id)
+    finally:
+        conn.close()
+    return messages, conversations
+
+
+def main():
+    from config import Config
+    from sharding import open_database
+
+    parser = argparse.ArgumentParser(description='导出聊天记录供离线分析（按天分区的 Parquet / Arrow 文件）')
+    parser.add_argument('output_dir', nargs='?', default=Config.ANALYTICS_EXPORT_DIR, help='输出目录')
+    parser.add_argument('--format', default='parquet', choices=sorted(FORMATS), help='文件格式')
+    parser.add_argument('--batch', type=int, default=DEFAULT_BATCH_SIZE, help='每批读取的行数')
+    args = parser.parse_args()
+
+    db = open_database()
+    messages = conversations = 0
+    # 分片模式下逐个分片导出（共享库不保存对话和消息）
+    for database in getattr(db, 'shards', [db]):
+        database.init_database()
+        exported = export_database(database.db_path, args.output_dir, args.format, args.batch)
+        messages += exported[0]
+        conversations += exported[1]
+    print(f"✅ 导出完成：{messages} 条新消息，{conversations} 个对话快照（{args.output_dir}）")
+
+
+if __name__ == '__main__':
+    main()
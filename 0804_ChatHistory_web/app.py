@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from flask import Flask, render_template, request, jsonify, session, redirect
+from flask import Flask, Response, render_template, request, jsonify, session, redirect, stream_with_context
 import sqlite3
 import os
 import json
@@ -9,8 +9,11 @@ import hashlib
 from datetime import datetime
 import uuid
 from api_service import DashScopeService
-from models import Database
+import export
+from records import as_dicts
+from sharding import open_database
 from config import Config
+from write_queue import WriteQueue
 
 app = Flask(__name__)
 app.config.from_object(Config)
@@ -19,8 +22,21 @@ app.secret_key = os.environ.get('SECRET_KEY', 'guyuejinyu-secret-key-2024')
 # 会话配置
 app.config['PERMANENT_SESSION_LIFETIME'] = 86400 * 30  # 30天
 
-# 初始化数据库
-db = Database()
+# 初始化数据库（延迟到第一次访问时建表、迁移）
+write_queue = WriteQueue(Config.WRITE_QUEUE_PATH, Config.get_sqlite_pragmas()) if Config.WRITE_BEHIND else None
+db = open_database(write_queue)
+admin_cache_ttls = Config.get_admin_cache_ttls()
+
+# 提示词中携带的最近对话轮数
+CHAT_CONTEXT_TURNS = 6
+
+@app.teardown_appcontext
+def release_db_connection(exception=None):
+    """请求结束时回收绑定在请求上的数据库连接"""
+    db.pool.teardown(exception)
+    db.read_pool.teardown(exception)
+    if write_queue is not None:
+        write_queue.pool.teardown(exception)
 
 def get_current_user_id():
     """获取当前用户ID，确保用户隔离"""
@@ -41,7 +57,7 @@ def get_characters():
     """获取可用角色列表（包含默认角色和用户自定义角色）"""
     user_id = get_current_user_id()
     characters = db.get_characters(user_id)
-    return jsonify(characters)
+    return jsonify(as_dicts(characters))
 
 @app.route('/api/config', methods=['GET', 'POST'])
 def api_config():
@@ -110,7 +126,7 @@ def chat():
             conversation_id = str(uuid.uuid4())
         
         # 获取角色信息
-        character = db.get_character(character_id)
+        character = db.get_character(character_id, user_id=user_id)
         if not character:
             return jsonify({'error': '角色不存在'}), 400
         
@@ -121,7 +137,8 @@ def chat():
             rejection_response = _get_character_rejection(character, attack_type)
             
             # 保存对话记录（含攻击类型标记）
-            db.save_message(conversation_id, user_id, character_id, user_message, rejection_response)
+            db.save_message(conversation_id, user_id, character_id, user_message, rejection_response,
+                            character_name=character['name'])
             
             return jsonify({
                 'response': rejection_response,
@@ -132,8 +149,8 @@ def chat():
                 'attack_type': attack_type  # 用于前端统计和监控
             })
         
-        # 获取对话历史
-        chat_history = db.get_chat_history(conversation_id, limit=10)
+        # 获取最近几轮对话（只读取问答两列）
+        chat_history = db.get_recent_turns(conversation_id, limit=CHAT_CONTEXT_TURNS, user_id=user_id)
         
         # 构建提示词
         system_prompt = _build_system_prompt(character)
@@ -150,7 +167,8 @@ def chat():
             return jsonify({'error': 'AI服务调用失败'}), 500
         
         # 保存对话记录
-        db.save_message(conversation_id, user_id, character_id, user_message, ai_response)
+        db.save_message(conversation_id, user_id, character_id, user_message, ai_response,
+                        character_name=character['name'])
         
         return jsonify({
             'response': ai_response,
@@ -184,7 +202,7 @@ def generate_image():
         
         # 获取角色信息优化提示词
         if character_id:
-            character = db.get_character(character_id)
+            character = db.get_character(character_id, user_id=user_id)
             if character:
                 prompt = f"{character['description']}，{prompt}，中国古代风格，高质量"
         
@@ -211,16 +229,53 @@ def generate_image():
 
 @app.route('/api/conversations')
 def get_conversations():
-    """获取对话历史列表"""
+    """获取对话历史列表（游标分页，可按角色筛选）"""
     user_id = get_current_user_id()
-    conversations = db.get_conversations(user_id)
+    
+    try:
+        conversations = db.get_conversations(
+            user_id,
+            page_cursor=request.args.get('cursor'),
+            limit=request.args.get('limit', 20, type=int),
+            character_id=request.args.get('character_id')
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     return jsonify(conversations)
 
+@app.route('/api/search')
+def search_messages():
+    """搜索当前用户的聊天记录"""
+    user_id = get_current_user_id()
+    
+    try:
+        results = db.search_messages(
+            user_id,
+            request.args.get('q', ''),
+            limit=request.args.get('limit', 20, type=int)
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'results': results})
+
+@app.route('/api/export')
+def export_history():
+    """导出当前用户的全部对话（流式输出，format=ndjson 或 markdown）"""
+    user_id = get_current_user_id()
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in export.FORMATS:
+        return jsonify({'error': '不支持的导出格式'}), 400
+    
+    chunks = export.stream_export(db.export_conversations(user_id), export_format)
+    return Response(stream_with_context(chunks), mimetype=export.FORMATS[export_format][0], headers={
+        'Content-Disposition': f'attachment; filename="{export.export_filename(export_format)}"',
+    })
+
 @app.route('/api/conversation/<conversation_id>')
 def get_conversation(conversation_id):
     """获取特定对话的详细内容"""
     user_id = get_current_user_id()
-    messages = db.get_chat_history(conversation_id)
+    messages = db.get_chat_history(conversation_id, user_id=user_id)
     return jsonify(messages)
 
 @app.route('/api/characters', methods=['POST'])
@@ -338,7 +393,7 @@ def delete_character(character_id):
         if not character_id.startswith('custom_'):
             return jsonify({'error': '不能删除系统预设角色'}), 400
         
-        success = db.delete_custom_character(character_id)
+        success = db.delete_custom_character(character_id, user_id=user_id)
         if success:
             return jsonify({'message': '角色已删除'})
         else:
@@ -512,10 +567,10 @@ def _build_chat_messages(system_prompt, chat_history, user_message):
     """构建对话消息列表"""
     messages = [{"role": "system", "content": system_prompt}]
     
-    # 添加历史对话
-    for msg in chat_history[-6:]:  # 只取最近6轮对话
-        messages.append({"role": "user", "content": msg['user_message']})
-        messages.append({"role": "assistant", "content": msg['ai_response']})
+    # 添加历史对话（最近 CHAT_CONTEXT_TURNS 轮）
+    for turn in chat_history[-CHAT_CONTEXT_TURNS:]:
+        messages.append({"role": "user", "content": turn.user_message})
+        messages.append({"role": "assistant", "content": turn.ai_response})
     
     # 添加当前用户消息
     messages.append({"role": "user", "content": user_message})
@@ -560,13 +615,17 @@ def admin_logout():
 
 # ====== 管理员API接口 ======
 
+def cached_admin_result(endpoint, loader, *args):
+    """按接口缓存管理后台查询结果，并发请求只触发一次查询"""
+    return db.cache.get((endpoint,) + args, admin_cache_ttls[endpoint], lambda: loader(*args))
+
 @app.route('/admin/api/stats')
 def admin_stats():
     """获取系统统计数据"""
     if not session.get('is_admin'):
         return jsonify({'error': 'Unauthorized'}), 401
     
-    stats = db.get_admin_stats()
+    stats = cached_admin_result('stats', db.get_admin_stats)
     return jsonify(stats)
 
 @app.route('/admin/api/conversations')
@@ -575,10 +634,13 @@ def admin_conversations():
     if not session.get('is_admin'):
         return jsonify({'error': 'Unauthorized'}), 401
     
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     limit = request.args.get('limit', 20, type=int)
     
-    conversations = db.get_all_conversations(page, limit)
+    try:
+        conversations = cached_admin_result('conversations', db.get_all_conversations, cursor, limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     return jsonify(conversations)
 
 @app.route('/admin/api/users')
@@ -587,7 +649,7 @@ def admin_users():
     if not session.get('is_admin'):
         return jsonify({'error': 'Unauthorized'}), 401
     
-    users = db.get_user_statistics()
+    users = cached_admin_result('users', db.get_user_statistics)
     return jsonify(users)
 
 @app.route('/admin/api/performance')
@@ -596,7 +658,7 @@ def admin_performance():
     if not session.get('is_admin'):
         return jsonify({'error': 'Unauthorized'}), 401
     
-    performance = db.get_performance_stats()
+    performance = cached_admin_result('performance', db.get_performance_stats)
     return jsonify(performance)
 
 if __name__ == '__main__':
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+冷数据归档
+长时间没有新消息的对话，把消息移到按月划分的归档库（archive/guyuejinyu_archive_YYYY_MM.db），
+主库只保留对话记录（列表页所需的消息数、预览等字段不变），热数据保持精简。
+查看已归档的对话时，按需以只读方式 ATTACH 对应的归档库读取。
+已归档的消息从全文索引中删除，不再出现在搜索结果中（搜索只覆盖主库中的消息）。
+
+归档已有对话: python3 archive.py [--idle-days 180] [--batch 100] [--dry-run]
+"""
+
+import argparse
+import os
+import urllib.parse
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+
+ARCHIVE_FILE_PREFIX = 'guyuejinyu_archive_'
+
+# 每个连接同时附加的归档库上限（SQLite 默认最多附加10个数据库）
+MAX_ATTACHED = 8
+
+# 归档库中的消息字段与主库一致，保留原消息ID
+MESSAGE_COLUMNS = ('id, conversation_id, user_id, character_id, user_message, ai_response, '
+                   'is_image_request, image_url, created_at')
+CONVERSATION_COLUMNS = 'id, user_id, character_id, title, created_at, updated_at'
+
+
+def archive_path(archive_dir, month):
+    """月份（YYYY-MM）对应的归档库路径"""
+    return os.path.join(archive_dir, f"{ARCHIVE_FILE_PREFIX}{month.replace('-', '_')}.db")
+
+
+def _schema_name(month):
+    return 'archive_' + month.replace('-', '_')
+
+
+def create_archive_schema(conn, schema):
+    """在附加的归档库中建表（幂等）"""
+    # 归档库以只读方式附加，WAL 模式需要可写的共享内存文件，因此使用回滚日志
+    conn.execute(f"PRAGMA {schema}.journal_mode = DELETE")
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.conversations (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            character_id TEXT,
+            title TEXT,
+            created_at TIMESTAMP,
+            updated_at TIMESTAMP
+        )
+    ''')
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.messages (
+            id INTEGER PRIMARY KEY,
+            conversation_id TEXT,
+            user_id TEXT,
+            character_id TEXT,
+            user_message TEXT,
+            ai_response TEXT,
+            is_image_request BOOLEAN DEFAULT 0,
+            image_url TEXT,
+            created_at TIMESTAMP
+        )
+    ''')
+    conn.execute(f'''
+        CREATE INDEX IF NOT EXISTS {schema}.idx_messages_conversation_created
+        ON messages (conversation_id, created_at)
+    ''')
+
+
+def attach_archive(conn, archive_dir, month):
+    """在连接上以只读方式附加归档库（按最近使用保留，超出上限时分离最久未用的），返回schema名"""
+    attached = conn.__dict__.setdefault('attached_archives', OrderedDict())
+    schema = _schema_name(month)
+    if schema in attached:
+        attached.move_to_end(schema)
+        return schema
+
+    if len(attached) >= MAX_ATTACHED:
+        oldest, _ = attached.popitem(last=False)
+        conn.execute(f"DETACH DATABASE {oldest}")
+    path = os.path.abspath(archive_path(archive_dir, month))
+    conn.execute(f"ATTACH DATABASE ? AS {schema}", (f"file:{urllib.parse.quote(path)}?mode=ro",))
+    attached[schema] = True
+    return schema
+
+
+def read_archived_messages(conn, archive_dir, month, conversation_id, limit, columns='*'):
+    """读取归档库中某个对话最新的 limit 条消息（按时间倒序）"""
+    schema = attach_archive(conn, archive_dir, month)
+    return conn.execute(f'''
+        SELECT {columns} FROM {schema}.messages
+        WHERE conversation_id = ?
+        ORDER BY created_at DESC
+        LIMIT ?
+    ''', (conversation_id, limit)).fetchall()
+
+
+def find_idle_conversations(conn, cutoff, limit):
+    """最后更新早于 cutoff 且仍有消息在主库的对话
+
+    已归档后又有新消息的对话（updated_at 晚于归档时刻）归入原来的归档库。
+    """
+    return conn.execute('''
+        SELECT
+            id,
+            updated_at,
+            COALESCE(archive_month, strftime('%Y-%m', updated_at)) AS month,
+            message_count,
+            last_message_at,
+            last_message_preview
+        FROM conversations
+        WHERE (archive_month IS NULL OR updated_at > archived_at) AND updated_at < ?
+        ORDER BY updated_at
+        LIMIT ?
+    ''', (cutoff, limit)).fetchall()
+
+
+def _copy_to_archive(conn, archive_dir, month, ids):
+    """把对话和消息复制到归档库（可重复执行）"""
+    conn.execute("ATTACH DATABASE ? AS archive_job", (archive_path(archive_dir, month),))
+    try:
+        create_archive_schema(conn, 'archive_job')
+        placeholders = ','.join('?' * len(ids))
+        conn.execute('BEGIN')
+        conn.execute(f'''
+            INSERT OR REPLACE INTO archive_job.conversations ({CONVERSATION_COLUMNS})
+            SELECT {CONVERSATION_COLUMNS} FROM main.conversations WHERE id IN ({placeholders})
+        ''', ids)
+        conn.execute(f'''
+            INSERT OR REPLACE INTO archive_job.messages ({MESSAGE_COLUMNS})
+            SELECT {MESSAGE_COLUMNS} FROM main.messages WHERE conversation_id IN ({placeholders})
+        ''', ids)
+        conn.commit()
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute("DETACH DATABASE archive_job")
+
+
+def _remove_from_hot(conn, month, conversations):
+    """删除主库中已归档的消息并标记对话，返回 (归档的对话数, 删除的消息数)
+
+    复制之后有新消息的对话跳过，下次归档时再处理。
+    删除消息会触发对话统计字段的更新，这里恢复为归档前的值，列表页显示不变。
+    事务内的 archive_moves 标记让计数触发器不把移走的消息当作删除（用户、角色统计和总数不变），
+    移走的消息数累加到 archived_messages；全文索引中的这些消息仍会删除，已归档的消息不能搜索。
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('INSERT INTO archive_moves (id) VALUES (1)')
+    moved = removed = 0
+    for conv in conversations:
+        current = conn.execute('SELECT updated_at FROM conversations WHERE id = ?', (conv['id'],)).fetchone()
+        if current is None or current['updated_at'] != conv['updated_at']:
+            continue
+        count = conn.execute('DELETE FROM messages WHERE conversation_id = ?', (conv['id'],)).rowcount
+        conn.execute('''
+            UPDATE conversations SET
+                archive_month = ?,
+                archived_at = updated_at,
+                archived_messages = archived_messages + ?,
+                message_count = ?,
+                last_message_at = ?,
+                last_message_preview = ?
+            WHERE id = ?
+        ''', (month, count, conv['message_count'], conv['last_message_at'], conv['last_message_preview'],
+              conv['id']))
+        removed += count
+        moved += 1
+    conn.execute('DELETE FROM archive_moves')
+    conn.commit()
+    return moved, removed
+
+
+def purge_archived_conversations(conn, archive_dir, month, ids):
+    """删除归档库中这些对话的消息和对话记录（主库的对话记录已删除），返回删除的消息数"""
+    path = archive_path(archive_dir, month)
+    if not os.path.exists(path):
+        return 0
+    conn.execute("ATTACH DATABASE ? AS purge_job", (path,))
+    try:
+        placeholders = ','.join('?' * len(ids))
+        conn.execute('BEGIN IMMEDIATE')
+        removed = conn.execute(
+            f"DELETE FROM purge_job.messages WHERE conversation_id IN ({placeholders})", ids).rowcount
+        conn.execute(f"DELETE FROM purge_job.conversations WHERE id IN ({placeholders})", ids)
+        conn.commit()
+        return removed
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute("DETACH DATABASE purge_job")
+
+
+def archive_idle_conversations(db, idle_days, batch_size=100, dry_run=False):
+    """归档超过 idle_days 天没有新消息的对话，返回 (对话数, 消息数)"""
+    cutoff = (datetime.now() - timedelta(days=idle_days)).strftime('%Y-%m-%d %H:%M:%S')
+    os.makedirs(db.archive_dir, exist_ok=True)
+    total_conversations = total_messages = 0
+
+    while True:
+        with db.connection() as conn:
+            batch = find_idle_conversations(conn, cutoff, batch_size)
+            if dry_run:
+                # 预演只统计第一批，不做任何修改
+                print(f"🔍 预演：首批 {len(batch)} 个对话待归档（早于 {cutoff}）")
+                return len(batch), sum(conv['message_count'] for conv in batch)
+            if not batch:
+                break
+
+            by_month = defaultdict(list)
+            for conv in batch:
+                by_month[conv['month']].append(conv)
+            batch_moved = 0
+            for month, conversations in sorted(by_month.items()):
+                _copy_to_archive(conn, db.archive_dir, month, [conv['id'] for conv in conversations])
+                moved, removed = _remove_from_hot(conn, month, conversations)
+                batch_moved += moved
+                total_conversations += moved
+                total_messages += removed
+                print(f"🗄️  已归档 {moved} 个对话、{removed} 条消息到 {archive_path(db.archive_dir, month)}")
+            # 整批都因有新消息被跳过时停止，避免反复处理同一批
+            if not batch_moved:
+                break
+
+    db.cache.invalidate()
+    return total_conversations, total_messages
+
+
+def main():
+    from config import Config
+    from sharding import open_database
+
+    parser = argparse.ArgumentParser(description='归档长时间未活跃的对话')
+    parser.add_argument('--idle-days', type=int, default=Config.ARCHIVE_IDLE_DAYS, help='超过多少天没有新消息')
+    parser.add_argument('--batch', type=int, default=100, help='每批处理的对话数')
+    parser.add_argument('--dry-run', action='store_true', help='只统计，不修改数据')
+    args = parser.parse_args()
+
+    db = open_database()
+    conversations = messages = 0
+    # 分片模式下逐个分片归档（共享库不保存对话）
+    for database in getattr(db, 'shards', [db]):
+        archived = archive_idle_conversations(database, args.idle_days, args.batch, args.dry_run)
+        conversations += archived[0]
+        messages += archived[1]
+    if not args.dry_run:
+        print(f"✅ 归档完成：{conversations} 个对话，{messages} 条消息")
+
+
+if __name__ == '__main__':
+    main()
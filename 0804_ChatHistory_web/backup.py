@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+在线备份
+使用 SQLite 备份接口（sqlite3.Connection.backup）分步复制数据库，每步只复制少量页并短暂停顿，
+应用运行期间也可以安全备份，不会长时间占用锁。WAL 模式下备份期间保持一个读事务，
+写入不受影响，备份也不会因为并发写入而重新开始。
+
+增量快照按页比较：记录上一个快照每一页的摘要，新快照只保存变化的页（gzip 压缩的 .pdiff 文件）。
+一次全量快照（可直接打开的 .db 文件）和其后的增量快照组成一条快照链，恢复时从全量快照开始依次应用增量。
+
+目录结构（每个数据库一个子目录，分片模式下共享库和各分片分别备份）:
+  backups/guyuejinyu/manifest.json           快照清单（类型、上一个快照、页数、SHA-256）
+  backups/guyuejinyu/latest.hashes           最新快照每一页的摘要
+  backups/guyuejinyu/20250806T152516000000.db      全量快照
+  backups/guyuejinyu/20250806T162516000000.pdiff   增量快照
+
+用法:
+  python3 backup.py snapshot [--full]           创建快照并按保留策略清理旧的快照链
+  python3 backup.py list                        列出快照
+  python3 backup.py verify [快照名]             恢复到临时文件并检查完整性（默认最新快照）
+  python3 backup.py restore <快照名> <目标文件> [--source guyuejinyu]
+  python3 backup.py rotate                      只执行保留策略
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import time
+from datetime import datetime
+
+MANIFEST_FILE = 'manifest.json'
+HASHES_FILE = 'latest.hashes'
+
+# 默认每步复制的页数和每步之后的停顿（秒）
+DEFAULT_STEP_PAGES = 1024
+DEFAULT_STEP_PAUSE = 0.01
+
+# 每页摘要长度
+DIGEST_SIZE = 16
+
+# 增量文件头：标识、版本、页大小、页数；之后每条记录为页号 + 页内容
+PDIFF_MAGIC = b'GYPD'
+PDIFF_HEADER = struct.Struct('>4sHII')
+PAGE_NUMBER = struct.Struct('>I')
+
+
+def copy_online(db_path, target_path, step_pages=DEFAULT_STEP_PAGES, pause=DEFAULT_STEP_PAUSE):
+    """用备份接口把数据库分步复制到 target_path，返回页大小"""
+    source = sqlite3.connect(db_path)
+    target = sqlite3.connect(target_path)
+    try:
+        wal = source.execute('PRAGMA journal_mode').fetchone()[0].lower() == 'wal'
+        if wal:
+            # 在同一个读事务中完成备份：读到的是一致的快照，并发写入不会使备份重新开始
+            source.execute('BEGIN')
+            source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+
+        def progress(status, remaining, total):
+            if remaining:
+                time.sleep(pause)
+
+        source.backup(target, pages=step_pages, progress=progress)
+        if wal:
+            source.rollback()
+        return source.execute('PRAGMA page_size').fetchone()[0]
+    finally:
+        target.close()
+        source.close()
+
+
+def _iter_pages(path, page_size):
+    with open(path, 'rb') as f:
+        while True:
+            page = f.read(page_size)
+            if not page:
+                return
+            yield page
+
+
+def _page_digest(page):
+    return hashlib.blake2b(page, digest_size=DIGEST_SIZE).digest()
+
+
+def load_manifest(backup_dir):
+    path = os.path.join(backup_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {'snapshots': []}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _save_manifest(backup_dir, manifest):
+    path = os.path.join(backup_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def _load_hashes(backup_dir):
+    path = os.path.join(backup_dir, HASHES_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        data = f.read()
+    return [data[i:i + DIGEST_SIZE] for i in range(0, len(data), DIGEST_SIZE)]
+
+
+def _save_hashes(backup_dir, hashes):
+    path = os.path.join(backup_dir, HASHES_FILE)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(b''.join(hashes))
+    os.replace(path + '.tmp', path)
+
+
+def take_snapshot(db_path, backup_dir, full=False, full_every=7,
+                  step_pages=DEFAULT_STEP_PAGES, pause=DEFAULT_STEP_PAUSE):
+    """创建快照，返回清单中的快照记录
+
+    没有可比较的上一个快照、页大小变化、当前快照链已有 full_every 个快照或指定 full 时创建全量快照。
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    manifest = load_manifest(backup_dir)
+    snapshots = manifest['snapshots']
+    name = f"{datetime.now():%Y%m%dT%H%M%S%f}"
+    image_path = os.path.join(backup_dir, f"{name}.tmp")
+
+    page_size = copy_online(db_path, image_path, step_pages, pause)
+    previous = snapshots[-1] if snapshots else None
+    previous_hashes = _load_hashes(backup_dir)
+    chain_length = sum(1 for s in snapshots if previous and s['chain'] == previous['chain'])
+    if (previous is None or previous_hashes is None or previous['page_size'] != page_size
+            or len(previous_hashes) != previous['page_count'] or chain_length >= full_every):
+        full = True
+
+    hashes, digest = [], hashlib.sha256()
+    changed = 0
+    try:
+        if full:
+            for page in _iter_pages(image_path, page_size):
+                hashes.append(_page_digest(page))
+                digest.update(page)
+            filename = f"{name}.db"
+            os.replace(image_path, os.path.join(backup_dir, filename))
+            changed = len(hashes)
+        else:
+            filename = f"{name}.pdiff"
+            page_count = os.path.getsize(image_path) // page_size
+            with gzip.open(os.path.join(backup_dir, filename + '.tmp'), 'wb') as out:
+                out.write(PDIFF_HEADER.pack(PDIFF_MAGIC, 1, page_size, page_count))
+                for number, page in enumerate(_iter_pages(image_path, page_size)):
+                    page_hash = _page_digest(page)
+                    hashes.append(page_hash)
+                    digest.update(page)
+                    if number >= len(previous_hashes) or previous_hashes[number] != page_hash:
+                        out.write(PAGE_NUMBER.pack(number) + page)
+                        changed += 1
+            os.replace(os.path.join(backup_dir, filename + '.tmp'), os.path.join(backup_dir, filename))
+    finally:
+        if os.path.exists(image_path):
+            os.remove(image_path)
+
+    entry = {
+        'name': name,
+        'kind': 'full' if full else 'delta',
+        'file': filename,
+        'parent': None if full else previous['name'],
+        'chain': name if full else previous['chain'],
+        'page_size': page_size,
+        'page_count': len(hashes),
+        'changed_pages': changed,
+        'sha256': digest.hexdigest(),
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    snapshots.append(entry)
+    _save_manifest(backup_dir, manifest)
+    _save_hashes(backup_dir, hashes)
+    return entry
+
+
+def _snapshot_chain(manifest, name):
+    """从全量快照到指定快照的快照列表"""
+    by_name = {s['name']: s for s in manifest['snapshots']}
+    if name not in by_name:
+        raise ValueError(f"快照不存在: {name}")
+    chain = [by_name[name]]
+    while chain[-1]['parent']:
+        parent = by_name.get(chain[-1]['parent'])
+        if parent is None:
+            raise ValueError(f"快照链不完整，缺少: {chain[-1]['parent']}")
+        chain.append(parent)
+    return chain[::-1]
+
+
+def _apply_pdiff(path, image):
+    with gzip.open(path, 'rb') as f:
+        magic, version, page_size, page_count = PDIFF_HEADER.unpack(f.read(PDIFF_HEADER.size))
+        if magic != PDIFF_MAGIC or version != 1:
+            raise ValueError(f"不是有效的增量快照文件: {path}")
+        while True:
+            number = f.read(PAGE_NUMBER.size)
+            if not number:
+                break
+            image.seek(PAGE_NUMBER.unpack(number)[0] * page_size)
+            image.write(f.read(page_size))
+        image.truncate(page_count * page_size)
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def restore_snapshot(backup_dir, name, target_path):
+    """把快照恢复为 target_path（目标文件不能已存在），校验 SHA-256 后返回快照记录"""
+    if os.path.exists(target_path):
+        raise FileExistsError(f"目标文件已存在: {target_path}")
+    chain = _snapshot_chain(load_manifest(backup_dir), name)
+    temporary = target_path + '.restoring'
+    shutil.copyfile(os.path.join(backup_dir, chain[0]['file']), temporary)
+    try:
+        with open(temporary, 'r+b') as image:
+            for snapshot in chain[1:]:
+                _apply_pdiff(os.path.join(backup_dir, snapshot['file']), image)
+        if _file_sha256(temporary) != chain[-1]['sha256']:
+            raise ValueError(f"快照 {name} 恢复后的校验和不一致")
+        os.replace(temporary, target_path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    return chain[-1]
+
+
+def verify_snapshot(backup_dir, name=None):
+    """恢复到临时文件并执行 integrity_check，返回 (是否通过, 说明)"""
+    snapshots = load_manifest(backup_dir)['snapshots']
+    if not snapshots:
+        return False, '没有快照'
+    name = name or snapshots[-1]['name']
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'verify.db')
+        try:
+            restore_snapshot(backup_dir, name, path)
+        except (OSError, ValueError) as e:
+            return False, str(e)
+        conn = sqlite3.connect(path)
+        try:
+            result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+        finally:
+            conn.close()
+    return result == 'ok', f"{name}: {result}"
+
+
+def rotate(backup_dir, keep_chains):
+    """只保留最近 keep_chains 条快照链，返回删除的快照数"""
+    manifest = load_manifest(backup_dir)
+    chains = []
+    for snapshot in manifest['snapshots']:
+        if snapshot['chain'] not in chains:
+            chains.append(snapshot['chain'])
+    expired = set(chains[:-keep_chains]) if keep_chains > 0 else set()
+    if not expired:
+        return 0
+
+    removed = [s for s in manifest['snapshots'] if s['chain'] in expired]
+    manifest['snapshots'] = [s for s in manifest['snapshots'] if s['chain'] not in expired]
+    # 先更新清单再删除文件，中途失败只会留下清单中已不存在的文件
+    _save_manifest(backup_dir, manifest)
+    for snapshot in removed:
+        path = os.path.join(backup_dir, snapshot['file'])
+        if os.path.exists(path):
+            os.remove(path)
+    return len(removed)
+
+
+def backup_dir_for(db_path, backup_root):
+    """数据库对应的备份目录（按数据库文件名区分）"""
+    return os.path.join(backup_root, os.path.splitext(os.path.basename(db_path))[0])
+
+
+def _format_size(size):
+    return f"{size / 1024 / 1024:.1f} MB" if size >= 1024 * 1024 else f"{size / 1024:.1f} KB"
+
+
+def main():
+    from config import Config
+    from sharding import open_database
+
+    parser = argparse.ArgumentParser(description='数据库在线备份（备份接口 + 按页增量快照）')
+    parser.add_argument('command', choices=['snapshot', 'list', 'verify', 'restore', 'rotate'])
+    parser.add_argument('name', nargs='?', help='快照名（verify / restore）')
+    parser.add_argument('target', nargs='?', help='恢复的目标文件（restore）')
+    parser.add_argument('--full', action='store_true', help='强制创建全量快照')
+    parser.add_argument('--source', help='数据库名（如 guyuejinyu），默认所有数据库')
+    args = parser.parse_args()
+
+    db = open_database()
+    # 分片模式下共享库和每个分片分别备份
+    databases = [database.db_path for database in getattr(db, 'databases', [db])]
+    if args.source:
+        databases = [path for path in databases if os.path.splitext(os.path.basename(path))[0] == args.source]
+        if not databases:
+            parser.error(f"没有名为 {args.source} 的数据库")
+
+    if args.command == 'restore':
+        if not args.name or not args.target or len(databases) != 1:
+            parser.error('restore 需要快照名、目标文件，分片模式下还需要 --source')
+        try:
+            snapshot = restore_snapshot(backup_dir_for(databases[0], Config.BACKUP_DIR), args.name, args.target)
+        except (OSError, ValueError) as e:
+            print(f"❌ 恢复失败: {e}")
+            raise SystemExit(1)
+        print(f"✅ 已恢复快照 {snapshot['name']} 到 {args.target}（校验和一致）")
+        print("💡 停止应用后用该文件替换数据库文件（同时删除旧的 -wal / -shm 文件）")
+        return
+
+    failed = False
+    for db_path in databases:
+        backup_dir = backup_dir_for(db_path, Config.BACKUP_DIR)
+        if args.command == 'snapshot':
+            if not os.path.exists(db_path):
+                print(f"❌ 数据库文件不存在: {db_path}")
+                failed = True
+                continue
+            started = time.perf_counter()
+            entry = take_snapshot(db_path, backup_dir, args.full, Config.BACKUP_FULL_EVERY,
+                                  Config.BACKUP_STEP_PAGES, Config.BACKUP_STEP_PAUSE)
+            size = os.path.getsize(os.path.join(backup_dir, entry['file']))
+            print(f"✅ {db_path}: {'全量' if entry['kind'] == 'full' else '增量'}快照 {entry['name']}，"
+                  f"{entry['changed_pages']}/{entry['page_count']} 页，{_format_size(size)}，"
+                  f"耗时 {time.perf_counter() - started:.2f}s")
+            removed = rotate(backup_dir, Config.BACKUP_KEEP_CHAINS)
+            if removed:
+                print(f"🗑️ 已清理 {removed} 个过期快照")
+        elif args.command == 'list':
+            print(f"{db_path}:")
+            for snapshot in load_manifest(backup_dir)['snapshots']:
+                print(f"  {snapshot['name']}  {snapshot['kind']:5}  {snapshot['created_at']}  "
+                      f"{snapshot['changed_pages']}/{snapshot['page_count']} 页")
+        elif args.command == 'verify':
+            ok, message = verify_snapshot(backup_dir, args.name)
+            print(f"{'✅' if ok else '❌'} {db_path}: {message}")
+            failed = failed or not ok
+        else:
+            print(f"🗑️ {db_path}: 已清理 {rotate(backup_dir, Config.BACKUP_KEEP_CHAINS)} 个过期快照")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,765 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+古月今语 - 数据库性能基准测试
+在临时数据库上模拟多个gunicorn worker的数据库负载，不会触碰生产数据
+
+用法: python3 benchmark.py <场景> [--workers 4] [--turns 500]
+"""
+
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import random
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+import compression
+from db_pool import DEFAULT_PRAGMAS, ConnectionPool
+from memory_store import MemoryDatabase
+from migrations import DEFAULT_CHARACTERS
+from models import Database
+from pagination import encode_cursor
+from sharding import ShardedDatabase
+from write_queue import WriteQueue, start_writer_process, stop_writer_process
+
+
+# 对比用的日志模式配置：旧版默认的回滚日志 vs WAL调优配置
+JOURNAL_PROFILES = [
+    ('DELETE/FULL', {'journal_mode': 'DELETE', 'synchronous': 'FULL', 'busy_timeout': 5000}),
+    ('WAL/NORMAL', DEFAULT_PRAGMAS),
+]
+
+
+# 冷启动探针：在全新进程中计时 import app 和第一个请求
+STARTUP_PROBE = '''
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.app.test_client().get('/api/characters')
+first = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_request': first - imported}))
+'''
+
+
+class ConnectPerCallPool(ConnectionPool):
+    """旧行为：每次数据库调用都新建连接，用完即关闭"""
+
+    def acquire(self):
+        self._check_fork()
+        return self.connect()
+
+    def release(self, conn):
+        conn.close()
+
+
+def simulate_chat_turn(db, user_id, conversation_id, turn):
+    """模拟一次 /api/chat 请求的数据库访问序列"""
+    db.get_user_config(user_id)
+    db.get_character('kongzi')
+    db.get_recent_turns(conversation_id)
+    db.save_message(conversation_id, user_id, 'kongzi',
+                    f"第{turn}问：何为仁？", "仁者爱人。" * 20)
+
+
+def _chat_worker(db_path, pool_class, turns, result_queue):
+    """单个worker进程：连续处理若干轮对话"""
+    pool = pool_class(db_path)
+    db = Database(db_path, pool=pool)
+    user_id = str(uuid.uuid4())
+    db.save_user_config(user_id, {'api_key': 'sk-benchmark'})
+    conversation_id = str(uuid.uuid4())
+    opened_before = pool.opened
+
+    start = time.perf_counter()
+    for turn in range(turns):
+        simulate_chat_turn(db, user_id, conversation_id, turn)
+    elapsed = time.perf_counter() - start
+
+    result_queue.put((elapsed, pool.opened - opened_before))
+
+
+def legacy_save_message(db, conversation_id, user_id, character_id, user_message, ai_response):
+    """旧版 save_message：先查对话、再查角色，插入后再单独更新时间
+
+    与当前写入路径做同样的工作（压缩回复、写入全文索引），只比较往返次数和事务结构的差别。
+    """
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id FROM conversations WHERE id = ?', (conversation_id,))
+        if not cursor.fetchone():
+            character = db.get_character(character_id)
+            title = f"与{character['name']}的对话" if character else "新对话"
+            cursor.execute('''
+                INSERT INTO conversations (id, user_id, character_id, title)
+                VALUES (?, ?, ?, ?)
+            ''', (conversation_id, user_id, character_id, title))
+        cursor.execute('''
+            INSERT INTO messages
+            (conversation_id, user_id, character_id, user_message, ai_response, image_url)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (conversation_id, user_id, character_id, user_message,
+              db.compressor.compress(ai_response), None))
+        cursor.execute('''
+            INSERT INTO messages_fts (rowid, user_message, ai_response) VALUES (?, ?, ?)
+        ''', (cursor.lastrowid, user_message, ai_response))
+        cursor.execute('UPDATE conversations SET updated_at = ? WHERE id = ?',
+                       (datetime.now(), conversation_id))
+        conn.commit()
+
+
+def upsert_save_message(db, conversation_id, user_id, character_id, user_message, ai_response):
+    """当前 save_message：单事务upsert，标题使用调用方已有的角色名"""
+    db.save_message(conversation_id, user_id, character_id, user_message, ai_response,
+                    character_name='孔子')
+
+
+def _write_worker(db_path, save_func, turns, result_queue):
+    """写入worker：每10轮开启一个新对话，其余轮次追加消息"""
+    db = Database(db_path)
+    user_id = str(uuid.uuid4())
+
+    start = time.perf_counter()
+    for turn in range(turns):
+        if turn % 10 == 0:
+            conversation_id = str(uuid.uuid4())
+        save_func(db, conversation_id, user_id, 'kongzi', f"第{turn}问", "仁者爱人。" * 20)
+    elapsed = time.perf_counter() - start
+
+    result_queue.put((elapsed, turns))
+
+
+def _sharded_write_worker(db_path, shard_dir, shard_count, turns, result_queue):
+    """分片写入worker：轮流代表多个用户写入，使写入分散到各个分片"""
+    if shard_count > 1:
+        db = ShardedDatabase(db_path, shard_dir, shard_count)
+    else:
+        db = Database(db_path)
+    conversations = [(str(uuid.uuid4()), str(uuid.uuid4())) for _ in range(16)]
+
+    start = time.perf_counter()
+    for turn in range(turns):
+        conversation_id, user_id = conversations[turn % len(conversations)]
+        db.save_message(conversation_id, user_id, 'kongzi', f"第{turn}问", "仁者爱人。" * 20,
+                        character_name='孔子')
+    elapsed = time.perf_counter() - start
+
+    result_queue.put((elapsed, turns))
+
+
+def _latency_worker(db_path, queue_path, turns, result_queue):
+    """请求侧写入延迟：记录每次 save_message 返回所需时间"""
+    write_queue = WriteQueue(queue_path) if queue_path else None
+    db = Database(db_path, write_queue=write_queue)
+    user_id = str(uuid.uuid4())
+    conversation_id = str(uuid.uuid4())
+    latencies = []
+    for turn in range(turns):
+        start = time.perf_counter()
+        db.save_message(conversation_id, user_id, 'kongzi', f"第{turn}问", "仁者爱人。" * 20,
+                        character_name='孔子')
+        latencies.append(time.perf_counter() - start)
+    result_queue.put(latencies)
+
+
+def _journal_writer(db_path, pragmas, turns, stop_event, result_queue):
+    """写入worker：连续保存对话消息，统计被锁次数"""
+    db = Database(db_path, pragmas=pragmas)
+    user_id = str(uuid.uuid4())
+    conversation_id = str(uuid.uuid4())
+    done = locked = 0
+
+    start = time.perf_counter()
+    for turn in range(turns):
+        try:
+            db.save_message(conversation_id, user_id, 'kongzi',
+                            f"第{turn}问", "仁者爱人。" * 20)
+            done += 1
+        except sqlite3.OperationalError:
+            locked += 1
+    elapsed = time.perf_counter() - start
+
+    result_queue.put(('write', done, locked, elapsed))
+
+
+def _journal_reader(db_path, pragmas, turns, stop_event, result_queue):
+    """读取worker：反复执行管理员统计查询，直到写入结束"""
+    db = Database(db_path, pragmas=pragmas)
+    done = locked = 0
+
+    start = time.perf_counter()
+    while not stop_event.is_set():
+        try:
+            db.get_admin_stats()
+            db.get_user_statistics()
+            done += 1
+        except sqlite3.OperationalError:
+            locked += 1
+    elapsed = time.perf_counter() - start
+
+    result_queue.put(('read', done, locked, elapsed))
+
+
+def run_workers(target, args_list):
+    """以fork方式并发启动worker进程（与gunicorn一致），收集各自结果"""
+    ctx = multiprocessing.get_context('fork')
+    result_queue = ctx.Queue()
+    processes = [ctx.Process(target=target, args=args + (result_queue,))
+                 for args in args_list]
+    for process in processes:
+        process.start()
+    results = [result_queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return results
+
+
+def bench_pool(workdir, workers, turns):
+    """连接池 vs 每次调用新建连接"""
+    print(f"场景: 连接复用（{workers} 个worker，每个 {turns} 轮对话）")
+    print("-" * 60)
+    for label, pool_class in [('每次新建连接', ConnectPerCallPool),
+                              ('连接池复用', ConnectionPool)]:
+        db_path = os.path.join(workdir, f"pool_{pool_class.__name__}.db")
+        seed = Database(db_path)
+        seed.init_database()
+        seed.pool.close_all()
+        results = run_workers(_chat_worker,
+                              [(db_path, pool_class, turns)] * workers)
+        wall = max(elapsed for elapsed, _ in results)
+        opened = sum(count for _, count in results)
+        total_turns = workers * turns
+        print(f"{label:<10} 吞吐 {total_turns / wall:8.1f} 轮/秒  "
+              f"平均 {wall / turns * 1000:6.2f} ms/轮  "
+              f"新建连接 {opened / total_turns:5.2f} 次/轮")
+
+
+def bench_write(workdir, workers, turns):
+    """save_message 写入吞吐：旧版多次往返 vs 单事务upsert"""
+    print(f"场景: 写入吞吐（{workers} 个worker，每个 {turns} 轮对话）")
+    print("-" * 60)
+    for label, save_func in [('旧版多次往返', legacy_save_message),
+                             ('单事务upsert', upsert_save_message)]:
+        db_path = os.path.join(workdir, f"write_{save_func.__name__}.db")
+        seed = Database(db_path)
+        seed.init_database()
+        seed.pool.close_all()
+        results = run_workers(_write_worker, [(db_path, save_func, turns)] * workers)
+        wall = max(elapsed for elapsed, _ in results)
+        total_turns = sum(count for _, count in results)
+        print(f"{label:<12} 吞吐 {total_turns / wall:8.1f} 轮/秒")
+
+
+def bench_sharding(workdir, workers, turns, shard_counts=(1, 2, 4)):
+    """写入吞吐随分片数的变化（每个分片有独立的写锁）"""
+    print(f"场景: 按用户分片（{workers} 个worker，每个 {turns} 轮对话）")
+    print("-" * 60)
+    for shard_count in shard_counts:
+        db_path = os.path.join(workdir, f"sharding_{shard_count}.db")
+        shard_dir = os.path.join(workdir, f"shards_{shard_count}")
+        if shard_count > 1:
+            seed = ShardedDatabase(db_path, shard_dir, shard_count)
+        else:
+            seed = Database(db_path)
+        seed.init_database()
+        seed.pool.close_all()
+        results = run_workers(_sharded_write_worker, [(db_path, shard_dir, shard_count, turns)] * workers)
+        wall = max(elapsed for elapsed, _ in results)
+        total_turns = sum(count for _, count in results)
+        print(f"{shard_count} 个分片  吞吐 {total_turns / wall:8.1f} 轮/秒")
+
+
+def bench_writebehind(workdir, workers, turns):
+    """同步提交 vs 延迟写入队列 + 组提交：请求侧延迟与落库吞吐"""
+    print(f"场景: 延迟写入（{workers} 个worker，每个 {turns} 轮对话，synchronous=FULL）")
+    print("-" * 60)
+    # 使用FULL同步级别，体现每次提交的fsync成本
+    pragmas = dict(DEFAULT_PRAGMAS, synchronous='FULL')
+    for label, use_queue in [('同步提交', False), ('队列+组提交', True)]:
+        db_path = os.path.join(workdir, f"writebehind_{use_queue}.db")
+        queue_path = os.path.join(workdir, 'writebehind_queue.db') if use_queue else None
+        seed = Database(db_path, pragmas=pragmas)
+        seed.init_database()
+        seed.pool.close_all()
+
+        start = time.perf_counter()
+        writer = start_writer_process(Database(db_path, pragmas=pragmas), queue_path, pragmas) if use_queue else None
+        results = run_workers(_latency_worker, [(db_path, queue_path, turns)] * workers)
+        stop_writer_process(writer)
+        wall = time.perf_counter() - start
+
+        latencies = sorted(latency for worker in results for latency in worker)
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000
+        print(f"{label:<10} 请求侧 p50 {p50:6.2f} ms  p99 {p99:6.2f} ms  "
+              f"全部落库 {len(latencies) / wall:8.1f} 轮/秒")
+
+
+def bench_pagination(workdir, workers, turns, conversations=50000, page_size=20):
+    """管理员对话列表翻页：LIMIT/OFFSET vs 游标分页，在不同深度的单页耗时"""
+    print(f"场景: 深度翻页（{conversations} 个对话，每页 {page_size} 条）")
+    print("-" * 60)
+    db = Database(os.path.join(workdir, 'pagination.db'))
+    with db.connection() as conn:
+        conn.executemany('''
+            INSERT INTO conversations (id, user_id, character_id, title, created_at, updated_at)
+            VALUES (?, ?, 'kongzi', '与孔子的对话', ?, ?)
+        ''', [(f"conv-{i:06d}", f"user-{i % 500}", f"2025-01-01 00:00:{i:06d}", f"2025-01-01 00:00:{i:06d}")
+              for i in range(conversations)])
+        conn.commit()
+
+    for depth in [1, 100, 1000, conversations // page_size - 1]:
+        conn = db.get_connection()
+        start = time.perf_counter()
+        conn.execute('''
+            SELECT conv.id, conv.user_id, conv.title, c.name as character_name, conv.created_at,
+                   (SELECT COUNT(*) FROM messages m WHERE m.conversation_id = conv.id) as message_count
+            FROM conversations conv
+            LEFT JOIN characters c ON conv.character_id = c.id
+            ORDER BY conv.updated_at DESC, conv.id DESC LIMIT ? OFFSET ?
+        ''', (page_size, (depth - 1) * page_size)).fetchall()
+        offset_ms = (time.perf_counter() - start) * 1000
+
+        # 游标分页：定位到该深度上一页的最后一行后取一页
+        anchor = conn.execute('''
+            SELECT updated_at, id FROM conversations
+            ORDER BY updated_at DESC, id DESC LIMIT 1 OFFSET ?
+        ''', (max(0, (depth - 1) * page_size - 1),)).fetchone()
+        token = encode_cursor(dict(anchor), 'next') if depth > 1 else None
+        start = time.perf_counter()
+        db.get_all_conversations(page_cursor=token, limit=page_size)
+        keyset_ms = (time.perf_counter() - start) * 1000
+
+        print(f"第 {depth:>5} 页  OFFSET {offset_ms:8.2f} ms  游标 {keyset_ms:8.2f} ms")
+
+
+# 汇总表之前的管理员统计查询：每次都扫描原始消息/对话表
+LEGACY_STATS_QUERIES = [
+    '''SELECT DATE(created_at) as date, COUNT(DISTINCT user_id) as active_users
+       FROM conversations WHERE created_at >= datetime('now', '-7 days')
+       GROUP BY DATE(created_at) ORDER BY date''',
+    '''SELECT strftime('%H', created_at) as hour, COUNT(*) as message_count,
+              AVG(CASE WHEN ai_response != '' THEN 1 ELSE 0 END) as success_rate
+       FROM messages WHERE created_at >= datetime('now', '-24 hours')
+       GROUP BY strftime('%H', created_at) ORDER BY hour''',
+    '''SELECT COUNT(*), SUM(CASE WHEN ai_response != '' AND ai_response IS NOT NULL THEN 1 ELSE 0 END)
+       FROM messages WHERE created_at >= datetime('now', '-7 days')''',
+    '''SELECT COUNT(*), SUM(CASE WHEN image_url IS NOT NULL AND image_url != '' THEN 1 ELSE 0 END)
+       FROM messages WHERE is_image_request = 1 AND created_at >= datetime('now', '-7 days')''',
+]
+
+
+def bench_stats(workdir, workers, turns, messages=200000, rounds=5):
+    """管理员统计：扫描原始表 vs 读取按小时/按天汇总表"""
+    print(f"场景: 管理员统计（{messages} 条消息，分布在最近30天）")
+    print("-" * 60)
+    db = Database(os.path.join(workdir, 'stats.db'))
+    with db.connection() as conn:
+        conn.executemany('''
+            INSERT INTO conversations (id, user_id, character_id, title) VALUES (?, ?, 'kongzi', '与孔子的对话')
+        ''', [(f"conv-{i}", f"user-{i % 800}") for i in range(5000)])
+        conn.executemany('''
+            INSERT INTO messages (conversation_id, user_id, character_id, user_message, ai_response, created_at)
+            VALUES (?, ?, 'kongzi', '问', '答', datetime('now', ?))
+        ''', [(f"conv-{i % 5000}", f"user-{i % 800}", f"-{i * 30 * 86400 // messages} seconds")
+              for i in range(messages)])
+        conn.commit()
+
+    conn = db.get_connection()
+    legacy, rollup = [], []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for sql in LEGACY_STATS_QUERIES:
+            conn.execute(sql).fetchall()
+        legacy.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        db.get_admin_stats()
+        db.get_performance_stats()
+        rollup.append((time.perf_counter() - start) * 1000)
+
+    print(f"扫描原始表  {statistics.median(legacy):8.2f} ms")
+    print(f"读取汇总表  {statistics.median(rollup):8.2f} ms  （含 get_admin_stats 全部查询）")
+
+
+def storage_workload(db, threads, turns):
+    """存储后端的混合负载：多个线程同时对话（写入 + 读取历史 + 翻对话列表），返回各操作耗时（秒）"""
+    timings = {'save_message': [], 'get_chat_history': [], 'get_conversations': []}
+    lock = threading.Lock()
+
+    def timed(name, func, *args, **kwargs):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        with lock:
+            timings[name].append(elapsed)
+
+    def user_session(n):
+        user_id = f"bench-user-{n}"
+        for turn in range(turns):
+            conversation_id = f"bench-conv-{n}-{turn // 10}"
+            timed('save_message', db.save_message, conversation_id, user_id, 'kongzi',
+                  f"第{turn}问", "仁者爱人。" * 20, character_name='孔子')
+            timed('get_chat_history', db.get_chat_history, conversation_id, 10, user_id=user_id)
+            if turn % 10 == 0:
+                timed('get_conversations', db.get_conversations, user_id)
+
+    sessions = [threading.Thread(target=user_session, args=(n,)) for n in range(threads)]
+    for session in sessions:
+        session.start()
+    for session in sessions:
+        session.join()
+
+    for name, func in [('get_admin_stats', db.get_admin_stats), ('get_user_statistics', db.get_user_statistics),
+                       ('get_all_conversations', db.get_all_conversations)]:
+        timings[name] = []
+        for _ in range(20):
+            timed(name, func)
+    return timings
+
+
+def bench_storage(workdir, workers, turns):
+    """同一负载分别在 SQLite 和内存存储上运行（workers 作为线程数）"""
+    print(f"场景: 存储后端（{workers} 个线程，每个 {turns} 轮对话），各操作耗时中位数")
+    print("-" * 60)
+    for label, db in [('SQLite', Database(os.path.join(workdir, 'storage.db'))), ('内存', MemoryDatabase())]:
+        db.init_database()
+        timings = storage_workload(db, workers, turns)
+        print(f"{label}")
+        for name, samples in timings.items():
+            print(f"  {name:<22} {statistics.median(samples) * 1e6:9.1f} µs")
+
+
+def legacy_chat_reads(db, conversation_id, user_id):
+    """投影之前 /api/chat 的读取：整行读取历史和角色列表，每行转换为 dict"""
+    with db.connection() as conn:
+        rows = conn.execute('''
+            SELECT * FROM messages WHERE conversation_id = ? ORDER BY created_at DESC LIMIT 10
+        ''', (conversation_id,)).fetchall()
+        history = list(reversed(db._decode_messages(conn, rows)))
+        characters = [dict(row) for row in conn.execute(
+            'SELECT * FROM characters WHERE user_id IS NULL OR user_id = ? ORDER BY created_at', (user_id,))]
+    return [(m['user_message'], m['ai_response']) for m in history[-6:]], characters
+
+
+def projected_chat_reads(db, conversation_id, user_id):
+    """当前的读取：只取需要的列，直接构造 namedtuple"""
+    return db.get_recent_turns(conversation_id, user_id=user_id), db.get_characters(user_id)
+
+
+def measure_allocations(func, rounds):
+    """返回 (调用期间的内存峰值字节数, 结果占用的内存块数) 的中位数"""
+    peaks, blocks = [], []
+    for _ in range(rounds):
+        start_blocks = sys.getallocatedblocks()
+        tracemalloc.reset_peak()
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        result = func()
+        peaks.append(tracemalloc.get_traced_memory()[1] - start_bytes)
+        blocks.append(sys.getallocatedblocks() - start_blocks)
+        del result
+    return statistics.median(peaks), statistics.median(blocks)
+
+
+def bench_allocations(workdir, workers, turns, rounds=200):
+    """/api/chat 读取路径的内存分配：整行 dict vs 按列投影的 namedtuple"""
+    print(f"场景: 对话请求的读取分配（每次读取最近对话和角色列表，{rounds} 次取中位数）")
+    print("-" * 60)
+    db = Database(os.path.join(workdir, 'allocations.db'))
+    user_id, conversation_id = 'alloc-user', 'alloc-conv'
+    for turn in range(20):
+        db.save_message(conversation_id, user_id, 'kongzi', f"第{turn}问：何为仁？", "仁者爱人。" * 60,
+                        character_name='孔子')
+
+    for label, reads in [('整行 dict', legacy_chat_reads), ('列投影 namedtuple', projected_chat_reads)]:
+        reads(db, conversation_id, user_id)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            reads(db, conversation_id, user_id)
+        elapsed = (time.perf_counter() - start) / rounds
+
+        gc.disable()
+        tracemalloc.start()
+        try:
+            peak, blocks = measure_allocations(lambda: reads(db, conversation_id, user_id), rounds)
+        finally:
+            tracemalloc.stop()
+            gc.enable()
+        print(f"{label:<16} 峰值 {peak / 1024:7.1f} KB  结果占用 {blocks:5.0f} 个内存块  "
+              f"耗时 {elapsed * 1e6:7.1f} µs")
+
+
+# 合成语料：古文名句与角色设定拼接，再混入随机常用字，模拟文言风格的AI回复
+CLASSICAL_PHRASES = [
+    '学而时习之，不亦说乎？', '有朋自远方来，不亦乐乎？', '己所不欲，勿施于人。',
+    '温故而知新，可以为师矣。', '三人行，必有我师焉。', '知之为知之，不知为不知，是知也。',
+    '君不见黄河之水天上来，奔流到海不复回。', '天生我材必有用，千金散尽还复来。',
+    '举杯邀明月，对影成三人。', '长风破浪会有时，直挂云帆济沧海。',
+    '鞠躬尽瘁，死而后已。', '非淡泊无以明志，非宁静无以致远。', '静以修身，俭以养德。',
+    '知行合一，致良知。', '心外无物，心外无理。', '此心光明，亦复何言。',
+    '为政以德，譬如北辰，居其所而众星共之。', '吾日三省吾身。', '见贤思齐焉，见不贤而内自省也。',
+]
+
+
+def synthetic_responses(count, seed=20250806):
+    """生成 count 条 300~1500 字的合成回复"""
+    rng = random.Random(seed)
+    phrases = CLASSICAL_PHRASES + [c['system_prompt'] for c in DEFAULT_CHARACTERS]
+    alphabet = ''.join(set(''.join(phrases)))
+    responses = []
+    for _ in range(count):
+        target = rng.randint(300, 1500)
+        parts, length = [], 0
+        while length < target:
+            if rng.random() < 0.6:
+                part = rng.choice(phrases)
+            else:
+                part = ''.join(rng.choice(alphabet) for _ in range(rng.randint(10, 40))) + '。'
+            parts.append(part)
+            length += len(part)
+        responses.append(''.join(parts))
+    return responses
+
+
+def bench_compression(workdir, workers, turns, messages=5000):
+    """AI回复压缩：存储大小与压缩/解压CPU开销（合成文言语料）"""
+    print(f"场景: 回复压缩（{messages} 条合成回复，另取 1000 条训练字典）")
+    print("-" * 60)
+    corpus = synthetic_responses(messages + 1000)
+    training, corpus = corpus[:1000], corpus[1000:]
+    raw_bytes = sum(len(text.encode('utf-8')) for text in corpus)
+
+    configs = [('不压缩', None, False), ('zlib', 'zlib', False), ('zlib+字典', 'zlib', True)]
+    if compression.zstandard is not None:
+        configs += [('zstd', 'zstd', False), ('zstd+字典', 'zstd', True)]
+
+    print(f"原文 {raw_bytes / 1024 / 1024:.2f} MB")
+    for label, codec, use_dictionary in configs:
+        db_path = os.path.join(workdir, f"compression_{len(os.listdir(workdir))}.db")
+        db = Database(db_path, compressor=compression.Compressor(codec))
+        if use_dictionary:
+            with db.connection() as conn:
+                data = compression.train_dictionary(training, codec)
+                compression.store_dictionary(conn, codec, data, len(training))
+                db.compressor.load_dictionaries(conn)
+
+        start = time.perf_counter()
+        stored = [db.compressor.compress(text) for text in corpus]
+        compress_us = (time.perf_counter() - start) / len(corpus) * 1e6
+        start = time.perf_counter()
+        for value in stored:
+            db.compressor.decompress(value)
+        decompress_us = (time.perf_counter() - start) / len(corpus) * 1e6
+        stored_bytes = sum(len(value) if isinstance(value, bytes) else len(value.encode('utf-8'))
+                           for value in stored)
+
+        for i in range(0, len(corpus), 500):
+            db.write_turns([{'conversation_id': f"conv-{j % 500}", 'user_id': f"user-{j % 50}",
+                             'character_id': 'kongzi', 'user_message': '请教', 'ai_response': corpus[j],
+                             'image_url': None, 'character_name': '孔子', 'updated_at': datetime.now()}
+                            for j in range(i, min(i + 500, len(corpus)))], 0)
+        start = time.perf_counter()
+        for i in range(500):
+            db.get_chat_history(f"conv-{i}", limit=10)
+        history_ms = (time.perf_counter() - start) / 500 * 1000
+        with db.connection() as conn:
+            conn.execute('VACUUM')
+            # dbstat 按表统计实际占用的页，全文索引合计其 messages_fts_* 影子表
+            table_bytes = dict(conn.execute('''
+                SELECT CASE WHEN name LIKE 'messages_fts%' THEN 'messages_fts' ELSE name END, SUM(pgsize)
+                FROM dbstat GROUP BY 1
+            ''').fetchall())
+        db.checkpoint('TRUNCATE')
+        db.pool.close_all()
+
+        print(f"{label:<10} 正文 {stored_bytes / 1024 / 1024:6.2f} MB ({stored_bytes / raw_bytes:6.1%})  "
+              f"压缩 {compress_us:6.1f} µs/条  解压 {decompress_us:5.1f} µs/条  "
+              f"读取10条历史 {history_ms:5.2f} ms  "
+              f"messages表 {table_bytes.get('messages', 0) / 1024 / 1024:6.2f} MB  "
+              f"全文索引 {table_bytes.get('messages_fts', 0) / 1024 / 1024:6.2f} MB  "
+              f"数据库文件 {os.path.getsize(db_path) / 1024 / 1024:6.2f} MB")
+    print("注：全文索引为无内容表，只保存分词，大小不随压缩方式变化")
+
+
+def bench_journal(workdir, workers, turns):
+    """回滚日志 vs WAL：管理员统计查询与对话写入并发"""
+    readers = max(1, workers // 2)
+    print(f"场景: 日志模式（{workers} 个写入worker × {turns} 轮，{readers} 个管理员查询worker）")
+    print("-" * 60)
+    ctx = multiprocessing.get_context('fork')
+    for label, pragmas in JOURNAL_PROFILES:
+        db_path = os.path.join(workdir, f"journal_{pragmas['journal_mode']}.db")
+        seed = Database(db_path, pragmas=pragmas)
+        for i in range(2000):
+            seed.save_message(f"seed-{i % 200}", f"user-{i % 50}", 'kongzi', "问", "答" * 50)
+        seed.pool.close_all()
+
+        result_queue = ctx.Queue()
+        stop_event = ctx.Event()
+        writers = [ctx.Process(target=_journal_writer,
+                               args=(db_path, pragmas, turns, stop_event, result_queue))
+                   for _ in range(workers)]
+        reader_procs = [ctx.Process(target=_journal_reader,
+                                    args=(db_path, pragmas, turns, stop_event, result_queue))
+                        for _ in range(readers)]
+        for process in writers + reader_procs:
+            process.start()
+        results = [result_queue.get() for _ in writers]
+        stop_event.set()
+        results += [result_queue.get() for _ in reader_procs]
+        for process in writers + reader_procs:
+            process.join()
+
+        for kind, name in [('write', '写入'), ('read', '统计查询')]:
+            rows = [r for r in results if r[0] == kind]
+            done = sum(r[1] for r in rows)
+            locked = sum(r[2] for r in rows)
+            wall = max(r[3] for r in rows)
+            print(f"{label:<12} {name:<6} {done / wall:8.1f} 次/秒  被锁失败 {locked} 次")
+
+
+def _isolation_chat(db_path, pragmas, turns, result_queue):
+    """聊天worker：记录每次 save_message 的耗时（请求侧写入延迟）"""
+    db = Database(db_path, pragmas=pragmas)
+    user_id = str(uuid.uuid4())
+    conversation_id = str(uuid.uuid4())
+    latencies, locked = [], 0
+    for turn in range(turns):
+        start = time.perf_counter()
+        try:
+            db.save_message(conversation_id, user_id, 'kongzi', f"第{turn}问", "仁者爱人。" * 20,
+                            character_name='孔子')
+        except sqlite3.OperationalError:
+            locked += 1
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.002)
+    result_queue.put(('chat', latencies, locked))
+
+
+def _isolation_admin(db_path, pragmas, stop_event, result_queue):
+    """管理后台worker：不经缓存反复执行全表统计和仪表板查询（只读连接），直到聊天结束"""
+    db = Database(db_path, pragmas=pragmas)
+    rounds = 0
+    while not stop_event.is_set():
+        with db.read_connection() as conn:
+            for sql in LEGACY_STATS_QUERIES:
+                conn.execute(sql).fetchall()
+        db.get_admin_stats()
+        db.get_all_conversations()
+        rounds += 1
+    result_queue.put(('admin', rounds))
+
+
+def bench_isolation(workdir, workers, turns, messages=200000):
+    """混合负载：聊天写入延迟，单独运行 vs 同时有管理后台重查询（只读连接）"""
+    print(f"场景: 管理查询隔离（{messages} 条消息，{workers} 个聊天worker × {turns} 轮，1 个管理后台worker）")
+    print("-" * 60)
+    ctx = multiprocessing.get_context('fork')
+    for label, pragmas in JOURNAL_PROFILES:
+        db_path = os.path.join(workdir, f"isolation_{pragmas['journal_mode']}.db")
+        seed = Database(db_path, pragmas=pragmas)
+        with seed.connection() as conn:
+            conn.executemany('''
+                INSERT INTO conversations (id, user_id, character_id, title) VALUES (?, ?, 'kongzi', '与孔子的对话')
+            ''', [(f"conv-{i}", f"user-{i % 800}") for i in range(5000)])
+            conn.executemany('''
+                INSERT INTO messages (conversation_id, user_id, character_id, user_message, ai_response, created_at)
+                VALUES (?, ?, 'kongzi', '问', ?, datetime('now', ?))
+            ''', [(f"conv-{i % 5000}", f"user-{i % 800}", "仁者爱人。" * 20, f"-{i * 30 * 86400 // messages} seconds")
+                  for i in range(messages)])
+            conn.commit()
+        seed.pool.close_all()
+
+        for with_admin in (False, True):
+            result_queue = ctx.Queue()
+            stop_event = ctx.Event()
+            chats = [ctx.Process(target=_isolation_chat, args=(db_path, pragmas, turns, result_queue))
+                     for _ in range(workers)]
+            admins = [ctx.Process(target=_isolation_admin, args=(db_path, pragmas, stop_event, result_queue))
+                      for _ in range(1 if with_admin else 0)]
+            for process in admins + chats:
+                process.start()
+            results = [result_queue.get() for _ in chats]
+            stop_event.set()
+            admin_rounds = sum(result_queue.get()[1] for _ in admins)
+            for process in admins + chats:
+                process.join()
+
+            latencies = sorted(latency for r in results for latency in r[1])
+            locked = sum(r[2] for r in results)
+            p50 = latencies[len(latencies) // 2] * 1000
+            p99 = latencies[int(len(latencies) * 0.99)] * 1000
+            name = f"管理查询 {admin_rounds} 轮" if with_admin else "仅聊天"
+            print(f"{label:<12} {name:<12} 写入 p50 {p50:6.2f} ms  p99 {p99:7.2f} ms  "
+                  f"最长 {latencies[-1] * 1000:7.1f} ms  被锁失败 {locked} 次")
+
+
+def _run_startup_probe(db_path):
+    """在子进程中运行冷启动探针"""
+    env = dict(os.environ, DATABASE_PATH=db_path)
+    output = subprocess.run([sys.executable, '-c', STARTUP_PROBE], env=env,
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench_startup(workdir, workers, turns, runs=5):
+    """冷启动耗时：import app 与第一个请求（全新数据库 / 已初始化数据库）"""
+    print(f"场景: 冷启动（每种情况运行 {runs} 次取中位数）")
+    print("-" * 60)
+    warm_path = os.path.join(workdir, 'startup_warm.db')
+    _run_startup_probe(warm_path)
+
+    for label, make_path in [('全新数据库', lambda i: os.path.join(workdir, f"startup_cold_{i}.db")),
+                             ('已初始化数据库', lambda i: warm_path)]:
+        samples = [_run_startup_probe(make_path(i)) for i in range(runs)]
+        import_ms = statistics.median(s['import'] for s in samples) * 1000
+        first_ms = statistics.median(s['first_request'] for s in samples) * 1000
+        print(f"{label:<10} import app {import_ms:7.1f} ms  首个请求 {first_ms:7.1f} ms")
+
+
+SCENARIOS = {
+    'allocations': bench_allocations,
+    'pagination': bench_pagination,
+    'pool': bench_pool,
+    'sharding': bench_sharding,
+    'journal': bench_journal,
+    'compression': bench_compression,
+    'isolation': bench_isolation,
+    'startup': bench_startup,
+    'stats': bench_stats,
+    'storage': bench_storage,
+    'write': bench_write,
+    'writebehind': bench_writebehind,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="古月今语数据库基准测试")
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('--workers', type=int, default=4, help="模拟的gunicorn worker数")
+    parser.add_argument('--turns', type=int, default=500, help="每个worker的对话轮数")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='guyuejinyu_bench_')
+    try:
+        SCENARIOS[args.scenario](workdir, args.workers, args.turns)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
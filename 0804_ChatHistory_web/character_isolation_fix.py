@@ -6,17 +6,22 @@
 修复自定义角色的用户隔离问题
 """
 
+import argparse
 import sqlite3
 import os
-from datetime import datetime
+
+from backup import backup_dir_for, take_snapshot
+from chunked_migration import ChunkStep, count_rows, run_migration
+from config import Config
+from migrations import LATEST_VERSION, get_schema_version, migrate
 
 def backup_database(db_path="guyuejinyu.db"):
-    """备份原数据库"""
-    backup_path = f"guyuejinyu_backup_character_fix_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-    
+    """备份原数据库（备份接口在线创建全量快照，可用 backup.py restore 恢复）"""
     if os.path.exists(db_path):
-        import shutil
-        shutil.copy2(db_path, backup_path)
+        backup_dir = backup_dir_for(db_path, Config.BACKUP_DIR)
+        snapshot = take_snapshot(db_path, backup_dir, full=True,
+                                 step_pages=Config.BACKUP_STEP_PAGES, pause=Config.BACKUP_STEP_PAUSE)
+        backup_path = os.path.join(backup_dir, snapshot['file'])
         print(f"✅ 数据库已备份到: {backup_path}")
         return backup_path
     else:
@@ -24,26 +29,19 @@ def backup_database(db_path="guyuejinyu.db"):
         return None
 
 def add_user_id_column(db_path="guyuejinyu.db"):
-    """为角色表添加user_id字段"""
+    """为角色表添加user_id字段（由结构迁移统一完成）"""
     if not os.path.exists(db_path):
         print("❌ 数据库文件不存在")
         return False
     
     try:
         conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        # 检查user_id字段是否已存在
-        cursor.execute("PRAGMA table_info(characters)")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        if 'user_id' not in columns:
-            print("🔧 为角色表添加user_id字段...")
-            cursor.execute("ALTER TABLE characters ADD COLUMN user_id TEXT")
-            conn.commit()
-            print("✅ 成功添加user_id字段")
+        if get_schema_version(conn) >= LATEST_VERSION:
+            print("✅ 数据库结构已是最新版本，user_id字段已存在")
         else:
-            print("✅ user_id字段已存在")
+            print("🔧 执行数据库结构迁移...")
+            migrate(conn, db_path)
+            print("✅ 数据库结构迁移完成")
         
         conn.close()
         return True
@@ -101,8 +99,16 @@ def analyze_character_data(db_path="guyuejinyu.db"):
     except Exception as e:
         print(f"❌ 分析失败: {e}")
 
-def fix_unassigned_characters(db_path="guyuejinyu.db"):
-    """修复未分配用户的自定义角色"""
+# 未分配用户的自定义角色：先删消息，再删对话和角色本身
+UNASSIGNED_CHARACTERS = "SELECT id FROM characters WHERE id LIKE 'custom_%' AND user_id IS NULL"
+UNASSIGNED_CHARACTER_CLEANUP = [
+    ChunkStep('messages', f"conversation_id IN (SELECT id FROM conversations WHERE character_id IN ({UNASSIGNED_CHARACTERS}))"),
+    ChunkStep('conversations', f"character_id IN ({UNASSIGNED_CHARACTERS})"),
+    ChunkStep('characters', "id LIKE 'custom_%' AND user_id IS NULL"),
+]
+
+def fix_unassigned_characters(db_path="guyuejinyu.db", action=None, dry_run=False):
+    """修复未分配用户的自定义角色（action 为 '1'/'2'/'3' 时不再询问）"""
     if not os.path.exists(db_path):
         print("❌ 数据库文件不存在")
         return False
@@ -125,25 +131,26 @@ def fix_unassigned_characters(db_path="guyuejinyu.db"):
         
         print(f"\n🔧 修复 {len(unassigned_characters)} 个未分配的自定义角色...")
         
+        if dry_run:
+            message_count, conversation_count, _ = count_rows(db_path, UNASSIGNED_CHARACTER_CLEANUP)
+            print(f"💡 试运行：删除时将同时删除 {conversation_count} 个对话、{message_count} 条消息，未修改数据")
+            conn.close()
+            return True
+        
         # 选择处理方式
         print("\n选择处理方式:")
         print("1. 删除这些角色（推荐 - 因为无法确定原始创建者）")
         print("2. 保留角色但标记为系统角色")
         print("3. 取消操作")
         
-        choice = input("请选择 (1/2/3): ").strip()
+        choice = action or input("请选择 (1/2/3): ").strip()
         
         if choice == '1':
-            # 删除未分配的自定义角色
+            # 删除未分配的自定义角色及其对话（分批删除，中断后重新执行会继续）
             for char_id, name in unassigned_characters:
-                # 删除相关的对话记录
-                cursor.execute('DELETE FROM messages WHERE conversation_id IN (SELECT id FROM conversations WHERE character_id = ?)', (char_id,))
-                cursor.execute('DELETE FROM conversations WHERE character_id = ?', (char_id,))
-                # 删除角色
-                cursor.execute('DELETE FROM characters WHERE id = ?', (char_id,))
-                print(f"  ✅ 已删除角色: {name}")
-            
-            conn.commit()
+                print(f"  - 删除角色: {name}")
+            run_migration(db_path, 'character_fix_unassigned', UNASSIGNED_CHARACTER_CLEANUP,
+                          Config.MIGRATION_CHUNK_ROWS, Config.MIGRATION_PAUSE, Config.MIGRATION_MAX_TRANSACTION)
             print(f"\n✅ 成功删除 {len(unassigned_characters)} 个未分配的自定义角色")
             
         elif choice == '2':
@@ -209,9 +216,19 @@ def verify_character_isolation(db_path="guyuejinyu.db"):
         print(f"❌ 验证失败: {e}")
 
 def main():
+    parser = argparse.ArgumentParser(description='角色隔离修复工具')
+    parser.add_argument('--dry-run', action='store_true', help='只分析和统计，不备份、不修改')
+    parser.add_argument('--action', choices=['delete', 'keep'], help='未分配角色的处理方式，不指定时询问')
+    args = parser.parse_args()
+    
     print("🎭 古月今语 - 角色隔离修复工具")
     print("=" * 50)
     
+    if args.dry_run:
+        analyze_character_data()
+        fix_unassigned_characters(dry_run=True)
+        return
+    
     # 1. 备份数据库
     print("\n1. 备份数据库...")
     backup_path = backup_database()
@@ -229,7 +246,7 @@ def main():
     
     # 4. 修复未分配的角色
     print("\n4. 修复角色隔离...")
-    if fix_unassigned_characters():
+    if fix_unassigned_characters(action={'delete': '1', 'keep': '2'}.get(args.action)):
         print("\n5. 验证修复效果...")
         verify_character_isolation()
         
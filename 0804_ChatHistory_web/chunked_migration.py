@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+分批数据修复
+把"删除/更新满足条件的所有行"拆成按 rowid 范围的小事务：每批只扫描 chunk_rows 个 rowid，
+修改和进度（data_migration_progress 表）在同一事务中提交，中断后重新执行会从上次的位置继续。
+每批之后停顿一会儿，事务耗时超过目标时自动减小批次，应用运行期间执行也不会长时间占用写锁。
+
+删除使用普通的 DELETE，触发器照常维护对话摘要和全文索引。
+每个步骤开始（或继续）时记录表当前的最大 rowid，之后新写入的行不在本次处理范围内。
+
+用法（由修复脚本调用 run_migration）:
+  python3 chunked_migration.py status [--db guyuejinyu.db]     查看各任务进度
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+import urllib.parse
+from datetime import datetime
+
+from migrations import migrate
+
+# 默认每批扫描的 rowid 数、批次之间的停顿（秒）、单个事务的目标耗时（秒）
+DEFAULT_CHUNK_ROWS = 2000
+DEFAULT_PAUSE = 0.05
+DEFAULT_MAX_TRANSACTION = 0.1
+MIN_CHUNK_ROWS = 50
+
+# 等待其他连接释放写锁的时间（秒）
+BUSY_TIMEOUT = 30
+
+
+class ChunkStep:
+    """一个分批执行的步骤：删除 table 中满足 condition 的行，或用 set_clause 更新这些行"""
+
+    def __init__(self, table, condition, params=(), set_clause=None):
+        self.table = table
+        self.condition = condition
+        self.params = tuple(params)
+        self.set_clause = set_clause
+
+    @property
+    def description(self):
+        action = '删除' if self.set_clause is None else f"更新（{self.set_clause}）"
+        return f"{action} {self.table} WHERE {self.condition}"
+
+    def statement(self):
+        target = f"DELETE FROM {self.table}" if self.set_clause is None else \
+            f"UPDATE {self.table} SET {self.set_clause}"
+        return f"{target} WHERE rowid > ? AND rowid <= ? AND ({self.condition})"
+
+
+def connect(db_path):
+    """修复任务使用的连接：手动管理事务，写锁冲突时等待"""
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    migrate(conn, db_path)
+    return conn
+
+
+def count_rows(db_path, steps):
+    """试运行：每个步骤当前满足条件的行数（只读连接，不修改数据库）"""
+    conn = sqlite3.connect(f"file:{urllib.parse.quote(os.path.abspath(db_path))}?mode=ro", uri=True)
+    try:
+        return [conn.execute(f"SELECT COUNT(*) FROM {step.table} WHERE {step.condition}",
+                             step.params).fetchone()[0] for step in steps]
+    finally:
+        conn.close()
+
+
+def _save_progress(conn, name, index, step, last_rowid, end_rowid, affected, completed):
+    now = datetime.now()
+    conn.execute('''
+        INSERT INTO data_migration_progress
+            (migration, step, description, last_rowid, end_rowid, affected_rows, completed_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (migration, step) DO UPDATE SET
+            last_rowid = excluded.last_rowid,
+            end_rowid = excluded.end_rowid,
+            affected_rows = excluded.affected_rows,
+            completed_at = excluded.completed_at,
+            updated_at = excluded.updated_at
+    ''', (name, index, step.description, last_rowid, end_rowid, affected, now if completed else None, now))
+
+
+def _run_step(conn, name, index, step, chunk_rows, pause, max_transaction):
+    row = conn.execute('''
+        SELECT last_rowid, affected_rows, completed_at FROM data_migration_progress
+        WHERE migration = ? AND step = ?
+    ''', (name, index)).fetchone()
+    if row and row[2]:
+        print(f"  ⏭️ 步骤 {index + 1} 已完成：{step.description}（{row[1]} 行）")
+        return row[1]
+
+    last_rowid, affected = (row[0], row[1]) if row else (0, 0)
+    end_rowid = conn.execute(f"SELECT COALESCE(MAX(rowid), 0) FROM {step.table}").fetchone()[0]
+    if last_rowid:
+        print(f"  ↪️ 步骤 {index + 1} 从 rowid {last_rowid} 继续")
+
+    chunk, saved = chunk_rows, False
+    while last_rowid < end_rowid:
+        upper = min(last_rowid + chunk, end_rowid)
+        started = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            affected += conn.execute(step.statement(), (last_rowid, upper) + step.params).rowcount
+            _save_progress(conn, name, index, step, upper, end_rowid, affected, upper >= end_rowid)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        elapsed = time.perf_counter() - started
+        last_rowid, saved = upper, True
+
+        # 自适应批次：事务超过目标耗时减半，远低于目标时逐步恢复
+        if elapsed > max_transaction:
+            chunk = max(MIN_CHUNK_ROWS, chunk // 2)
+        elif elapsed < max_transaction / 4:
+            chunk = min(chunk_rows, chunk * 2)
+        if last_rowid < end_rowid:
+            time.sleep(pause)
+
+    if not saved:
+        # 没有需要扫描的行（空表或上次已扫描到末尾），直接标记完成
+        conn.execute('BEGIN IMMEDIATE')
+        _save_progress(conn, name, index, step, last_rowid, end_rowid, affected, True)
+        conn.commit()
+    print(f"  ✅ 步骤 {index + 1}：{step.description}（{affected} 行）")
+    return affected
+
+
+def run_migration(db_path, name, steps, chunk_rows=DEFAULT_CHUNK_ROWS, pause=DEFAULT_PAUSE,
+                  max_transaction=DEFAULT_MAX_TRANSACTION, restart=False):
+    """按顺序分批执行各步骤，返回每个步骤影响的行数
+
+    上次执行中断时跳过已完成的步骤并从记录的位置继续；上次已全部完成或指定 restart 时重新开始。
+    """
+    conn = connect(db_path)
+    try:
+        completed = conn.execute('''
+            SELECT COUNT(*) FROM data_migration_progress WHERE migration = ? AND completed_at IS NOT NULL
+        ''', (name,)).fetchone()[0]
+        if restart or completed >= len(steps):
+            conn.execute('DELETE FROM data_migration_progress WHERE migration = ?', (name,))
+        return [_run_step(conn, name, index, step, chunk_rows, pause, max_transaction)
+                for index, step in enumerate(steps)]
+    finally:
+        conn.close()
+
+
+def migration_status(db_path):
+    """所有修复任务的进度"""
+    conn = connect(db_path)
+    try:
+        return conn.execute('''
+            SELECT migration, step, description, last_rowid, end_rowid, affected_rows, completed_at, updated_at
+            FROM data_migration_progress ORDER BY migration, step
+        ''').fetchall()
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='分批数据修复任务进度')
+    parser.add_argument('command', choices=['status'])
+    parser.add_argument('--db', default='guyuejinyu.db', help='数据库文件')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error(f"数据库文件不存在: {args.db}")
+    rows = migration_status(args.db)
+    if not rows:
+        print("没有修复任务记录")
+    for migration, step, description, last_rowid, end_rowid, affected, completed_at, updated_at in rows:
+        state = f"完成于 {completed_at}" if completed_at else f"进行中 {last_rowid}/{end_rowid}"
+        print(f"{migration} #{step + 1}  {state}  {affected} 行  {description}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+消息正文压缩
+较长的 AI 回复以 BLOB 形式压缩存储：2字节头（算法、字典编号）+ 压缩数据，
+短文本和压缩后没有变小的文本仍按原文（TEXT）保存，读取时按值的类型判断是否需要解压。
+字典由历史消息和角色设定训练得到，保存在 compression_dictionaries 表中，
+同一条记录始终用写入时的字典解压，重新训练字典不影响已有数据。
+
+训练字典:         python3 compression.py train [--codec zlib] [--samples 2000]
+压缩已有消息:     python3 compression.py compress [--batch 500]
+"""
+
+import argparse
+import struct
+import threading
+import zlib
+from collections import Counter
+
+try:
+    import zstandard
+except ImportError:  # zstd 为可选依赖，未安装时只能使用 zlib
+    zstandard = None
+
+# 算法编号写入每条压缩记录的头部，已分配的编号不能修改
+CODECS = {'zlib': 1, 'zstd': 2}
+CODEC_NAMES = {number: name for name, number in CODECS.items()}
+
+# 头部：算法编号（1字节）+ 字典编号（2字节，0 表示不使用字典）
+HEADER = struct.Struct('<BH')
+
+# 短于该字节数的文本不压缩（约170个汉字），压缩收益抵不过CPU开销
+DEFAULT_MIN_BYTES = 512
+DEFAULT_LEVEL = 6
+# zlib 预设字典最多使用32KB（滑动窗口大小）
+DICTIONARY_SIZE = 32 * 1024
+# zlib 字典训练时统计的片段长度（字符）
+TRAINING_GRAM_LENGTHS = (16, 8, 4)
+
+
+class UnknownDictionary(LookupError):
+    """记录使用的字典尚未加载（可能由其他进程新训练）"""
+
+
+class Compressor:
+    """压缩/解压消息正文，codec 为 None 时只解压不压缩"""
+
+    def __init__(self, codec=None, level=DEFAULT_LEVEL, min_bytes=DEFAULT_MIN_BYTES):
+        if codec is not None and codec not in CODECS:
+            raise ValueError(f"不支持的压缩算法: {codec}")
+        if codec == 'zstd' and zstandard is None:
+            raise RuntimeError("未安装 zstandard，无法使用 zstd 压缩")
+        self.codec = codec
+        self.level = level
+        self.min_bytes = min_bytes
+        self.dictionaries = {}  # 字典编号 -> (算法, 字典数据)
+        self.dictionary_id = 0  # 压缩时使用的字典
+        self._local = threading.local()
+
+    def load_dictionaries(self, conn):
+        """从数据库加载全部字典，压缩使用当前算法最新训练的字典"""
+        rows = conn.execute('SELECT id, codec, data FROM compression_dictionaries ORDER BY id').fetchall()
+        self.dictionaries = {row[0]: (row[1], bytes(row[2])) for row in rows}
+        self.dictionary_id = max(
+            (dict_id for dict_id, (codec, _) in self.dictionaries.items() if codec == self.codec), default=0)
+        self._local = threading.local()
+
+    def compress(self, text):
+        """返回要存储的值：压缩后的 bytes，或不值得压缩时的原文"""
+        if self.codec is None or not text:
+            return text
+        raw = text.encode('utf-8')
+        if len(raw) < self.min_bytes:
+            return text
+        payload = self._compress(raw)
+        if HEADER.size + len(payload) >= len(raw):
+            return text
+        return HEADER.pack(CODECS[self.codec], self.dictionary_id) + payload
+
+    def decompress(self, value):
+        """还原存储的值：bytes 按头部解压，其余原样返回"""
+        if not isinstance(value, bytes):
+            return value
+        codec_number, dict_id = HEADER.unpack_from(value)
+        codec = CODEC_NAMES.get(codec_number)
+        if codec is None:
+            raise ValueError(f"未知的压缩算法编号: {codec_number}")
+        if dict_id and dict_id not in self.dictionaries:
+            raise UnknownDictionary(dict_id)
+        dictionary = self.dictionaries[dict_id][1] if dict_id else None
+        payload = memoryview(value)[HEADER.size:]
+
+        if codec == 'zlib':
+            if dictionary:
+                decompressor = zlib.decompressobj(-15, zdict=dictionary)
+            else:
+                decompressor = zlib.decompressobj(-15)
+            raw = decompressor.decompress(payload) + decompressor.flush()
+        else:
+            if zstandard is None:
+                raise RuntimeError("未安装 zstandard，无法解压 zstd 压缩的消息")
+            raw = self._zstd('decompressor', dict_id, dictionary).decompress(payload)
+        return raw.decode('utf-8')
+
+    def _compress(self, raw):
+        dictionary = self.dictionaries[self.dictionary_id][1] if self.dictionary_id else None
+        if self.codec == 'zlib':
+            # 原始 deflate 流（wbits=-15），省去每条记录的 zlib 头和校验和
+            if dictionary:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=dictionary)
+            else:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            return compressor.compress(raw) + compressor.flush()
+        return self._zstd('compressor', self.dictionary_id, dictionary).compress(raw)
+
+    def _zstd(self, kind, dict_id, dictionary):
+        """按线程缓存 zstd 压缩/解压对象（加载字典开销较大，且对象不是线程安全的）"""
+        cache = self._local.__dict__.setdefault('zstd', {})
+        key = (kind, dict_id)
+        if key not in cache:
+            dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            if kind == 'compressor':
+                cache[key] = zstandard.ZstdCompressor(level=self.level, dict_data=dict_data,
+                                                      write_checksum=False, write_content_size=True)
+            else:
+                cache[key] = zstandard.ZstdDecompressor(dict_data=dict_data)
+        return cache[key]
+
+
+def train_dictionary(samples, codec='zlib', size=DICTIONARY_SIZE):
+    """用样本文本训练字典"""
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("未安装 zstandard，无法训练 zstd 字典")
+        return zstandard.train_dictionary(size, [text.encode('utf-8') for text in samples]).as_bytes()
+
+    # zlib 预设字典：挑选样本中反复出现的片段，越常见的越靠近末尾（回溯距离越短）
+    counts = Counter()
+    for text in samples:
+        for n in TRAINING_GRAM_LENGTHS:
+            for i in range(0, len(text) - n + 1, n // 2):
+                counts[text[i:i + n]] += 1
+
+    chosen, used = [], 0
+    for gram, count in sorted(counts.items(), key=lambda item: item[1] * len(item[0]), reverse=True):
+        if count < 2:
+            break
+        if any(gram in existing for existing in chosen):
+            continue
+        encoded = gram.encode('utf-8')
+        if used + len(encoded) > size:
+            break
+        chosen.append(gram)
+        used += len(encoded)
+    return ''.join(reversed(chosen)).encode('utf-8')
+
+
+def training_samples(conn, limit):
+    """训练样本：最近的 AI 回复 + 全部角色设定"""
+    compressor = Compressor()
+    compressor.load_dictionaries(conn)
+    rows = conn.execute('''
+        SELECT ai_response FROM messages
+        WHERE ai_response IS NOT NULL AND ai_response != ''
+        ORDER BY id DESC LIMIT ?
+    ''', (limit,)).fetchall()
+    samples = [compressor.decompress(row[0]) for row in rows]
+    for row in conn.execute('SELECT name, description, style, system_prompt FROM characters'):
+        samples.append(''.join(value or '' for value in row))
+    return samples
+
+
+def store_dictionary(conn, codec, data, sample_count):
+    """保存新字典，返回字典编号"""
+    cursor = conn.execute('''
+        INSERT INTO compression_dictionaries (codec, data, sample_count) VALUES (?, ?, ?)
+    ''', (codec, data, sample_count))
+    conn.commit()
+    return cursor.lastrowid
+
+
+def compress_existing(db, batch_size=500):
+    """按主键分批压缩已有的未压缩回复，返回压缩的条数"""
+    compressor = db.compressor
+    last_id, total = 0, 0
+    while True:
+        with db.connection() as conn:
+            rows = conn.execute('''
+                SELECT id, ai_response FROM messages
+                WHERE id > ? ORDER BY id LIMIT ?
+            ''', (last_id, batch_size)).fetchall()
+            if not rows:
+                return total
+            updates = []
+            for row in rows:
+                if isinstance(row['ai_response'], str):
+                    stored = compressor.compress(row['ai_response'])
+                    if isinstance(stored, bytes):
+                        updates.append((stored, row['id']))
+            conn.executemany('UPDATE messages SET ai_response = ? WHERE id = ?', updates)
+            conn.commit()
+        last_id = rows[-1]['id']
+        total += len(updates)
+
+
+def main():
+    from config import Config
+    from sharding import open_database
+
+    parser = argparse.ArgumentParser(description='消息正文压缩')
+    parser.add_argument('command', choices=['train', 'compress'])
+    parser.add_argument('--codec', default=Config.MESSAGE_COMPRESSION or 'zlib', choices=sorted(CODECS))
+    parser.add_argument('--samples', type=int, default=2000, help='训练字典使用的回复条数')
+    parser.add_argument('--batch', type=int, default=500, help='每个事务压缩的消息条数')
+    args = parser.parse_args()
+
+    db = open_database(compressor_factory=lambda: Compressor(
+        args.codec, Config.MESSAGE_COMPRESSION_LEVEL, Config.MESSAGE_COMPRESSION_MIN_BYTES))
+    # 字典按库保存，分片模式下每个分片用自己的消息训练、压缩
+    for database in getattr(db, 'shards', [db]):
+        if args.command == 'train':
+            with database.connection() as conn:
+                samples = training_samples(conn, args.samples)
+                data = train_dictionary(samples, args.codec)
+                dict_id = store_dictionary(conn, args.codec, data, len(samples))
+            print(f"✅ 已训练 {args.codec} 字典 #{dict_id}：{len(samples)} 条样本，{len(data)} 字节（{database.db_path}）")
+        else:
+            compressed = compress_existing(database, args.batch)
+            print(f"✅ 已压缩 {compressed} 条消息（{database.db_path}）")
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,79 @@ class Config:
     # 数据库配置
     DATABASE_PATH = os.environ.get('DATABASE_PATH') or 'guyuejinyu.db'
     
+    # SQLite PRAGMA配置（WAL模式下读写互不阻塞）
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE') or 'WAL'
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS') or 'NORMAL'
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', '5000'))  # 毫秒
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))  # 字节
+    SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE', '-16000'))  # 负数表示KB
+    SQLITE_TEMP_STORE = os.environ.get('SQLITE_TEMP_STORE') or 'MEMORY'
+    
+    # WAL检查点策略：WAL累计到指定页数时自动检查点，检查点后WAL文件截断到上限以内
+    SQLITE_WAL_AUTOCHECKPOINT = int(os.environ.get('SQLITE_WAL_AUTOCHECKPOINT', '1000'))  # 页
+    SQLITE_JOURNAL_SIZE_LIMIT = int(os.environ.get('SQLITE_JOURNAL_SIZE_LIMIT', str(64 * 1024 * 1024)))  # 字节
+    
+    # 延迟写入：对话先写入本地队列，由独立写入进程批量提交（组提交）
+    WRITE_BEHIND = os.environ.get('WRITE_BEHIND', 'False').lower() == 'true'
+    WRITE_QUEUE_PATH = os.environ.get('WRITE_QUEUE_PATH') or 'guyuejinyu_queue.db'
+    WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', '200'))
+    
+    # AI回复压缩：'zlib' 或 'zstd'（需安装 zstandard），留空不压缩；已压缩的记录总能读取
+    MESSAGE_COMPRESSION = os.environ.get('MESSAGE_COMPRESSION') or None
+    MESSAGE_COMPRESSION_LEVEL = int(os.environ.get('MESSAGE_COMPRESSION_LEVEL', '6'))
+    MESSAGE_COMPRESSION_MIN_BYTES = int(os.environ.get('MESSAGE_COMPRESSION_MIN_BYTES', '512'))
+    
+    # 冷数据归档：超过指定天数没有新消息的对话移入月度归档库
+    ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR') or 'archive'
+    ARCHIVE_IDLE_DAYS = int(os.environ.get('ARCHIVE_IDLE_DAYS', '180'))
+    
+    # 存储后端：sqlite（默认）或 memory（数据只在当前进程内存中，仅用于测试和单进程调试）
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite').lower()
+    
+    # 分片存储：SHARD_COUNT 大于1时按 user_id 哈希把用户数据分散到多个分片库，
+    # DATABASE_PATH 作为共享库；分片数确定后不能修改
+    SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '1'))
+    SHARD_DIR = os.environ.get('SHARD_DIR') or 'shards'
+    
+    # 离线分析导出目录（analytics_export.py，按天分区的 Parquet / Arrow 文件）
+    ANALYTICS_EXPORT_DIR = os.environ.get('ANALYTICS_EXPORT_DIR') or 'analytics'
+    
+    # 在线备份（backup.py）：每条快照链一个全量快照加最多 BACKUP_FULL_EVERY-1 个增量快照，
+    # 保留最近 BACKUP_KEEP_CHAINS 条链；备份时每步复制 BACKUP_STEP_PAGES 页后停顿 BACKUP_STEP_PAUSE 秒
+    BACKUP_DIR = os.environ.get('BACKUP_DIR') or 'backups'
+    BACKUP_FULL_EVERY = int(os.environ.get('BACKUP_FULL_EVERY', '7'))
+    BACKUP_KEEP_CHAINS = int(os.environ.get('BACKUP_KEEP_CHAINS', '3'))
+    BACKUP_STEP_PAGES = int(os.environ.get('BACKUP_STEP_PAGES', '1024'))
+    BACKUP_STEP_PAUSE = float(os.environ.get('BACKUP_STEP_PAUSE', '0.01'))
+    
+    # 分批数据修复（chunked_migration.py）：每批扫描的 rowid 数、批次间停顿（秒）、单个事务的目标耗时（秒）
+    MIGRATION_CHUNK_ROWS = int(os.environ.get('MIGRATION_CHUNK_ROWS', '2000'))
+    MIGRATION_PAUSE = float(os.environ.get('MIGRATION_PAUSE', '0.05'))
+    MIGRATION_MAX_TRANSACTION = float(os.environ.get('MIGRATION_MAX_TRANSACTION', '0.1'))
+    
+    # 数据保留策略（retention.py）：删除超过 RETENTION_IDLE_DAYS 天未更新、且用户超过
+    # RETENTION_INACTIVE_USER_DAYS 天没有发送消息的对话；RETENTION_IDLE_DAYS 为0时不清理
+    RETENTION_IDLE_DAYS = int(os.environ.get('RETENTION_IDLE_DAYS', '0'))
+    RETENTION_INACTIVE_USER_DAYS = int(os.environ.get('RETENTION_INACTIVE_USER_DAYS', '90'))
+    RETENTION_BATCH = int(os.environ.get('RETENTION_BATCH', '200'))
+    RETENTION_MESSAGE_BATCH = int(os.environ.get('RETENTION_MESSAGE_BATCH', '500'))
+    RETENTION_PAUSE = float(os.environ.get('RETENTION_PAUSE', '0.05'))
+    RETENTION_VACUUM_STEP_PAGES = int(os.environ.get('RETENTION_VACUUM_STEP_PAGES', '1000'))
+
+    # 已删除角色的后台清理（reaper.py）：检查间隔（秒）、删除后保留的时间（秒，等待写入队列中该角色的
+    # 消息落库）、每个事务删除的消息/对话数、事务之间的停顿（秒）
+    REAPER_INTERVAL = float(os.environ.get('REAPER_INTERVAL', '30'))
+    REAPER_GRACE_SECONDS = float(os.environ.get('REAPER_GRACE_SECONDS', '60'))
+    REAPER_BATCH = int(os.environ.get('REAPER_BATCH', '500'))
+    REAPER_PAUSE = float(os.environ.get('REAPER_PAUSE', '0.05'))
+
+    # 管理后台接口缓存时间（秒）：任何进程写入数据库后缓存立即失效（见 result_cache.py），
+    # 过期时间只限制没有写入时结果的最长保留时间
+    ADMIN_CACHE_TTL_STATS = float(os.environ.get('ADMIN_CACHE_TTL_STATS', '30'))
+    ADMIN_CACHE_TTL_USERS = float(os.environ.get('ADMIN_CACHE_TTL_USERS', '60'))
+    ADMIN_CACHE_TTL_PERFORMANCE = float(os.environ.get('ADMIN_CACHE_TTL_PERFORMANCE', '60'))
+    ADMIN_CACHE_TTL_CONVERSATIONS = float(os.environ.get('ADMIN_CACHE_TTL_CONVERSATIONS', '10'))
+    
     # 阿里云百炼API配置
     DEFAULT_TEXT_MODEL = os.environ.get('DEFAULT_TEXT_MODEL') or 'qwen-plus'
     DEFAULT_IMAGE_MODEL = os.environ.get('DEFAULT_IMAGE_MODEL') or 'wan2.2-t2i-flash'
@@ -55,6 +128,39 @@ class Config:
         '种族', '歧视', '仇恨', '攻击', '诽谤'
     ]
     
+    @classmethod
+    def get_sqlite_pragmas(cls):
+        """获取SQLite PRAGMA配置"""
+        return {
+            'journal_mode': cls.SQLITE_JOURNAL_MODE,
+            'synchronous': cls.SQLITE_SYNCHRONOUS,
+            'busy_timeout': cls.SQLITE_BUSY_TIMEOUT,
+            'mmap_size': cls.SQLITE_MMAP_SIZE,
+            'cache_size': cls.SQLITE_CACHE_SIZE,
+            'temp_store': cls.SQLITE_TEMP_STORE,
+            'wal_autocheckpoint': cls.SQLITE_WAL_AUTOCHECKPOINT,
+            'journal_size_limit': cls.SQLITE_JOURNAL_SIZE_LIMIT,
+            # 外键默认不检查，需要每个连接打开：删除角色/对话依赖 ON DELETE CASCADE
+            'foreign_keys': 'ON',
+        }
+    
+    @classmethod
+    def get_compressor(cls):
+        """按配置创建消息压缩器"""
+        from compression import Compressor
+        return Compressor(cls.MESSAGE_COMPRESSION, cls.MESSAGE_COMPRESSION_LEVEL,
+                          cls.MESSAGE_COMPRESSION_MIN_BYTES)
+    
+    @classmethod
+    def get_admin_cache_ttls(cls):
+        """获取管理后台各接口的缓存时间"""
+        return {
+            'stats': cls.ADMIN_CACHE_TTL_STATS,
+            'users': cls.ADMIN_CACHE_TTL_USERS,
+            'performance': cls.ADMIN_CACHE_TTL_PERFORMANCE,
+            'conversations': cls.ADMIN_CACHE_TTL_CONVERSATIONS,
+        }
+    
     @staticmethod
     def get_character_rejection(character_name):
         """获取角色特定的拒绝回复"""
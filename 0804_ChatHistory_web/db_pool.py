@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SQLite连接池
+每个进程的每个线程复用同一个连接，Flask请求内的连接绑定到 g，
+请求结束时统一回收，避免每次数据库调用都 connect/close。
+"""
+
+import os
+import sqlite3
+import threading
+import urllib.parse
+import weakref
+
+try:
+    from flask import g, has_app_context
+except ImportError:  # 离线脚本（修复工具、基准测试）可以不依赖Flask
+    g = None
+
+    def has_app_context():
+        return False
+
+
+# 默认PRAGMA配置，与 Config.get_sqlite_pragmas() 的默认值一致
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -16000,
+    'temp_store': 'MEMORY',
+    'wal_autocheckpoint': 1000,
+    'journal_size_limit': 64 * 1024 * 1024,
+    'foreign_keys': 'ON',
+}
+
+# 作用于整个数据库文件的PRAGMA，只在初始化时设置一次
+DATABASE_PRAGMAS = ('journal_mode',)
+
+
+def apply_pragmas(conn, pragmas):
+    """在新连接上应用连接级别的PRAGMA"""
+    for name, value in pragmas.items():
+        if name not in DATABASE_PRAGMAS:
+            conn.execute(f"PRAGMA {name} = {value}")
+
+
+class PooledConnection(sqlite3.Connection):
+    """连接池中的连接（子类化以支持弱引用）"""
+
+
+class ConnectionPool:
+    """按进程、线程复用的SQLite连接池"""
+
+    def __init__(self, db_path, pragmas=None, readonly=False):
+        self.db_path = db_path
+        self.pragmas = dict(DEFAULT_PRAGMAS if pragmas is None else pragmas)
+        # 只读连接池（管理后台查询）：以 mode=ro 打开并设置 query_only，连接不会获取写锁
+        self.readonly = readonly
+        self._lock = threading.Lock()
+        # fork前父进程打开的连接：子进程既不能使用也不能关闭（关闭可能触发
+        # 父进程仍在使用的文件的清理动作），只保留引用防止被回收
+        self._inherited = []
+        self._reset()
+
+    def _reset(self):
+        """重置当前进程的连接状态"""
+        self._pid = os.getpid()
+        self._local = threading.local()
+        # 线程结束后其连接随 threading.local 一起回收，这里只持有弱引用
+        self._connections = weakref.WeakSet()
+        self.opened = 0
+
+    def _check_fork(self):
+        """检测是否处于fork出的子进程（如gunicorn worker）"""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._inherited.extend(self._connections)
+                    self._reset()
+
+    def connect(self):
+        """新建一个数据库连接"""
+        # 连接只在所属线程内使用，关闭跨线程检查以便 close_all 统一关闭
+        if self.readonly:
+            conn = sqlite3.connect(f"file:{urllib.parse.quote(os.path.abspath(self.db_path))}?mode=ro",
+                                   uri=True, check_same_thread=False, factory=PooledConnection)
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                   factory=PooledConnection)
+        conn.row_factory = sqlite3.Row
+        apply_pragmas(conn, self.pragmas)
+        if self.readonly:
+            conn.execute("PRAGMA query_only = ON")
+        with self._lock:
+            self._connections.add(conn)
+            self.opened += 1
+        return conn
+
+    def acquire(self):
+        """获取当前线程的连接，Flask请求内同时绑定到 g"""
+        self._check_fork()
+
+        if has_app_context():
+            conns = g.setdefault('_db_connections', {})
+            conn = conns.get(id(self))
+            if conn is not None:
+                return conn
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self.connect()
+            self._local.conn = conn
+
+        if has_app_context():
+            g._db_connections[id(self)] = conn
+        return conn
+
+    def release(self, conn):
+        """归还连接：连接保持打开，供同线程后续调用复用
+
+        调用可能嵌套（如 save_message 内查询角色），这里不能结束事务。
+        """
+
+    def teardown(self, exception=None):
+        """Flask请求结束时回收绑定在 g 上的连接，回滚遗留的未提交事务
+
+        g 上的字典由所有连接池（读写、只读、写入队列、各分片）共用，这里只取走本池的连接。
+        """
+        conns = g.get('_db_connections') if has_app_context() else None
+        conn = conns.pop(id(self), None) if conns else None
+        if conn is not None and conn.in_transaction:
+            conn.rollback()
+
+    def close_all(self):
+        """关闭当前进程打开的全部连接（如gunicorn master在fork前调用）"""
+        self._check_fork()
+        with self._lock:
+            connections = list(self._connections)
+            self._connections = weakref.WeakSet()
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
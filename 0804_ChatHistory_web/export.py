@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+聊天记录导出
+把存储后端 export_conversations() 逐条生成的记录转换为流式输出：
+- ndjson：每行一条 JSON 记录（type 为 conversation 或 message）
+- markdown：zip 压缩包，每个对话一个 Markdown 文件
+两种格式都边读边输出，不在内存中拼接完整文件。
+"""
+
+import json
+import re
+import zipfile
+from datetime import datetime
+
+FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'markdown': ('application/zip', 'zip'),
+}
+
+# 输出缓冲超过该字节数时交给响应，避免频繁产生很小的数据块
+FLUSH_BYTES = 64 * 1024
+
+# 文件名中不允许出现的字符
+UNSAFE_FILENAME = re.compile(r'[\\/:*?"<>|\s]+')
+
+
+def export_filename(export_format):
+    """下载文件名，如 guyuejinyu_export_20250806.ndjson"""
+    return f"guyuejinyu_export_{datetime.now():%Y%m%d}.{FORMATS[export_format][1]}"
+
+
+def ndjson_chunks(records):
+    """逐条序列化为 NDJSON，按 FLUSH_BYTES 分块输出"""
+    buffer, size = [], 0
+    for record in records:
+        line = (json.dumps(record, ensure_ascii=False, default=str) + '\n').encode('utf-8')
+        buffer.append(line)
+        size += len(line)
+        if size >= FLUSH_BYTES:
+            yield b''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+class _ChunkSink:
+    """zipfile 的输出目标：只追加、不支持 seek，写入的数据随时可以取走
+
+    不可 seek 时 zipfile 在每个文件之后写数据描述符，无需回填文件头，适合流式输出。
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks, self.size = [], 0
+        return data
+
+
+def _transcript_name(conversation, used_names):
+    """对话在压缩包中的文件名：创建日期_标题.md，重名时追加对话ID前缀"""
+    title = UNSAFE_FILENAME.sub('_', conversation.get('title') or '对话')[:40]
+    name = f"{str(conversation.get('created_at') or '')[:10]}_{title}.md"
+    if name in used_names:
+        name = f"{name[:-3]}_{conversation['id'][:8]}.md"
+    used_names.add(name)
+    return name
+
+
+def _conversation_header(conversation):
+    return (f"# {conversation.get('title') or '对话'}\n\n"
+            f"- 角色：{conversation.get('character_name') or conversation.get('character_id') or '未知'}\n"
+            f"- 创建时间：{conversation.get('created_at')}\n"
+            f"- 最后更新：{conversation.get('updated_at')}\n\n")
+
+
+def _message_markdown(message, character_name):
+    text = f"### {message.get('created_at')}\n\n**我**：{message.get('user_message') or ''}\n\n"
+    text += f"**{character_name}**：{message.get('ai_response') or ''}\n\n"
+    if message.get('image_url'):
+        text += f"![图片]({message['image_url']})\n\n"
+    return text
+
+
+def markdown_zip_chunks(records):
+    """每个对话写成一个 Markdown 文件，边压缩边输出 zip 数据"""
+    sink = _ChunkSink()
+    used_names = set()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        entry, character_name = None, None
+        try:
+            for record in records:
+                if record['type'] == 'conversation':
+                    if entry is not None:
+                        entry.close()
+                    entry = archive.open(_transcript_name(record, used_names), 'w')
+                    character_name = record.get('character_name') or '角色'
+                    entry.write(_conversation_header(record).encode('utf-8'))
+                elif entry is not None:
+                    entry.write(_message_markdown(record, character_name).encode('utf-8'))
+                if sink.size >= FLUSH_BYTES:
+                    yield sink.take()
+        finally:
+            if entry is not None:
+                entry.close()
+    yield sink.take()
+
+
+def stream_export(records, export_format):
+    """按格式把记录转换为字节块，结束或客户端断开时关闭记录生成器（释放数据库连接）"""
+    chunks = markdown_zip_chunks(records) if export_format == 'markdown' else ndjson_chunks(records)
+    try:
+        yield from chunks
+    finally:
+        chunks.close()
+        records.close()
@@ -44,4 +44,53 @@ loglevel = "info"
 preload_app = True
 
 # 工作进程重启阈值
-max_requests = 1000
\ No newline at end of file
+max_requests = 1000
+
+
+def when_ready(server):
+    """preload_app 时在master中一次性完成数据库初始化（迁移、默认角色），worker直接继承"""
+    from app import db
+    from config import Config
+    db.init_database()
+    db.pool.close_all()
+    db.read_pool.close_all()
+
+    # 启用延迟写入时，由master启动唯一的写入进程，进程意外退出后自动重启
+    server.writer_supervisor = None
+    if Config.WRITE_BEHIND:
+        from write_queue import WriterSupervisor
+        server.writer_supervisor = WriterSupervisor(
+            db, Config.WRITE_QUEUE_PATH, Config.get_sqlite_pragmas(), Config.WRITE_BATCH_SIZE)
+        server.writer_supervisor.start()
+
+    # 已删除角色的对话由唯一的清理进程在后台分批删除（SQLite 单库、分片）；
+    # 内存存储的数据在各 worker 自己的内存中，清理进程访问不到，不启动
+    server.reaper_process = None
+    if Config.STORAGE_BACKEND != 'memory':
+        from reaper import start_reaper_process
+        server.reaper_process = start_reaper_process(
+            db, Config.REAPER_INTERVAL, Config.REAPER_GRACE_SECONDS, Config.REAPER_BATCH, Config.REAPER_PAUSE)
+
+
+def pre_fork(server, worker):
+    """fork worker前关闭master中打开的数据库连接，SQLite连接不能跨进程共享"""
+    from app import db
+    db.pool.close_all()
+    db.read_pool.close_all()
+
+
+
+def on_exit(server):
+    """master退出时清空写入队列、截断WAL文件，把已提交的数据全部写回主数据库"""
+    from app import db, write_queue
+    from reaper import stop_reaper_process
+    stop_reaper_process(getattr(server, 'reaper_process', None))
+    if write_queue is not None:
+        from write_queue import TurnWriter
+        supervisor = getattr(server, 'writer_supervisor', None)
+        if supervisor is not None:
+            supervisor.stop()
+        TurnWriter(db, write_queue).drain()
+    db.checkpoint('TRUNCATE')
+    db.pool.close_all()
+    db.read_pool.close_all()
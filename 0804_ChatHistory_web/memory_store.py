@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+内存存储后端
+与 SQLite 实现语义一致的进程内存储，用于快速、无文件的测试和基准对比。
+数据只存在于当前进程，不能用于多 worker 部署或延迟写入队列。
+
+所有操作持有同一把锁，单次调用是原子的；
+统计计数与 SQLite 的触发器一致：按天/按小时统计只累加，用户/角色计数在删除消息和对话时同步减少。
+"""
+
+import copy
+import itertools
+import threading
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+
+import search
+from migrations import DEFAULT_CHARACTERS, PREVIEW_LENGTH
+from pagination import DEFAULT_PAGE_SIZE, build_page, clamp_limit, decode_cursor
+from records import CharacterSummary, ChatTurn
+from result_cache import ResultCache
+from storage import NullPool, Storage
+
+
+def _utc_now():
+    """与 SQLite CURRENT_TIMESTAMP 格式一致的 UTC 时间"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _timestamp(value):
+    """与 sqlite3 绑定 datetime 参数时的字符串格式一致"""
+    return str(value) if isinstance(value, datetime) else value
+
+
+def _hour_bucket(timestamp):
+    return f"{timestamp[:10]} {timestamp[11:13]}:00:00"
+
+
+def _keyset_page(rows, page_cursor, limit):
+    """按 (updated_at, id) 倒序的游标分页，与 pagination.keyset_clause 的取数方式一致"""
+    limit = clamp_limit(limit)
+    direction = 'next'
+    if page_cursor:
+        updated_at, row_id, direction = decode_cursor(page_cursor)
+        key = (updated_at, row_id)
+        if direction == 'next':
+            rows = [row for row in rows if (row['updated_at'], row['id']) < key]
+        else:
+            rows = [row for row in rows if (row['updated_at'], row['id']) > key]
+    rows.sort(key=lambda row: (row['updated_at'], row['id']), reverse=direction == 'next')
+    return build_page(rows[:limit + 1], limit, direction, page_cursor is not None)
+
+
+class MemoryDatabase(Storage):
+    """线程安全的内存存储"""
+
+    def __init__(self):
+        self.cache = ResultCache()
+        self.pool = NullPool()
+        self.read_pool = NullPool()
+        self._lock = threading.RLock()
+        self._message_ids = itertools.count(1)
+        self._last_applied_id = 0
+
+        self._characters = {}
+        self._user_configs = {}
+        self._conversations = {}
+        self._messages = {}
+        self._conversation_messages = defaultdict(list)
+
+        # 对应 stats_hourly / stats_daily / user_stats / character_stats 及其去重集合
+        self._stats_hourly = defaultdict(lambda: {
+            'message_count': 0, 'successful_responses': 0, 'image_requests': 0, 'successful_images': 0})
+        self._stats_daily = defaultdict(lambda: {'new_conversations': 0, 'message_count': 0, 'active_users': 0})
+        self._daily_users = set()
+        self._user_stats = {}
+        self._character_stats = {}
+        # (角色, 用户) -> 消息数：对应 character_users，计数归零时角色的用户数减一
+        self._character_users = Counter()
+
+        created_at = _utc_now()
+        for character in DEFAULT_CHARACTERS:
+            self._characters[character['id']] = dict(
+                character, generated_avatar_url=None, created_at=created_at, user_id=None, deleted_at=None)
+
+    # ====== 角色 ======
+
+    def get_characters(self, user_id=None):
+        """获取角色列表（包含默认角色和用户自定义角色），返回 CharacterSummary"""
+        with self._lock:
+            characters = [CharacterSummary(**{field: c[field] for field in CharacterSummary._fields})
+                          for c in self._characters.values()
+                          if c['deleted_at'] is None
+                          and (c['user_id'] is None or (user_id and c['user_id'] == user_id))]
+        characters.sort(key=lambda c: c.created_at)
+        return characters
+
+    def get_character(self, character_id, user_id=None):
+        """获取特定角色（已标记删除、等待清理的角色视为不存在）"""
+        with self._lock:
+            character = self._characters.get(character_id)
+            return dict(character) if character and character['deleted_at'] is None else None
+
+    def add_custom_character(self, character_data, user_id):
+        """添加自定义角色"""
+        with self._lock:
+            if character_data['id'] in self._characters:
+                print(f"添加角色失败: 角色ID已存在 {character_data['id']}")
+                return False
+            self._characters[character_data['id']] = {
+                'id': character_data['id'],
+                'name': character_data['name'],
+                'description': character_data['description'],
+                'style': character_data['style'],
+                'avatar_url': character_data.get('avatar_url', ''),
+                'generated_avatar_url': None,
+                'system_prompt': character_data['system_prompt'],
+                'created_at': _utc_now(),
+                'user_id': user_id,
+                'deleted_at': None,
+            }
+        self.cache.invalidate()
+        return True
+
+    def delete_custom_character(self, character_id, user_id=None):
+        """删除自定义角色：与 SQLite 一样只设置删除标记（默认角色不能删除），对话由 reap_deleted_characters 清理"""
+        with self._lock:
+            character = self._characters.get(character_id)
+            if character and character['user_id'] is not None and character['deleted_at'] is None:
+                character['deleted_at'] = _utc_now()
+        self.cache.invalidate()
+        return True
+
+    def reap_deleted_characters(self, grace_seconds=60, batch_size=500, pause=0.05):
+        """删除标记删除超过 grace_seconds 秒的角色及其对话和消息，返回 (角色数, 对话数, 消息数)"""
+        cutoff = (datetime.now(timezone.utc) - timedelta(seconds=grace_seconds)).strftime('%Y-%m-%d %H:%M:%S')
+        reaped = total_conversations = total_messages = 0
+        with self._lock:
+            for character_id in [c['id'] for c in self._characters.values()
+                                 if c['deleted_at'] is not None and c['deleted_at'] <= cutoff]:
+                for conv_id in [c['id'] for c in self._conversations.values() if c['character_id'] == character_id]:
+                    for message_id in self._conversation_messages.pop(conv_id, []):
+                        self._uncount_message(self._messages.pop(message_id))
+                        total_messages += 1
+                    self._uncount_conversation(self._conversations.pop(conv_id))
+                    total_conversations += 1
+                del self._characters[character_id]
+                self._character_stats.pop(character_id, None)
+                self._character_users = Counter({pair: count for pair, count in self._character_users.items()
+                                                 if pair[0] != character_id})
+                reaped += 1
+        if reaped:
+            self.cache.invalidate()
+        return reaped, total_conversations, total_messages
+
+    def update_character_avatar(self, character_id, avatar_url):
+        """更新角色的生成头像"""
+        with self._lock:
+            character = self._characters.get(character_id)
+            if character:
+                character['generated_avatar_url'] = avatar_url
+
+    # ====== 用户配置 ======
+
+    def save_user_config(self, user_id, config):
+        """保存用户配置"""
+        with self._lock:
+            self._user_configs[user_id] = {
+                'user_id': user_id,
+                'api_key': config.get('api_key'),
+                'text_model': config.get('text_model', 'qwen-plus'),
+                'image_model': config.get('image_model', 'wan2.2-t2i-flash'),
+                'created_at': _utc_now(),
+                'updated_at': _timestamp(datetime.now()),
+            }
+
+    def get_user_config(self, user_id):
+        """获取用户配置"""
+        with self._lock:
+            config = self._user_configs.get(user_id)
+            return dict(config) if config else None
+
+    # ====== 对话与消息 ======
+
+    def save_message(self, conversation_id, user_id, character_id, user_message, ai_response,
+                     image_url=None, character_name=None):
+        """保存对话消息"""
+        with self._lock:
+            self._write_turn({
+                'conversation_id': conversation_id,
+                'user_id': user_id,
+                'character_id': character_id,
+                'user_message': user_message,
+                'ai_response': ai_response,
+                'image_url': image_url,
+                'character_name': character_name,
+                'updated_at': datetime.now(),
+            })
+        self.cache.invalidate()
+
+    def write_turns(self, turns, last_queue_id):
+        """批量写入队列中的对话，同时记录已写入的队列位置"""
+        with self._lock:
+            for turn in turns:
+                self._write_turn(turn)
+            self._last_applied_id = last_queue_id
+        self.cache.invalidate()
+
+    def get_last_applied_turn(self):
+        """获取已写入的最后一个队列ID"""
+        with self._lock:
+            return self._last_applied_id
+
+    def _write_turn(self, turn):
+        """写入一轮对话并累加统计（调用方持有锁）"""
+        conv_id, user_id, character_id = turn['conversation_id'], turn['user_id'], turn['character_id']
+        conv = self._conversations.get(conv_id)
+        if conv is None:
+            character = self._characters.get(character_id)
+            if turn.get('character_name'):
+                title = f"与{turn['character_name']}的对话"
+            else:
+                title = f"与{character['name']}的对话" if character else '新对话'
+            conv = self._conversations[conv_id] = {
+                'id': conv_id,
+                'user_id': user_id,
+                'character_id': character_id,
+                'title': title,
+                'created_at': _utc_now(),
+                'updated_at': _timestamp(turn['updated_at']),
+                'message_count': 0,
+                'last_message_at': None,
+                'last_message_preview': None,
+                'archive_month': None,
+                'archived_at': None,
+                'archived_messages': 0,
+            }
+            self._count_conversation(conv)
+        else:
+            conv['updated_at'] = _timestamp(turn['updated_at'])
+
+        message = {
+            'id': next(self._message_ids),
+            'conversation_id': conv_id,
+            'user_id': user_id,
+            'character_id': character_id,
+            'user_message': turn['user_message'],
+            'ai_response': turn['ai_response'],
+            'is_image_request': 0,
+            'image_url': turn.get('image_url'),
+            'created_at': _timestamp(turn.get('created_at')) or _utc_now(),
+        }
+        self._messages[message['id']] = message
+        self._conversation_messages[conv_id].append(message['id'])
+
+        conv['message_count'] += 1
+        conv['last_message_at'] = message['created_at']
+        preview = message['user_message']
+        conv['last_message_preview'] = preview[:PREVIEW_LENGTH] if preview is not None else None
+        self._count_message(message)
+
+    def _count_conversation(self, conv):
+        """新对话计入按天统计和用户/角色计数"""
+        self._stats_daily[conv['created_at'][:10]]['new_conversations'] += 1
+        if conv['user_id'] is not None:
+            self._user_stat(conv['user_id'])['conversation_count'] += 1
+        if conv['character_id'] is not None:
+            self._character_stat(conv['character_id'])['conversation_count'] += 1
+
+    def _count_message(self, message):
+        """新消息计入按小时/按天统计和用户/角色计数"""
+        created_at, user_id, character_id = message['created_at'], message['user_id'], message['character_id']
+        image_request = message['is_image_request'] == 1
+
+        hourly = self._stats_hourly[_hour_bucket(created_at)]
+        hourly['message_count'] += 1
+        hourly['successful_responses'] += bool(message['ai_response'])
+        hourly['image_requests'] += image_request
+        hourly['successful_images'] += image_request and bool(message['image_url'])
+
+        day = created_at[:10]
+        self._stats_daily[day]['message_count'] += 1
+        if user_id is not None and (day, user_id) not in self._daily_users:
+            self._daily_users.add((day, user_id))
+            self._stats_daily[day]['active_users'] += 1
+
+        if user_id is not None:
+            stat = self._user_stat(user_id)
+            stat['message_count'] += 1
+            stat['last_active'] = max(stat['last_active'] or '', created_at)
+        if character_id is not None:
+            stat = self._character_stat(character_id)
+            stat['message_count'] += 1
+            stat['last_active'] = max(stat['last_active'] or '', created_at)
+            if user_id is not None:
+                if not self._character_users[(character_id, user_id)]:
+                    stat['user_count'] += 1
+                self._character_users[(character_id, user_id)] += 1
+
+    def _uncount_conversation(self, conv):
+        """已删除的对话从用户/角色计数中减去（对应 trg_conversations_counters_delete）"""
+        if conv['user_id'] in self._user_stats:
+            self._user_stats[conv['user_id']]['conversation_count'] -= 1
+            self._drop_empty_user_stat(conv['user_id'])
+        if conv['character_id'] in self._character_stats:
+            self._character_stats[conv['character_id']]['conversation_count'] -= 1
+
+    def _uncount_message(self, message):
+        """已删除的消息从用户/角色计数中减去（对应 trg_messages_counters_delete），last_active 不回退"""
+        user_id, character_id = message['user_id'], message['character_id']
+        if user_id in self._user_stats:
+            self._user_stats[user_id]['message_count'] -= 1
+            self._drop_empty_user_stat(user_id)
+        if character_id in self._character_stats:
+            self._character_stats[character_id]['message_count'] -= 1
+            pair = (character_id, user_id)
+            if self._character_users.get(pair):
+                self._character_users[pair] -= 1
+                if not self._character_users[pair]:
+                    del self._character_users[pair]
+                    self._character_stats[character_id]['user_count'] -= 1
+
+    def _drop_empty_user_stat(self, user_id):
+        stat = self._user_stats[user_id]
+        if stat['message_count'] <= 0 and stat['conversation_count'] <= 0:
+            del self._user_stats[user_id]
+
+    def _user_stat(self, user_id):
+        return self._user_stats.setdefault(user_id, {
+            'user_id': user_id, 'message_count': 0, 'conversation_count': 0, 'last_active': None})
+
+    def _character_stat(self, character_id):
+        return self._character_stats.setdefault(character_id, {
+            'character_id': character_id, 'message_count': 0, 'conversation_count': 0,
+            'user_count': 0, 'last_active': None})
+
+    def get_chat_history(self, conversation_id, limit=50, user_id=None):
+        """获取对话历史（按时间正序）"""
+        with self._lock:
+            messages = [self._messages[i] for i in self._conversation_messages.get(conversation_id, [])]
+            messages.sort(key=lambda m: (m['created_at'], m['id']), reverse=True)
+            return [dict(m) for m in reversed(messages[:limit])]
+
+    def get_recent_turns(self, conversation_id, limit=6, user_id=None):
+        """构建提示词用的最近几轮对话（按时间正序）"""
+        with self._lock:
+            messages = [self._messages[i] for i in self._conversation_messages.get(conversation_id, [])]
+        messages.sort(key=lambda m: (m['created_at'], m['id']), reverse=True)
+        return [ChatTurn(m['user_message'], m['ai_response']) for m in reversed(messages[:limit])]
+
+    def get_conversations(self, user_id, page_cursor=None, limit=DEFAULT_PAGE_SIZE, character_id=None):
+        """获取用户的对话列表（按最后更新时间倒序，游标分页）"""
+        with self._lock:
+            rows = [self._with_character_name(conv) for conv in self._conversations.values()
+                    if conv['user_id'] == user_id and (not character_id or conv['character_id'] == character_id)]
+        return _keyset_page(rows, page_cursor, limit)
+
+    def _with_character_name(self, conv):
+        character = self._characters.get(conv['character_id'])
+        return dict(conv, character_name=character['name'] if character else None)
+
+    def search_messages(self, user_id, query, limit=20):
+        """在用户自己的聊天记录中搜索（按时间倒序，匹配不区分大小写）"""
+        terms = search.parse_query(query)
+        limit = clamp_limit(limit)
+
+        with self._lock:
+            hits = [dict(message) for message in self._messages.values()
+                    if message['user_id'] == user_id and search.matches(message, terms)]
+            names = {c['id']: c['name'] for c in self._characters.values()}
+
+        hits.sort(key=lambda m: (m['created_at'], m['id']), reverse=True)
+        return [{
+            'message_id': m['id'],
+            'conversation_id': m['conversation_id'],
+            'character_id': m['character_id'],
+            'character_name': names.get(m['character_id']),
+            'created_at': m['created_at'],
+            'user_message': search.make_snippet(m['user_message'], terms),
+            'ai_response': search.make_snippet(m['ai_response'], terms),
+        } for m in hits[:limit]]
+
+    def purge_search_index(self, batch_size=500):
+        """内存存储搜索时直接扫描消息，没有需要清理的索引"""
+        return 0
+
+    def export_conversations(self, user_id):
+        """逐条生成用户的对话和消息（每个对话在锁内复制后输出）"""
+        with self._lock:
+            conv_ids = [c['id'] for c in sorted(self._conversations.values(), key=lambda c: (c['created_at'], c['id']))
+                        if c['user_id'] == user_id]
+        for conv_id in conv_ids:
+            with self._lock:
+                conv = self._conversations.get(conv_id)
+                if conv is None:
+                    continue
+                record = {key: value for key, value in self._with_character_name(conv).items()
+                          if key in ('id', 'title', 'character_id', 'character_name', 'created_at', 'updated_at',
+                                     'message_count')}
+                messages = sorted((self._messages[i] for i in self._conversation_messages.get(conv_id, [])),
+                                  key=lambda m: (m['created_at'], m['id']))
+                messages = [{key: m[key] for key in ('id', 'conversation_id', 'user_message', 'ai_response',
+                                                     'image_url', 'created_at')} for m in messages]
+            yield dict(record, type='conversation')
+            for message in messages:
+                yield dict(message, type='message')
+
+    # ====== 管理员相关方法 ======
+
+    def get_admin_stats(self):
+        """获取管理员统计数据"""
+        today = datetime.now(timezone.utc).date()
+        week_ago = (today - timedelta(days=7)).isoformat()
+        today = today.isoformat()
+        with self._lock:
+            popular = sorted((
+                {'name': c['name'],
+                 'conversation_count': self._character_stats.get(c['id'], {}).get('conversation_count', 0)}
+                for c in self._characters.values() if c['deleted_at'] is None
+            ), key=lambda row: row['conversation_count'], reverse=True)
+            return {
+                'total_users': len(self._user_stats),
+                'total_conversations': len(self._conversations),
+                'total_messages': len(self._messages),
+                'today_conversations': self._stats_daily.get(today, {}).get('new_conversations', 0),
+                'popular_characters': popular[:5],
+                'user_activity': [{'date': day, 'active_users': stats['active_users']}
+                                  for day, stats in sorted(self._stats_daily.items()) if day >= week_ago],
+            }
+
+    def get_all_conversations(self, page_cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """获取所有对话记录（按最后更新时间倒序，游标分页）"""
+        columns = ('id', 'user_id', 'title', 'character_name', 'created_at', 'updated_at',
+                   'message_count', 'last_message_at', 'last_message_preview')
+        with self._lock:
+            rows = [{column: row[column] for column in columns}
+                    for row in map(self._with_character_name, self._conversations.values())]
+            total = len(self._conversations)
+        page = _keyset_page(rows, page_cursor, limit)
+        page['total'] = total
+        return page
+
+    def get_user_statistics(self):
+        """获取用户统计数据"""
+        with self._lock:
+            active_users = sorted((dict(stat) for stat in self._user_stats.values()),
+                                  key=lambda stat: stat['message_count'], reverse=True)[:20]
+            preferences = [{
+                'character_name': self._characters[stat['character_id']]['name']
+                if stat['character_id'] in self._characters else None,
+                'user_count': stat['user_count'],
+                'message_count': stat['message_count'],
+            } for stat in self._character_stats.values() if stat['message_count'] > 0]
+
+        return {
+            'active_users': [{key: user[key] for key in ('user_id', 'conversation_count', 'message_count',
+                                                          'last_active')} for user in active_users],
+            'character_preferences': sorted(preferences, key=lambda row: row['user_count'], reverse=True),
+        }
+
+    def get_performance_stats(self):
+        """获取AI性能统计"""
+        now = datetime.now(timezone.utc)
+        day_ago = (now - timedelta(hours=24)).strftime('%Y-%m-%d %H:00:00')
+        week_ago = (now - timedelta(days=7)).strftime('%Y-%m-%d %H:00:00')
+        with self._lock:
+            buckets = copy.deepcopy(dict(self._stats_hourly))
+
+        hourly_stats = sorted((
+            {'hour': bucket[11:13], 'message_count': stats['message_count'],
+             'success_rate': stats['successful_responses'] / stats['message_count']}
+            for bucket, stats in buckets.items() if bucket > day_ago and stats['message_count'] > 0
+        ), key=lambda row: row['hour'])
+        recent = [stats for bucket, stats in buckets.items() if bucket >= week_ago]
+        total = sum(stats['message_count'] for stats in recent)
+        successful = sum(stats['successful_responses'] for stats in recent)
+
+        return {
+            'hourly_stats': hourly_stats,
+            'success_rate': round(successful / total * 100, 2) if total else 0,
+            'response_stats': {'total_messages': total, 'successful_responses': successful},
+            'image_stats': {
+                'total_image_requests': sum(stats['image_requests'] for stats in recent),
+                'successful_images': sum(stats['successful_images'] for stats in recent),
+            },
+        }
@@ -0,0 +1,1080 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+数据库结构迁移
+schema_version 表记录已执行的迁移，PRAGMA user_version 保存当前版本号：
+版本已是最新的进程只读取一次 user_version，不做任何DDL检查。
+迁移在文件锁内执行，多个gunicorn worker同时启动时只有一个真正执行。
+"""
+
+import fcntl
+from datetime import datetime
+
+# 按版本号排序的迁移步骤: (版本, 说明, 函数)
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """注册一个迁移步骤，版本号必须递增"""
+    def decorator(func):
+        assert not MIGRATIONS or MIGRATIONS[-1][0] < version, "迁移版本号必须递增"
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+
+def _columns(cursor, table):
+    """获取表的字段名"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in cursor.fetchall()}
+
+
+@migration(1, "基础表结构")
+def create_base_tables(cursor):
+    # 用户配置表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_configs (
+            user_id TEXT PRIMARY KEY,
+            api_key TEXT,
+            text_model TEXT DEFAULT 'qwen-plus',
+            image_model TEXT DEFAULT 'wan2.2-t2i-flash',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 角色表（user_id 为空表示系统默认角色，否则为该用户的自定义角色）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS characters (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            description TEXT,
+            style TEXT,
+            avatar_url TEXT,
+            generated_avatar_url TEXT,
+            system_prompt TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            user_id TEXT
+        )
+    ''')
+
+    # 早期版本的角色表缺少的字段
+    columns = _columns(cursor, 'characters')
+    if 'generated_avatar_url' not in columns:
+        cursor.execute("ALTER TABLE characters ADD COLUMN generated_avatar_url TEXT")
+        print("已添加 generated_avatar_url 字段到 characters 表")
+    if 'user_id' not in columns:
+        cursor.execute("ALTER TABLE characters ADD COLUMN user_id TEXT")
+        print("已添加 user_id 字段到 characters 表，实现角色用户隔离")
+
+    # 对话表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            character_id TEXT,
+            title TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (character_id) REFERENCES characters (id)
+        )
+    ''')
+
+    # 消息表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id TEXT,
+            user_id TEXT,
+            character_id TEXT,
+            user_message TEXT,
+            ai_response TEXT,
+            is_image_request BOOLEAN DEFAULT 0,
+            image_url TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id),
+            FOREIGN KEY (character_id) REFERENCES characters (id)
+        )
+    ''')
+
+
+# 热点查询所需的二级索引，均为 (过滤列, 排序列) 组合，尽量覆盖查询所需的列
+INDEXES = [
+    # get_chat_history: WHERE conversation_id = ? ORDER BY created_at
+    'CREATE INDEX IF NOT EXISTS idx_messages_conversation_created ON messages (conversation_id, created_at)',
+    # get_user_statistics: 按用户分组统计对话数、消息数、最后活跃时间
+    'CREATE INDEX IF NOT EXISTS idx_messages_user_conversation ON messages (user_id, conversation_id, created_at)',
+    # get_user_statistics: 按角色分组统计用户数、消息数
+    'CREATE INDEX IF NOT EXISTS idx_messages_character_user ON messages (character_id, user_id)',
+    # get_performance_stats: 按时间范围统计
+    'CREATE INDEX IF NOT EXISTS idx_messages_created ON messages (created_at)',
+    # get_conversations: WHERE user_id = ? ORDER BY updated_at
+    'CREATE INDEX IF NOT EXISTS idx_conversations_user_updated ON conversations (user_id, updated_at)',
+    # delete_custom_character / 热门角色统计: WHERE character_id = ?
+    'CREATE INDEX IF NOT EXISTS idx_conversations_character ON conversations (character_id)',
+    # get_admin_stats / get_all_conversations: 按创建时间过滤、排序
+    'CREATE INDEX IF NOT EXISTS idx_conversations_created ON conversations (created_at, user_id)',
+    # get_characters: WHERE user_id IS NULL OR user_id = ? ORDER BY created_at
+    'CREATE INDEX IF NOT EXISTS idx_characters_user ON characters (user_id, created_at)',
+]
+
+
+@migration(2, "热点查询索引")
+def create_indexes(cursor):
+    for statement in INDEXES:
+        cursor.execute(statement)
+
+
+# 系统默认角色
+DEFAULT_CHARACTERS = [
+    {
+        'id': 'kongzi',
+        'name': '孔子',
+        'description': '春秋时期著名思想家、教育家，儒家学派创始人',
+        'style': '温文尔雅，循循善诱，喜用比喻，语言庄重而富有哲理',
+        'avatar_url': '',
+        'system_prompt': '孔子（公元前551年－公元前479年），字仲尼，春秋时期鲁国人，中国古代思想家、教育家，儒家学派创始人。以仁、义、礼、智、信为核心思想，主张"有教无类"，注重道德修养和社会秩序。'
+    },
+    {
+        'id': 'libai',
+        'name': '李白',
+        'description': '唐代伟大的浪漫主义诗人，被誉为"诗仙"',
+        'style': '豪放不羁，想象奇特，语言飘逸，常用夸张和比喻，富有浪漫色彩',
+        'avatar_url': '',
+        'system_prompt': '李白（701年－762年），字太白，号青莲居士，唐代伟大的浪漫主义诗人，被誉为"诗仙"。性格豪放，喜好饮酒作诗，追求自由，蔑视权贵，其诗风雄奇豪放，想象丰富。'
+    },
+    {
+        'id': 'zhugeliang',
+        'name': '诸葛亮',
+        'description': '三国时期蜀汉丞相，杰出的政治家、军事家、发明家',
+        'style': '智慧深邃，言辞谨慎，善于分析，语言简练而富有逻辑性',
+        'avatar_url': '',
+        'system_prompt': '诸葛亮（181年－234年），字孔明，号卧龙，三国时期蜀汉丞相，杰出的政治家、军事家、发明家。以智谋著称，忠诚于蜀汉，鞠躬尽瘁，死而后已。'
+    },
+    {
+        'id': 'wuzetian',
+        'name': '武则天',
+        'description': '中国历史上唯一的正统女皇帝，政治家',
+        'style': '威严果断，智慧过人，语言简练有力，体现女性领导者的魅力',
+        'avatar_url': '',
+        'system_prompt': '武则天（624年－705年），中国历史上唯一的正统女皇帝，杰出的政治家。善于用人，推行科举制度，促进文化发展，统治期间社会相对稳定。'
+    },
+    {
+        'id': 'wangyangming',
+        'name': '王阳明',
+        'description': '明代著名哲学家、教育家、军事家，心学集大成者',
+        'style': '深邃睿智，注重内心修养，语言精练，富有哲理性和启发性',
+        'avatar_url': '',
+        'system_prompt': '王阳明（1472年－1529年），名守仁，字伯安，明代著名哲学家、教育家、军事家，心学集大成者。主张"心即理"、"知行合一"、"致良知"，强调内心的道德修养。'
+    }
+]
+
+
+def seed_default_characters(cursor):
+    """一次性批量写入默认角色，已存在的角色保持不变"""
+    cursor.executemany('''
+        INSERT OR IGNORE INTO characters (id, name, description, style, avatar_url, system_prompt)
+        VALUES (:id, :name, :description, :style, :avatar_url, :system_prompt)
+    ''', DEFAULT_CHARACTERS)
+
+
+@migration(3, "写入默认角色")
+def create_default_characters(cursor):
+    seed_default_characters(cursor)
+
+
+@migration(4, "延迟写入队列位置")
+def create_write_queue_state(cursor):
+    # 写入进程在提交批量对话的同一事务中更新 last_applied_id，保证队列中的对话只写入一次
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS write_queue_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_applied_id INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO write_queue_state (id, last_applied_id) VALUES (1, 0)')
+
+
+@migration(5, "游标分页索引")
+def create_keyset_indexes(cursor):
+    # 对话列表按 (updated_at, id) 游标分页，索引需包含 id 作为同一时间内的排序依据
+    cursor.execute('DROP INDEX IF EXISTS idx_conversations_user_updated')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_user_updated_id
+        ON conversations (user_id, updated_at, id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_updated_id
+        ON conversations (updated_at, id)
+    ''')
+
+
+# 对话列表展示的最后一条消息预览长度
+PREVIEW_LENGTH = 60
+
+
+@migration(6, "对话冗余统计字段（消息数、最后消息时间、预览）")
+def create_conversation_summary(cursor):
+    # 列表页直接读取对话表上的冗余字段，不再关联 messages 表计数
+    columns = _columns(cursor, 'conversations')
+    if 'message_count' not in columns:
+        cursor.execute("ALTER TABLE conversations ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0")
+    if 'last_message_at' not in columns:
+        cursor.execute("ALTER TABLE conversations ADD COLUMN last_message_at TIMESTAMP")
+    if 'last_message_preview' not in columns:
+        cursor.execute("ALTER TABLE conversations ADD COLUMN last_message_preview TEXT")
+
+    # 由触发器维护，任何写入路径（含写入进程、批量清理）都能保持一致
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_summary_insert
+        AFTER INSERT ON messages
+        BEGIN
+            UPDATE conversations SET
+                message_count = message_count + 1,
+                last_message_at = NEW.created_at,
+                last_message_preview = substr(NEW.user_message, 1, {PREVIEW_LENGTH})
+            WHERE id = NEW.conversation_id;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_summary_delete
+        AFTER DELETE ON messages
+        BEGIN
+            UPDATE conversations SET
+                message_count = message_count - 1,
+                last_message_at = (
+                    SELECT MAX(created_at) FROM messages WHERE conversation_id = OLD.conversation_id
+                ),
+                last_message_preview = (
+                    SELECT substr(user_message, 1, {PREVIEW_LENGTH}) FROM messages
+                    WHERE conversation_id = OLD.conversation_id
+                    ORDER BY created_at DESC, id DESC LIMIT 1
+                )
+            WHERE id = OLD.conversation_id;
+        END
+    ''')
+
+    # 回填已有对话
+    cursor.execute(f'''
+        UPDATE conversations SET
+            message_count = (
+                SELECT COUNT(*) FROM messages WHERE conversation_id = conversations.id
+            ),
+            last_message_at = (
+                SELECT MAX(created_at) FROM messages WHERE conversation_id = conversations.id
+            ),
+            last_message_preview = (
+                SELECT substr(user_message, 1, {PREVIEW_LENGTH}) FROM messages
+                WHERE conversation_id = conversations.id
+                ORDER BY created_at DESC, id DESC LIMIT 1
+            )
+    ''')
+
+
+
+@migration(7, "按小时/按天的统计汇总表")
+def create_stats_rollups(cursor):
+    # 每小时一行：消息量、AI回复成功数、图片请求及成功数
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_hourly (
+            bucket TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            successful_responses INTEGER NOT NULL DEFAULT 0,
+            image_requests INTEGER NOT NULL DEFAULT 0,
+            successful_images INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    # 每天一行：新增对话、消息量、活跃用户数
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT PRIMARY KEY,
+            new_conversations INTEGER NOT NULL DEFAULT 0,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            active_users INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    # 当天已出现过的用户，用于增量维护去重的活跃用户数
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_daily_users (
+            day TEXT,
+            user_id TEXT,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+    ''')
+
+    # 回填已有数据（迁移在写事务中执行，期间不会有新消息写入）
+    cursor.execute('''
+        INSERT INTO stats_hourly (bucket, message_count, successful_responses, image_requests, successful_images)
+        SELECT
+            strftime('%Y-%m-%d %H:00:00', created_at),
+            COUNT(*),
+            SUM(ai_response IS NOT NULL AND ai_response != ''),
+            SUM(COALESCE(is_image_request, 0) = 1),
+            SUM(COALESCE(is_image_request, 0) = 1 AND image_url IS NOT NULL AND image_url != '')
+        FROM messages
+        WHERE created_at IS NOT NULL
+        GROUP BY 1
+    ''')
+    cursor.execute('''
+        INSERT INTO stats_daily_users (day, user_id)
+        SELECT DISTINCT DATE(created_at), user_id FROM messages
+        WHERE created_at IS NOT NULL AND user_id IS NOT NULL
+    ''')
+    cursor.execute('''
+        INSERT INTO stats_daily (day, new_conversations, message_count, active_users)
+        SELECT day, SUM(new_conversations), SUM(message_count), SUM(active_users)
+        FROM (
+            SELECT DATE(created_at) AS day, COUNT(*) AS new_conversations,
+                   0 AS message_count, 0 AS active_users
+            FROM conversations WHERE created_at IS NOT NULL GROUP BY 1
+            UNION ALL
+            SELECT DATE(created_at), 0, COUNT(*), COUNT(DISTINCT user_id)
+            FROM messages WHERE created_at IS NOT NULL GROUP BY 1
+        )
+        GROUP BY day
+    ''')
+
+    # 之后由触发器随写入累加；清理或归档旧消息不会改变历史统计
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_stats_insert
+        AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO stats_hourly (bucket, message_count, successful_responses, image_requests, successful_images)
+            VALUES (
+                strftime('%Y-%m-%d %H:00:00', NEW.created_at),
+                1,
+                NEW.ai_response IS NOT NULL AND NEW.ai_response != '',
+                COALESCE(NEW.is_image_request, 0) = 1,
+                COALESCE(NEW.is_image_request, 0) = 1 AND NEW.image_url IS NOT NULL AND NEW.image_url != ''
+            )
+            ON CONFLICT(bucket) DO UPDATE SET
+                message_count = message_count + excluded.message_count,
+                successful_responses = successful_responses + excluded.successful_responses,
+                image_requests = image_requests + excluded.image_requests,
+                successful_images = successful_images + excluded.successful_images;
+
+            INSERT INTO stats_daily (day, message_count, active_users)
+            VALUES (
+                DATE(NEW.created_at),
+                1,
+                NEW.user_id IS NOT NULL AND NOT EXISTS (
+                    SELECT 1 FROM stats_daily_users
+                    WHERE day = DATE(NEW.created_at) AND user_id = NEW.user_id
+                )
+            )
+            ON CONFLICT(day) DO UPDATE SET
+                message_count = message_count + 1,
+                active_users = active_users + excluded.active_users;
+
+            INSERT OR IGNORE INTO stats_daily_users (day, user_id)
+            VALUES (DATE(NEW.created_at), NEW.user_id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_conversations_stats_insert
+        AFTER INSERT ON conversations
+        BEGIN
+            INSERT INTO stats_daily (day, new_conversations)
+            VALUES (DATE(NEW.created_at), 1)
+            ON CONFLICT(day) DO UPDATE SET new_conversations = new_conversations + 1;
+        END
+    ''')
+
+
+def _backfill_counters(cursor):
+    """按 messages、conversations 中现有的数据填充用户/角色计数表（调用方保证表为空）"""
+    cursor.execute('''
+        INSERT INTO user_stats (user_id, message_count, conversation_count, last_active)
+        SELECT user_id, SUM(message_count), SUM(conversation_count), MAX(last_active)
+        FROM (
+            SELECT user_id, COUNT(*) AS message_count, 0 AS conversation_count,
+                   MAX(created_at) AS last_active
+            FROM messages GROUP BY user_id
+            UNION ALL
+            SELECT user_id, 0, COUNT(*), NULL FROM conversations GROUP BY user_id
+        )
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id
+    ''')
+    cursor.execute('''
+        INSERT INTO character_users (character_id, user_id)
+        SELECT DISTINCT character_id, user_id FROM messages
+        WHERE character_id IS NOT NULL AND user_id IS NOT NULL
+    ''')
+    cursor.execute('''
+        INSERT INTO character_stats (character_id, message_count, conversation_count, user_count, last_active)
+        SELECT character_id, SUM(message_count), SUM(conversation_count), SUM(user_count), MAX(last_active)
+        FROM (
+            SELECT character_id, COUNT(*) AS message_count, 0 AS conversation_count,
+                   COUNT(DISTINCT user_id) AS user_count, MAX(created_at) AS last_active
+            FROM messages GROUP BY character_id
+            UNION ALL
+            SELECT character_id, 0, COUNT(*), 0, NULL FROM conversations GROUP BY character_id
+        )
+        WHERE character_id IS NOT NULL
+        GROUP BY character_id
+    ''')
+
+
+@migration(8, "用户/角色计数表")
+def create_counter_tables(cursor):
+    # 每个用户一行：消息数、对话数、最后活跃时间
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            conversation_count INTEGER NOT NULL DEFAULT 0,
+            last_active TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_user_stats_messages ON user_stats (message_count, user_id)
+    ''')
+    # 每个角色一行：消息数、对话数、使用过的用户数、最后活跃时间
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS character_stats (
+            character_id TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            conversation_count INTEGER NOT NULL DEFAULT 0,
+            user_count INTEGER NOT NULL DEFAULT 0,
+            last_active TIMESTAMP
+        )
+    ''')
+    # 与角色对话过的用户，用于增量维护去重的用户数
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS character_users (
+            character_id TEXT,
+            user_id TEXT,
+            PRIMARY KEY (character_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+
+    _backfill_counters(cursor)
+
+    # 触发器与消息/对话写入在同一事务中更新计数
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_counters_insert
+        AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO user_stats (user_id, message_count, last_active)
+            SELECT NEW.user_id, 1, NEW.created_at WHERE NEW.user_id IS NOT NULL
+            ON CONFLICT(user_id) DO UPDATE SET
+                message_count = message_count + 1,
+                last_active = MAX(COALESCE(last_active, ''), excluded.last_active);
+
+            INSERT INTO character_stats (character_id, message_count, user_count, last_active)
+            SELECT
+                NEW.character_id,
+                1,
+                NEW.user_id IS NOT NULL AND NOT EXISTS (
+                    SELECT 1 FROM character_users
+                    WHERE character_id = NEW.character_id AND user_id = NEW.user_id
+                ),
+                NEW.created_at
+            WHERE NEW.character_id IS NOT NULL
+            ON CONFLICT(character_id) DO UPDATE SET
+                message_count = message_count + 1,
+                user_count = user_count + excluded.user_count,
+                last_active = MAX(COALESCE(last_active, ''), excluded.last_active);
+
+            INSERT OR IGNORE INTO character_users (character_id, user_id)
+            VALUES (NEW.character_id, NEW.user_id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_conversations_counters_insert
+        AFTER INSERT ON conversations
+        BEGIN
+            INSERT INTO user_stats (user_id, conversation_count)
+            SELECT NEW.user_id, 1 WHERE NEW.user_id IS NOT NULL
+            ON CONFLICT(user_id) DO UPDATE SET conversation_count = conversation_count + 1;
+
+            INSERT INTO character_stats (character_id, conversation_count)
+            SELECT NEW.character_id, 1 WHERE NEW.character_id IS NOT NULL
+            ON CONFLICT(character_id) DO UPDATE SET conversation_count = conversation_count + 1;
+        END
+    ''')
+
+
+@migration(9, "聊天记录全文索引（FTS5 trigram）")
+def create_message_search(cursor):
+    # 独立保存原文（不依赖 messages 表的存储格式），rowid 与 messages.id 一致；
+    # user_id / conversation_id 只用于过滤和返回，不参与分词
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            user_message,
+            ai_response,
+            user_id UNINDEXED,
+            conversation_id UNINDEXED,
+            tokenize = 'trigram'
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO messages_fts (rowid, user_message, ai_response, user_id, conversation_id)
+        SELECT id, user_message, ai_response, user_id, conversation_id FROM messages
+    ''')
+    # 新消息由 save_message 写入索引；删除消息（删除角色、清理、归档）时同步删除
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_delete
+        AFTER DELETE ON messages
+        BEGIN
+            DELETE FROM messages_fts WHERE rowid = OLD.id;
+        END
+    ''')
+
+
+@migration(10, "消息压缩字典")
+def create_compression_dictionaries(cursor):
+    # 压缩记录的头部保存字典编号，字典一经使用便不能删除或修改
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS compression_dictionaries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            codec TEXT NOT NULL,
+            data BLOB NOT NULL,
+            sample_count INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+@migration(11, "冷数据归档标记")
+def create_archive_columns(cursor):
+    # archive_month: 消息所在的月度归档库；archived_at: 归档时的 updated_at，之后有新消息即晚于该值
+    columns = _columns(cursor, 'conversations')
+    if 'archive_month' not in columns:
+        cursor.execute("ALTER TABLE conversations ADD COLUMN archive_month TEXT")
+    if 'archived_at' not in columns:
+        cursor.execute("ALTER TABLE conversations ADD COLUMN archived_at TIMESTAMP")
+    # 只索引仍有消息在主库的对话，归档任务查找候选时不必跳过大量已归档的对话
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_archive_candidates
+        ON conversations (updated_at)
+        WHERE archive_month IS NULL OR updated_at > archived_at
+    ''')
+
+
+@migration(12, "分片布局")
+def create_shard_layout(cursor):
+    # 分片模式下共享库记录分片数，分片数变化会导致用户被路由到错误的分片
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shard_layout (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            shard_count INTEGER NOT NULL
+        )
+    ''')
+
+
+@migration(13, "导出用的对话创建时间索引")
+def create_export_index(cursor):
+    # 导出按 (created_at, id) 分批读取用户的对话：创建时间不会变化，导出期间继续对话不会导致遗漏或重复
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_user_created_id
+        ON conversations (user_id, created_at, id)
+    ''')
+
+
+@migration(14, "数据修复任务进度")
+def create_data_migration_progress(cursor):
+    # chunked_migration.py 按 rowid 范围分批修改数据，每批在同一事务中记录进度，中断后从 last_rowid 继续
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS data_migration_progress (
+            migration TEXT NOT NULL,
+            step INTEGER NOT NULL,
+            description TEXT,
+            last_rowid INTEGER NOT NULL DEFAULT 0,
+            end_rowid INTEGER,
+            affected_rows INTEGER NOT NULL DEFAULT 0,
+            completed_at TIMESTAMP,
+            updated_at TIMESTAMP,
+            PRIMARY KEY (migration, step)
+        )
+    ''')
+
+
+def _rebuild_table(cursor, table, create_sql):
+    """按新的建表语句重建表：复制数据后替换原表，恢复索引和自增序号
+
+    SQLite 不能修改已有的外键约束，只能重建表；调用方需要先删除引用该表的触发器并关闭外键检查。
+    """
+    indexes = [row[0] for row in cursor.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,))]
+    sequence = cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_sequence'").fetchone() and \
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+    old_columns = _columns(cursor, table)
+
+    cursor.execute(create_sql.format(table=f"{table}_rebuild"))
+    cursor.execute(f"PRAGMA table_info({table}_rebuild)")
+    columns = ', '.join(row[1] for row in cursor.fetchall() if row[1] in old_columns)
+    cursor.execute(f"INSERT INTO {table}_rebuild ({columns}) SELECT {columns} FROM {table}")
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}_rebuild RENAME TO {table}")
+    for sql in indexes:
+        cursor.execute(sql)
+    # AUTOINCREMENT 的序号不能回退：已删除的最大消息ID不会被重新使用（分析导出按ID递增增量读取）
+    if sequence:
+        cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (sequence[0], table))
+        if not cursor.rowcount:
+            cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, sequence[0]))
+
+
+@migration(15, "级联删除外键、角色软删除标记")
+def create_cascading_foreign_keys(cursor):
+    # 删除角色时先设置 deleted_at（列表中立即消失），对话和消息由 reaper.py 在后台分批删除
+    if 'deleted_at' not in _columns(cursor, 'characters'):
+        cursor.execute("ALTER TABLE characters ADD COLUMN deleted_at TIMESTAMP")
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_characters_deleted
+        ON characters (deleted_at) WHERE deleted_at IS NOT NULL
+    ''')
+
+    # 外键改为 ON DELETE CASCADE：删除角色/对话时不会留下孤立的对话和消息；
+    # 子表的外键字段都有索引（idx_conversations_character、idx_messages_conversation_created、
+    # idx_messages_character_user），级联查找不需要扫描全表
+    triggers = cursor.execute('''
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'trigger' AND tbl_name IN ('conversations', 'messages')
+    ''').fetchall()
+    for name, _ in triggers:
+        cursor.execute(f"DROP TRIGGER {name}")
+
+    _rebuild_table(cursor, 'conversations', '''
+        CREATE TABLE {table} (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            character_id TEXT,
+            title TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            last_message_at TIMESTAMP,
+            last_message_preview TEXT,
+            archive_month TEXT,
+            archived_at TIMESTAMP,
+            FOREIGN KEY (character_id) REFERENCES characters (id) ON DELETE CASCADE
+        )
+    ''')
+    _rebuild_table(cursor, 'messages', '''
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id TEXT,
+            user_id TEXT,
+            character_id TEXT,
+            user_message TEXT,
+            ai_response TEXT,
+            is_image_request BOOLEAN DEFAULT 0,
+            image_url TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE,
+            FOREIGN KEY (character_id) REFERENCES characters (id) ON DELETE CASCADE
+        )
+    ''')
+
+    for _, sql in triggers:
+        cursor.execute(sql)
+
+
+@migration(16, "全文索引改为无内容表（不再保存原文副本）")
+def create_contentless_message_search(cursor):
+    # 索引只保存倒排表，原文从 messages 读取（回复解压后生成摘要），rowid 与 messages.id 一致；
+    # 用户、对话过滤改为关联 messages 表
+    cursor.execute('''
+        CREATE VIRTUAL TABLE messages_fts_contentless USING fts5(
+            user_message,
+            ai_response,
+            content = '',
+            tokenize = 'trigram'
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO messages_fts_contentless (rowid, user_message, ai_response)
+        SELECT rowid, user_message, ai_response FROM messages_fts
+    ''')
+    cursor.execute("DROP TRIGGER IF EXISTS trg_messages_fts_delete")
+    cursor.execute("DROP TABLE messages_fts")
+    cursor.execute("ALTER TABLE messages_fts_contentless RENAME TO messages_fts")
+
+    # 无内容表删除索引条目时必须提供写入时的原文，而回复在 messages 中可能是压缩存储的，
+    # 触发器无法解压：删除消息时先记下原值，由后台清理（reaper.py）解压后从索引中删除。
+    # 删除前的这段时间里旧条目关联不到 messages，不会出现在搜索结果中；
+    # 消息ID为 AUTOINCREMENT，不会被新消息重新使用
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages_fts_deleted (
+            id INTEGER PRIMARY KEY,
+            user_message TEXT,
+            ai_response
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_delete
+        AFTER DELETE ON messages
+        BEGIN
+            INSERT OR REPLACE INTO messages_fts_deleted (id, user_message, ai_response)
+            VALUES (OLD.id, OLD.user_message, OLD.ai_response);
+        END
+    ''')
+
+
+# 会改变管理后台查询结果的表，以及需要触发的操作
+GENERATION_TRIGGERS = [
+    ('messages', 'INSERT'), ('messages', 'DELETE'),
+    ('conversations', 'INSERT'), ('conversations', 'UPDATE'), ('conversations', 'DELETE'),
+    ('characters', 'INSERT'), ('characters', 'UPDATE'), ('characters', 'DELETE'),
+]
+
+
+@migration(17, "写入代数（多进程共享的查询缓存失效）")
+def create_data_generation(cursor):
+    # 查询结果缓存记录读取时的代数，代数变化即失效；由触发器维护，
+    # 任何进程（gunicorn worker、延迟写入进程、清理进程、命令行脚本）的写入都会让所有进程的缓存失效
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS data_generation (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            generation INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO data_generation (id, generation) VALUES (1, 0)")
+    for table, event in GENERATION_TRIGGERS:
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_generation_{event.lower()}
+            AFTER {event} ON {table}
+            BEGIN
+                UPDATE data_generation SET generation = generation + 1 WHERE id = 1;
+            END
+        ''')
+
+
+@migration(18, "用户/对话/消息总数汇总行")
+def create_stats_totals(cursor):
+    # 管理后台的总数直接读这一行，不再对 conversations、messages 做 COUNT(*) 全索引扫描；
+    # 与原先的 COUNT(*) 一致，统计当前库中的记录：删除、清理时同步减少（归档不减少，见 v21）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            users INTEGER NOT NULL DEFAULT 0,
+            conversations INTEGER NOT NULL DEFAULT 0,
+            messages INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO stats_totals (id, users, conversations, messages)
+        VALUES (1, (SELECT COUNT(*) FROM user_stats), (SELECT COUNT(*) FROM conversations),
+                (SELECT COUNT(*) FROM messages))
+    ''')
+    for table, column, event, delta in [
+        ('user_stats', 'users', 'INSERT', '+ 1'),
+        ('conversations', 'conversations', 'INSERT', '+ 1'),
+        ('conversations', 'conversations', 'DELETE', '- 1'),
+        ('messages', 'messages', 'INSERT', '+ 1'),
+        ('messages', 'messages', 'DELETE', '- 1'),
+    ]:
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_totals_{event.lower()}
+            AFTER {event} ON {table}
+            BEGIN
+                UPDATE stats_totals SET {column} = {column} {delta} WHERE id = 1;
+            END
+        ''')
+
+
+@migration(19, "删除消息/对话时同步减少用户、角色计数")
+def create_counter_delete_triggers(cursor):
+    # 清理、删除角色删除消息和对话时计数同步减少（归档不减少，见 v21），与总数（stats_totals）一致，
+    # 都是当前库中的记录数；按天/按小时的统计仍只累加。last_active 删除后不回退。
+    # 旧版本的计数只增不减，先按现有数据重新计算
+    cursor.execute("DELETE FROM user_stats")
+    cursor.execute("DELETE FROM character_stats")
+    cursor.execute("DELETE FROM character_users")
+    _backfill_counters(cursor)
+    cursor.execute("UPDATE stats_totals SET users = (SELECT COUNT(*) FROM user_stats) WHERE id = 1")
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_counters_delete
+        AFTER DELETE ON messages
+        BEGIN
+            UPDATE user_stats SET message_count = message_count - 1 WHERE user_id = OLD.user_id;
+
+            -- 该用户与该角色的最后一条消息被删除时，角色的用户数减一
+            UPDATE character_stats SET
+                message_count = message_count - 1,
+                user_count = user_count - (
+                    EXISTS (SELECT 1 FROM character_users
+                            WHERE character_id = OLD.character_id AND user_id = OLD.user_id)
+                    AND NOT EXISTS (SELECT 1 FROM messages
+                                    WHERE character_id = OLD.character_id AND user_id = OLD.user_id)
+                )
+            WHERE character_id = OLD.character_id;
+
+            DELETE FROM character_users
+            WHERE character_id = OLD.character_id AND user_id = OLD.user_id
+              AND NOT EXISTS (SELECT 1 FROM messages
+                              WHERE character_id = OLD.character_id AND user_id = OLD.user_id);
+
+            DELETE FROM user_stats
+            WHERE user_id = OLD.user_id AND message_count <= 0 AND conversation_count <= 0;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_conversations_counters_delete
+        AFTER DELETE ON conversations
+        BEGIN
+            UPDATE user_stats SET conversation_count = conversation_count - 1 WHERE user_id = OLD.user_id;
+            UPDATE character_stats SET conversation_count = conversation_count - 1
+            WHERE character_id = OLD.character_id;
+
+            DELETE FROM user_stats
+            WHERE user_id = OLD.user_id AND message_count <= 0 AND conversation_count <= 0;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_characters_counters_delete
+        AFTER DELETE ON characters
+        BEGIN
+            DELETE FROM character_stats WHERE character_id = OLD.id;
+            DELETE FROM character_users WHERE character_id = OLD.id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_user_stats_totals_delete
+        AFTER DELETE ON user_stats
+        BEGIN
+            UPDATE stats_totals SET users = users - 1 WHERE id = 1;
+        END
+    ''')
+
+
+@migration(20, "对话变更序号（分析导出的增量位置）")
+def create_conversation_change_sequence(cursor):
+    # updated_at 由应用在写入前（延迟写入时为入队时）确定，提交顺序与它不一致，不能作为增量导出的位置。
+    # change_seq 在写事务内由触发器从计数行取号：写事务串行执行，序号随提交顺序递增，
+    # 导出读到序号 N 时，小于 N 的变更都已提交
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_changes (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            seq INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    if 'change_seq' not in _columns(cursor, 'conversations'):
+        cursor.execute("ALTER TABLE conversations ADD COLUMN change_seq INTEGER")
+    # 已有对话按 (updated_at, id) 顺序编号
+    cursor.execute('''
+        UPDATE conversations SET change_seq = ranked.seq
+        FROM (SELECT id, ROW_NUMBER() OVER (ORDER BY updated_at, id) AS seq FROM conversations) AS ranked
+        WHERE ranked.id = conversations.id
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO conversation_changes (id, seq)
+        VALUES (1, (SELECT COALESCE(MAX(change_seq), 0) FROM conversations))
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_change_seq ON conversations (change_seq)
+    ''')
+
+    for event, condition in [('INSERT', ''), ('UPDATE', 'WHEN NEW.change_seq IS OLD.change_seq')]:
+        # 更新 change_seq 本身不再触发（WHEN 条件），不会递归
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_conversations_change_seq_{event.lower()}
+            AFTER {event} ON conversations
+            {condition}
+            BEGIN
+                UPDATE conversation_changes SET seq = seq + 1 WHERE id = 1;
+                UPDATE conversations SET change_seq = (SELECT seq FROM conversation_changes WHERE id = 1)
+                WHERE id = NEW.id;
+            END
+        ''')
+
+
+# 该用户与该角色是否还有消息（主库中的消息，或已归档对话在归档库中的消息）；
+# +character_id 让查找走用户的对话索引，热门角色的对话很多，不能按角色扫描
+_HAS_CHARACTER_MESSAGES = '''(
+    EXISTS (SELECT 1 FROM messages WHERE character_id = {prefix}.character_id AND user_id = {prefix}.user_id)
+    OR EXISTS (SELECT 1 FROM conversations
+               WHERE user_id = {prefix}.user_id AND +character_id = {prefix}.character_id
+                 AND archived_messages > 0)
+)'''
+
+
+@migration(21, "归档消息不计为删除")
+def create_archive_aware_counters(cursor):
+    # 归档把消息移到月度归档库，消息仍然存在：对话的消息数、列表页不变，计数和总数也不应减少。
+    # archive.py 在删除主库消息的事务内写入 archive_moves（其他连接看不到这一行），
+    # 消息删除触发器看到它就不减少计数；全文索引仍然删除（已归档的消息不能搜索）。
+    # 归档的消息数记在 conversations.archived_messages，删除对话时一并从计数中减去
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archive_moves (
+            id INTEGER PRIMARY KEY CHECK (id = 1)
+        )
+    ''')
+    if 'archived_messages' not in _columns(cursor, 'conversations'):
+        cursor.execute("ALTER TABLE conversations ADD COLUMN archived_messages INTEGER NOT NULL DEFAULT 0")
+
+    # 已归档的对话：归档时 message_count 恢复为归档前的值，差值即归档库中的消息数；
+    # v19 按主库数据重新计算的计数把这些消息加回来
+    cursor.execute('''
+        UPDATE conversations
+        SET archived_messages = MAX(0, message_count - (
+            SELECT COUNT(*) FROM messages WHERE conversation_id = conversations.id))
+        WHERE archive_month IS NOT NULL
+    ''')
+    cursor.execute('''
+        UPDATE user_stats SET message_count = message_count + (
+            SELECT COALESCE(SUM(archived_messages), 0) FROM conversations WHERE user_id = user_stats.user_id)
+    ''')
+    cursor.execute('''
+        UPDATE character_stats SET message_count = message_count + (
+            SELECT COALESCE(SUM(archived_messages), 0) FROM conversations
+            WHERE character_id = character_stats.character_id)
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO character_users (character_id, user_id)
+        SELECT DISTINCT character_id, user_id FROM conversations
+        WHERE archived_messages > 0 AND character_id IS NOT NULL AND user_id IS NOT NULL
+    ''')
+    cursor.execute('''
+        UPDATE character_stats SET user_count = (
+            SELECT COUNT(*) FROM character_users WHERE character_id = character_stats.character_id)
+    ''')
+    cursor.execute('''
+        UPDATE stats_totals SET messages = messages + (SELECT COALESCE(SUM(archived_messages), 0) FROM conversations)
+        WHERE id = 1
+    ''')
+
+    for name in ('trg_messages_counters_delete', 'trg_messages_totals_delete',
+                 'trg_conversations_counters_delete', 'trg_conversations_totals_delete'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+    has_messages = _HAS_CHARACTER_MESSAGES.format(prefix='OLD')
+
+    cursor.execute(f'''
+        CREATE TRIGGER trg_messages_counters_delete
+        AFTER DELETE ON messages
+        WHEN NOT EXISTS (SELECT 1 FROM archive_moves)
+        BEGIN
+            UPDATE user_stats SET message_count = message_count - 1 WHERE user_id = OLD.user_id;
+
+            -- 该用户与该角色的最后一条消息被删除时，角色的用户数减一
+            UPDATE character_stats SET
+                message_count = message_count - 1,
+                user_count = user_count - (
+                    EXISTS (SELECT 1 FROM character_users
+                            WHERE character_id = OLD.character_id AND user_id = OLD.user_id)
+                    AND NOT {has_messages}
+                )
+            WHERE character_id = OLD.character_id;
+
+            DELETE FROM character_users
+            WHERE character_id = OLD.character_id AND user_id = OLD.user_id AND NOT {has_messages};
+
+            DELETE FROM user_stats
+            WHERE user_id = OLD.user_id AND message_count <= 0 AND conversation_count <= 0;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_messages_totals_delete
+        AFTER DELETE ON messages
+        WHEN NOT EXISTS (SELECT 1 FROM archive_moves)
+        BEGIN
+            UPDATE stats_totals SET messages = messages - 1 WHERE id = 1;
+        END
+    ''')
+    # 删除对话时，归档库中它的消息也随之删除（清理、删除角色），从计数中减去
+    cursor.execute(f'''
+        CREATE TRIGGER trg_conversations_counters_delete
+        AFTER DELETE ON conversations
+        BEGIN
+            UPDATE user_stats SET
+                conversation_count = conversation_count - 1,
+                message_count = message_count - OLD.archived_messages
+            WHERE user_id = OLD.user_id;
+
+            UPDATE character_stats SET
+                conversation_count = conversation_count - 1,
+                message_count = message_count - OLD.archived_messages,
+                user_count = user_count - (
+                    OLD.archived_messages > 0
+                    AND EXISTS (SELECT 1 FROM character_users
+                                WHERE character_id = OLD.character_id AND user_id = OLD.user_id)
+                    AND NOT {has_messages}
+                )
+            WHERE character_id = OLD.character_id;
+
+            DELETE FROM character_users
+            WHERE OLD.archived_messages > 0
+              AND character_id = OLD.character_id AND user_id = OLD.user_id AND NOT {has_messages};
+
+            DELETE FROM user_stats
+            WHERE user_id = OLD.user_id AND message_count <= 0 AND conversation_count <= 0;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_conversations_totals_delete
+        AFTER DELETE ON conversations
+        BEGIN
+            UPDATE stats_totals SET
+                conversations = conversations - 1,
+                messages = messages - OLD.archived_messages
+            WHERE id = 1;
+        END
+    ''')
+
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn):
+    """读取数据库当前的结构版本"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, db_path):
+    """执行尚未完成的迁移，返回执行的迁移数量"""
+    # 快速路径：版本已是最新，不做任何DDL检查
+    if get_schema_version(conn) >= LATEST_VERSION:
+        return 0
+
+    # 文件锁保证同一时刻只有一个进程执行迁移，其余进程等待后直接跳过
+    with open(f"{db_path}.migrate.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            return _apply_pending(conn)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _apply_pending(conn):
+    """在锁内重新检查版本并逐个执行迁移，每个迁移一个事务"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP
+        )
+    ''')
+
+    # 重建表时删除旧表不能触发级联删除；外键开关在事务内设置无效，只能在事务外切换
+    foreign_keys = conn.execute("PRAGMA foreign_keys").fetchone()[0]
+    conn.execute("PRAGMA foreign_keys = OFF")
+    applied = 0
+    try:
+        for version, description, func in MIGRATIONS:
+            if get_schema_version(conn) >= version:
+                continue
+
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                func(conn.cursor())
+                conn.execute('''
+                    INSERT OR REPLACE INTO schema_version (version, description, applied_at)
+                    VALUES (?, ?, ?)
+                ''', (version, description, datetime.now()))
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+            print(f"数据库迁移 v{version}: {description}")
+            applied += 1
+    finally:
+        conn.execute(f"PRAGMA foreign_keys = {foreign_keys}")
+    return applied
@@ -4,394 +4,668 @@
 import sqlite3
 import json
 import os
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
-class Database:
-    def __init__(self, db_path="guyuejinyu.db"):
+from db_pool import ConnectionPool
+from migrations import migrate, seed_default_characters
+from pagination import DEFAULT_PAGE_SIZE, build_page, clamp_limit, keyset_clause
+from result_cache import ResultCache
+from compression import Compressor, UnknownDictionary
+from records import CharacterSummary, ChatTurn
+from storage import Storage
+import archive
+import search
+
+# 流式导出时每批读取的对话数、每次从游标取出的消息数
+EXPORT_CONVERSATION_BATCH = 100
+EXPORT_MESSAGE_BATCH = 200
+
+class Database(Storage):
+    def __init__(self, db_path="guyuejinyu.db", pool=None, pragmas=None, write_queue=None, compressor=None,
+                 archive_dir="archive"):
         self.db_path = db_path
-        self.init_database()
-        self.init_default_characters()
+        self.pool = pool or ConnectionPool(db_path, pragmas)
+        # 管理后台查询使用独立的只读连接：WAL 模式下大范围统计与聊天写入互不阻塞
+        self.read_pool = ConnectionPool(db_path, self.pool.pragmas, readonly=True)
+        # 可选的延迟写入队列：设置后 save_message 只入队，由独立的写入进程批量提交
+        self.write_queue = write_queue
+        # 初始化推迟到第一次访问数据库，创建实例（导入app）时不做任何I/O
+        self._initialized = False
+        self._init_lock = threading.Lock()
+        # 管理后台查询结果缓存，任何进程写入数据库后失效（触发器递增 data_generation）
+        self.cache = ResultCache(source=self.get_data_generation)
+        # AI回复压缩：未启用时仍能读取已压缩的记录
+        self.compressor = compressor or Compressor()
+        # 月度归档库所在目录，查看已归档的对话时按需只读附加
+        self.archive_dir = archive_dir
     
     def get_connection(self):
-        """获取数据库连接"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
+        """获取数据库连接（当前线程复用的池化连接，调用方不要关闭）"""
+        return self.pool.acquire()
     
-    def init_database(self):
-        """初始化数据库表"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # 用户配置表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_configs (
-                user_id TEXT PRIMARY KEY,
-                api_key TEXT,
-                text_model TEXT DEFAULT 'qwen-plus',
-                image_model TEXT DEFAULT 'wan2.2-t2i-flash',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # 角色表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS characters (
-                id TEXT PRIMARY KEY,
-                name TEXT NOT NULL,
-                description TEXT,
-                style TEXT,
-                avatar_url TEXT,
-                generated_avatar_url TEXT,
-                system_prompt TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # 检查并添加缺失的字段
+    @contextmanager
+    def connection(self):
+        """在池化连接上执行一组操作，异常时回滚未提交的事务"""
+        if not self._initialized:
+            self.init_database()
+        conn = self.pool.acquire()
         try:
-            cursor.execute("SELECT generated_avatar_url FROM characters LIMIT 1")
+            yield conn
         except Exception:
-            # 如果字段不存在，添加它
-            cursor.execute("ALTER TABLE characters ADD COLUMN generated_avatar_url TEXT")
-            print("已添加 generated_avatar_url 字段到 characters 表")
-        
-        # 检查并添加user_id字段（用于角色隔离）
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self.pool.release(conn)
+    
+    @contextmanager
+    def read_connection(self):
+        """在只读池化连接上执行查询（mode=ro + query_only），不会获取写锁，也不与写入共用连接"""
+        # 只读连接不能建库和迁移，先用读写连接完成初始化
+        if not self._initialized:
+            self.init_database()
+        conn = self.read_pool.acquire()
         try:
-            cursor.execute("SELECT user_id FROM characters LIMIT 1")
-        except Exception:
-            # 如果字段不存在，添加它
-            cursor.execute("ALTER TABLE characters ADD COLUMN user_id TEXT")
-            print("已添加 user_id 字段到 characters 表，实现角色用户隔离")
-        
-        # 对话表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS conversations (
-                id TEXT PRIMARY KEY,
-                user_id TEXT,
-                character_id TEXT,
-                title TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (character_id) REFERENCES characters (id)
-            )
-        ''')
-        
-        # 消息表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                conversation_id TEXT,
-                user_id TEXT,
-                character_id TEXT,
-                user_message TEXT,
-                ai_response TEXT,
-                is_image_request BOOLEAN DEFAULT 0,
-                image_url TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (conversation_id) REFERENCES conversations (id),
-                FOREIGN KEY (character_id) REFERENCES characters (id)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+            yield conn
+        finally:
+            # 结束读事务，不让管理查询的快照阻止WAL检查点
+            if conn.in_transaction:
+                conn.rollback()
+            self.read_pool.release(conn)
+    
+    def init_database(self):
+        """初始化数据库（幂等）：设置日志模式，执行尚未完成的结构迁移
+
+        gunicorn preload_app 时由master在fork前调用一次，worker继承已初始化状态；
+        否则在每个进程第一次访问数据库时自动调用。
+        """
+        with self._init_lock:
+            if self._initialized:
+                return
+            
+            conn = self.pool.acquire()
+            # 新建的数据库使用增量 auto_vacuum（只能在设置 WAL、建表之前设置），清理数据后
+            # 由 retention.py 分步执行 incremental_vacuum 缩小文件；已有数据库需用 retention.py convert 转换一次
+            if conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone() is None:
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            # 日志模式作用于整个数据库文件，只需在初始化时设置
+            journal_mode = self.pool.pragmas.get('journal_mode')
+            if journal_mode:
+                conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+            
+            migrate(conn, self.db_path)
+            self.compressor.load_dictionaries(conn)
+            self._initialized = True
+    
+    def get_data_generation(self):
+        """数据库的写入代数：messages、conversations、characters 每次变更都由触发器加一"""
+        with self.read_connection() as conn:
+            return conn.execute('SELECT generation FROM data_generation WHERE id = 1').fetchone()[0]
     
     def init_default_characters(self):
-        """初始化默认角色"""
-        characters = [
-            {
-                'id': 'kongzi',
-                'name': '孔子',
-                'description': '春秋时期著名思想家、教育家，儒家学派创始人',
-                'style': '温文尔雅，循循善诱，喜用比喻，语言庄重而富有哲理',
-                'avatar_url': '',
-                'system_prompt': '孔子（公元前551年－公元前479年），字仲尼，春秋时期鲁国人，中国古代思想家、教育家，儒家学派创始人。以仁、义、礼、智、信为核心思想，主张"有教无类"，注重道德修养和社会秩序。'
-            },
-            {
-                'id': 'libai',
-                'name': '李白',
-                'description': '唐代伟大的浪漫主义诗人，被誉为"诗仙"',
-                'style': '豪放不羁，想象奇特，语言飘逸，常用夸张和比喻，富有浪漫色彩',
-                'avatar_url': '',
-                'system_prompt': '李白（701年－762年），字太白，号青莲居士，唐代伟大的浪漫主义诗人，被誉为"诗仙"。性格豪放，喜好饮酒作诗，追求自由，蔑视权贵，其诗风雄奇豪放，想象丰富。'
-            },
-            {
-                'id': 'zhugeliang',
-                'name': '诸葛亮',
-                'description': '三国时期蜀汉丞相，杰出的政治家、军事家、发明家',
-                'style': '智慧深邃，言辞谨慎，善于分析，语言简练而富有逻辑性',
-                'avatar_url': '',
-                'system_prompt': '诸葛亮（181年－234年），字孔明，号卧龙，三国时期蜀汉丞相，杰出的政治家、军事家、发明家。以智谋著称，忠诚于蜀汉，鞠躬尽瘁，死而后已。'
-            },
-            {
-                'id': 'wuzetian',
-                'name': '武则天',
-                'description': '中国历史上唯一的正统女皇帝，政治家',
-                'style': '威严果断，智慧过人，语言简练有力，体现女性领导者的魅力',
-                'avatar_url': '',
-                'system_prompt': '武则天（624年－705年），中国历史上唯一的正统女皇帝，杰出的政治家。善于用人，推行科举制度，促进文化发展，统治期间社会相对稳定。'
-            },
-            {
-                'id': 'wangyangming',
-                'name': '王阳明',
-                'description': '明代著名哲学家、教育家、军事家，心学集大成者',
-                'style': '深邃睿智，注重内心修养，语言精练，富有哲理性和启发性',
-                'avatar_url': '',
-                'system_prompt': '王阳明（1472年－1529年），名守仁，字伯安，明代著名哲学家、教育家、军事家，心学集大成者。主张"心即理"、"知行合一"、"致良知"，强调内心的道德修养。'
-            }
-        ]
-        
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        for char in characters:
-            # 检查角色是否已存在
-            cursor.execute('SELECT id FROM characters WHERE id = ?', (char['id'],))
-            if not cursor.fetchone():
-                cursor.execute('''
-                    INSERT INTO characters (id, name, description, style, avatar_url, system_prompt)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (char['id'], char['name'], char['description'], char['style'], 
-                     char['avatar_url'], char['system_prompt']))
-        
-        conn.commit()
-        conn.close()
+        """初始化默认角色（已存在的角色保持不变）"""
+        with self.connection() as conn:
+            seed_default_characters(conn.cursor())
+            conn.commit()
+    
+    def checkpoint(self, mode='PASSIVE'):
+        """执行WAL检查点，返回 (是否被阻塞, WAL页数, 已写回页数)
+
+        PASSIVE 不等待读写，可随时调用；TRUNCATE 会等待并清空WAL文件，
+        适合在进程退出等空闲时刻调用。
+        """
+        with self.connection() as conn:
+            return tuple(conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone())
     
     def get_characters(self, user_id=None):
-        """获取角色列表（包含默认角色和用户自定义角色）"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        if user_id:
-            # 获取默认角色（user_id为空）和当前用户的自定义角色
-            cursor.execute('''
-                SELECT * FROM characters 
-                WHERE user_id IS NULL OR user_id = ? 
-                ORDER BY created_at
-            ''', (user_id,))
-        else:
-            # 如果没有提供user_id，只返回默认角色
-            cursor.execute('''
-                SELECT * FROM characters 
-                WHERE user_id IS NULL 
-                ORDER BY created_at
-            ''')
-        
-        characters = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+        """获取角色列表（包含默认角色和用户自定义角色），返回 CharacterSummary"""
+        columns = ', '.join(CharacterSummary._fields)
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            
+            if user_id:
+                # 获取默认角色（user_id为空）和当前用户的自定义角色
+                cursor.execute(f'''
+                    SELECT {columns} FROM characters 
+                    WHERE (user_id IS NULL OR user_id = ?) AND deleted_at IS NULL
+                    ORDER BY created_at
+                ''', (user_id,))
+            else:
+                # 如果没有提供user_id，只返回默认角色
+                cursor.execute(f'''
+                    SELECT {columns} FROM characters 
+                    WHERE user_id IS NULL 
+                    ORDER BY created_at
+                ''')
+            
+            characters = list(map(CharacterSummary._make, cursor))
         return characters
     
-    def get_character(self, character_id):
-        """获取特定角色"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM characters WHERE id = ?', (character_id,))
-        character = cursor.fetchone()
-        conn.close()
+    def get_character(self, character_id, user_id=None):
+        """获取特定角色（user_id 供分片存储定位用户所在的分片）"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            # 已标记删除、等待后台清理的角色视为不存在
+            cursor.execute('SELECT * FROM characters WHERE id = ? AND deleted_at IS NULL', (character_id,))
+            character = cursor.fetchone()
         return dict(character) if character else None
     
     def save_user_config(self, user_id, config):
         """保存用户配置"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO user_configs 
-            (user_id, api_key, text_model, image_model, updated_at)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, config.get('api_key'), config.get('text_model', 'qwen-plus'),
-              config.get('image_model', 'wan2.2-t2i-flash'), datetime.now()))
-        
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT OR REPLACE INTO user_configs 
+                (user_id, api_key, text_model, image_model, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (user_id, config.get('api_key'), config.get('text_model', 'qwen-plus'),
+                  config.get('image_model', 'wan2.2-t2i-flash'), datetime.now()))
+            
+            conn.commit()
     
     def get_user_config(self, user_id):
         """获取用户配置"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM user_configs WHERE user_id = ?', (user_id,))
-        config = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM user_configs WHERE user_id = ?', (user_id,))
+            config = cursor.fetchone()
         return dict(config) if config else None
     
-    def save_message(self, conversation_id, user_id, character_id, user_message, ai_response, image_url=None):
-        """保存对话消息"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def save_message(self, conversation_id, user_id, character_id, user_message, ai_response, image_url=None, character_name=None):
+        """保存对话消息（单个事务：对话记录upsert + 写入消息）
+        
+        character_name 由调用方传入（请求中已查询过角色），用于生成新对话的标题；
+        未传入时在同一条SQL里按 character_id 查询。
+        启用延迟写入队列时只写入队列即返回，不等待主数据库提交。
+        """
+        turn = {
+            'conversation_id': conversation_id,
+            'user_id': user_id,
+            'character_id': character_id,
+            'user_message': user_message,
+            'ai_response': ai_response,
+            'image_url': image_url,
+            'character_name': character_name,
+            'updated_at': datetime.now(),
+        }
         
-        # 先确保对话记录存在
-        cursor.execute('SELECT id FROM conversations WHERE id = ?', (conversation_id,))
-        if not cursor.fetchone():
-            # 创建新对话
-            character = self.get_character(character_id)
-            title = f"与{character['name']}的对话" if character else "新对话"
+        if self.write_queue is not None:
+            self.write_queue.enqueue(turn)
+            return
+        
+        with self.connection() as conn:
+            self._write_turn(conn.cursor(), turn)
+            conn.commit()
+        self.cache.invalidate()
+    
+    def write_turns(self, turns, last_queue_id):
+        """在一个事务中批量写入队列中的对话（组提交），同时记录已写入的队列位置"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            for turn in turns:
+                self._write_turn(cursor, turn)
             cursor.execute('''
-                INSERT INTO conversations (id, user_id, character_id, title)
-                VALUES (?, ?, ?, ?)
-            ''', (conversation_id, user_id, character_id, title))
+                UPDATE write_queue_state SET last_applied_id = ? WHERE id = 1
+            ''', (last_queue_id,))
+            conn.commit()
+        self.cache.invalidate()
+    
+    def get_last_applied_turn(self):
+        """获取已写入主数据库的最后一个队列ID"""
+        with self.connection() as conn:
+            row = conn.execute('SELECT last_applied_id FROM write_queue_state WHERE id = 1').fetchone()
+        return row[0] if row else 0
+    
+    def _write_turn(self, cursor, turn):
+        """写入一轮对话：对话记录upsert + 插入消息"""
+        character_name = turn.get('character_name')
+        title = f"与{character_name}的对话" if character_name else None
         
-        # 保存消息
+        # 对话不存在则创建，已存在则更新最后更新时间
         cursor.execute('''
-            INSERT INTO messages 
-            (conversation_id, user_id, character_id, user_message, ai_response, image_url)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (conversation_id, user_id, character_id, user_message, ai_response, image_url))
+            INSERT INTO conversations (id, user_id, character_id, title, updated_at)
+            VALUES (?, ?, ?, COALESCE(?, (SELECT '与' || name || '的对话' FROM characters WHERE id = ?), '新对话'), ?)
+            ON CONFLICT(id) DO UPDATE SET updated_at = excluded.updated_at
+        ''', (turn['conversation_id'], turn['user_id'], turn['character_id'], title,
+              turn['character_id'], turn['updated_at']))
         
-        # 更新对话的最后更新时间
+        # 保存消息（来自队列的消息保留入队时间）
         cursor.execute('''
-            UPDATE conversations SET updated_at = ? WHERE id = ?
-        ''', (datetime.now(), conversation_id))
+            INSERT INTO messages 
+            (conversation_id, user_id, character_id, user_message, ai_response, image_url, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+        ''', (turn['conversation_id'], turn['user_id'], turn['character_id'], turn['user_message'],
+              self.compressor.compress(turn['ai_response']), turn.get('image_url'), turn.get('created_at')))
         
-        conn.commit()
-        conn.close()
+        # 写入全文索引（无内容表，只保存分词，按未压缩的原文建立）
+        cursor.execute('''
+            INSERT INTO messages_fts (rowid, user_message, ai_response) VALUES (?, ?, ?)
+        ''', (cursor.lastrowid, turn['user_message'], turn['ai_response']))
     
-    def get_chat_history(self, conversation_id, limit=50):
-        """获取对话历史"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def get_chat_history(self, conversation_id, limit=50, user_id=None):
+        """获取对话历史（启用延迟写入时合并队列中尚未落库的消息）
         
-        cursor.execute('''
-            SELECT * FROM messages 
-            WHERE conversation_id = ? 
-            ORDER BY created_at DESC 
-            LIMIT ?
-        ''', (conversation_id, limit))
+        user_id 供分片存储定位用户所在的分片，单库时不使用。
+        """
+        if self.write_queue is not None:
+            return self._get_chat_history_with_pending(conversation_id, limit)
         
-        messages = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT * FROM messages 
+                WHERE conversation_id = ? 
+                ORDER BY created_at DESC 
+                LIMIT ?
+            ''', (conversation_id, limit))
+            
+            rows = self._with_archived_history(conn, conversation_id, cursor.fetchall(), limit)
+            messages = self._decode_messages(conn, rows)
         return list(reversed(messages))  # 按时间正序返回
     
-    def get_conversations(self, user_id):
-        """获取用户的对话列表"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def get_recent_turns(self, conversation_id, limit=6, user_id=None):
+        """构建提示词用的最近几轮对话，只读取问答两列，按时间正序返回 ChatTurn
+        
+        user_id 供分片存储定位用户所在的分片，单库时不使用。
+        """
+        if self.write_queue is not None:
+            return [ChatTurn(m['user_message'], m['ai_response'])
+                    for m in self._get_chat_history_with_pending(conversation_id, limit)]
+        
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.execute('''
+                SELECT user_message, ai_response FROM messages 
+                WHERE conversation_id = ? 
+                ORDER BY created_at DESC 
+                LIMIT ?
+            ''', (conversation_id, limit))
+            
+            rows = self._with_archived_history(conn, conversation_id, cursor.fetchall(), limit,
+                                               columns='user_message, ai_response')
+            turns = [ChatTurn(user_message, self._decompress(conn, ai_response))
+                     for user_message, ai_response in reversed(rows)]
+        return turns
+    
+    def _with_archived_history(self, conn, conversation_id, rows, limit, columns='*'):
+        """主库中的消息不足 limit 条且对话已归档时，从归档库补齐更早的消息（均为倒序）"""
+        if len(rows) >= limit:
+            return rows
+        conv = conn.execute('SELECT archive_month FROM conversations WHERE id = ?', (conversation_id,)).fetchone()
+        if conv is None or conv['archive_month'] is None:
+            return rows
+        return list(rows) + archive.read_archived_messages(
+            conn, self.archive_dir, conv['archive_month'], conversation_id, limit - len(rows), columns)
+    
+    def _decode_messages(self, conn, rows):
+        """把消息行转换为字典并解压AI回复"""
+        messages = [dict(row) for row in rows]
+        for message in messages:
+            message['ai_response'] = self._decompress(conn, message['ai_response'])
+        return messages
+    
+    def _decompress(self, conn, value):
+        """解压存储的正文，遇到其他进程新训练的字典时重新加载"""
+        try:
+            return self.compressor.decompress(value)
+        except UnknownDictionary:
+            self.compressor.load_dictionaries(conn)
+            return self.compressor.decompress(value)
+    
+    def _get_chat_history_with_pending(self, conversation_id, limit):
+        """读己之写：主数据库中的历史 + 队列中尚未写入的消息
+        
+        先读队列再读主数据库：写入进程先提交主数据库、后删除队列，
+        因此队列快照中的消息要么仍未写入，要么ID不大于主数据库记录的已写入位置，
+        按该位置过滤后既不会遗漏也不会重复。
+        """
+        pending = self.write_queue.pending(conversation_id)
+        
+        with self.connection() as conn:
+            # 历史记录与已写入位置需要来自同一个读快照
+            conn.execute('BEGIN')
+            try:
+                rows = conn.execute('''
+                    SELECT * FROM messages 
+                    WHERE conversation_id = ? 
+                    ORDER BY created_at DESC 
+                    LIMIT ?
+                ''', (conversation_id, limit)).fetchall()
+                last_applied = conn.execute(
+                    'SELECT last_applied_id FROM write_queue_state WHERE id = 1').fetchone()[0]
+            finally:
+                conn.commit()
+            rows = self._with_archived_history(conn, conversation_id, rows, limit)
+            messages = list(reversed(self._decode_messages(conn, rows)))
+        
+        for turn in pending:
+            if turn['id'] > last_applied:
+                messages.append({
+                    'id': None,
+                    'conversation_id': turn['conversation_id'],
+                    'user_id': turn['user_id'],
+                    'character_id': turn['character_id'],
+                    'user_message': turn['user_message'],
+                    'ai_response': turn['ai_response'],
+                    'is_image_request': 0,
+                    'image_url': turn['image_url'],
+                    'created_at': turn['created_at'],
+                })
+        return messages[-limit:]
+    
+    def get_conversations(self, user_id, page_cursor=None, limit=DEFAULT_PAGE_SIZE, character_id=None):
+        """获取用户的对话列表（按最后更新时间倒序，游标分页）"""
+        limit = clamp_limit(limit)
+        keyset, keyset_params, order, direction = keyset_clause(page_cursor, 'conv')
+        character_filter = ' AND conv.character_id = ?' if character_id else ''
+        params = [user_id] + ([character_id] if character_id else []) + keyset_params + [limit + 1]
+        
+        with self.connection() as conn:
+            rows = conn.execute(f'''
+                SELECT conv.*, ch.name as character_name
+                FROM conversations conv
+                LEFT JOIN characters ch ON conv.character_id = ch.id
+                WHERE conv.user_id = ?{character_filter}{keyset}
+                ORDER BY conv.updated_at {order}, conv.id {order}
+                LIMIT ?
+            ''', params).fetchall()
+        
+        return build_page([dict(row) for row in rows], limit, direction, page_cursor is not None)
+    
+    def export_conversations(self, user_id):
+        """逐条生成用户的全部对话和消息，供流式导出（内存占用与历史总量无关）
+        
+        每个对话先生成一条 type=conversation 记录，随后按时间正序生成该对话的 type=message 记录
+        （已归档的消息在前）。使用独立连接，不占用请求线程的池化连接，
+        生成器结束或被关闭（客户端断开）时关闭连接。
+        """
+        if not self._initialized:
+            self.init_database()
+        conn = self.pool.connect()
+        try:
+            last_key = ('', '')
+            while True:
+                # 每批读完后再逐个对话读取消息，附加归档库时连接上没有未完成的语句
+                conversations = conn.execute('''
+                    SELECT conv.id, conv.title, conv.character_id, ch.name as character_name,
+                           conv.created_at, conv.updated_at, conv.message_count, conv.archive_month
+                    FROM conversations conv
+                    LEFT JOIN characters ch ON conv.character_id = ch.id
+                    WHERE conv.user_id = ? AND (conv.created_at, conv.id) > (?, ?)
+                    ORDER BY conv.created_at, conv.id
+                    LIMIT ?
+                ''', (user_id, last_key[0], last_key[1], EXPORT_CONVERSATION_BATCH)).fetchall()
+                if not conversations:
+                    return
+                
+                for conv in conversations:
+                    record = dict(conv)
+                    archive_month = record.pop('archive_month')
+                    yield dict(record, type='conversation')
+                    if archive_month is not None:
+                        schema = archive.attach_archive(conn, self.archive_dir, archive_month)
+                        yield from self._export_messages(conn, f"{schema}.messages", conv['id'], user_id)
+                    yield from self._export_messages(conn, 'main.messages', conv['id'], user_id)
+                last_key = (conversations[-1]['created_at'], conversations[-1]['id'])
+        finally:
+            conn.close()
+    
+    def _export_messages(self, conn, table, conversation_id, user_id):
+        """按时间正序分批取出一个对话的消息并解压"""
+        cursor = conn.execute(f'''
+            SELECT id, conversation_id, user_message, ai_response, image_url, created_at
+            FROM {table}
+            WHERE conversation_id = ? AND user_id = ?
+            ORDER BY created_at, id
+        ''', (conversation_id, user_id))
+        for rows in iter(lambda: cursor.fetchmany(EXPORT_MESSAGE_BATCH), []):
+            for message in self._decode_messages(conn, rows):
+                message['type'] = 'message'
+                yield message
+    
+    def search_messages(self, user_id, query, limit=20):
+        """在用户自己的聊天记录中搜索，返回按相关度排序的命中摘要
         
-        cursor.execute('''
-            SELECT c.*, ch.name as character_name
-            FROM conversations c
-            LEFT JOIN characters ch ON c.character_id = ch.id
-            WHERE c.user_id = ?
-            ORDER BY c.updated_at DESC
-        ''', (user_id,))
+        全文索引不保存原文，摘要由 messages 中的原文（解压后）生成。
+        """
+        terms = search.parse_query(query)
+        limit = clamp_limit(limit)
         
-        conversations = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return conversations
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            if search.uses_index(terms):
+                # 索引包含所有用户的消息：先按用户索引取出该用户的消息ID，逐个按 rowid 在索引中匹配，
+                # 只对该用户命中的消息计算相关度（CROSS JOIN 固定连接顺序）
+                cursor.execute('''
+                    SELECT 
+                        m.id as message_id,
+                        m.conversation_id,
+                        m.character_id,
+                        c.name as character_name,
+                        m.created_at,
+                        m.user_message,
+                        m.ai_response
+                    FROM messages m
+                    CROSS JOIN messages_fts f ON f.rowid = m.id
+                    LEFT JOIN characters c ON m.character_id = c.id
+                    WHERE m.user_id = ? AND messages_fts MATCH ?
+                    ORDER BY f.rank
+                    LIMIT ?
+                ''', (user_id, search.match_expression(terms), limit))
+                results = self._decode_messages(conn, cursor.fetchall())
+            else:
+                # 不足3个字符的词无法走 trigram 索引，在该用户的消息中按时间倒序逐条解压后匹配
+                cursor.execute('''
+                    SELECT 
+                        m.id as message_id,
+                        m.conversation_id,
+                        m.character_id,
+                        c.name as character_name,
+                        m.created_at,
+                        m.user_message,
+                        m.ai_response
+                    FROM messages m
+                    LEFT JOIN characters c ON m.character_id = c.id
+                    WHERE m.user_id = ?
+                    ORDER BY m.created_at DESC
+                ''', (user_id,))
+                results = []
+                for rows in iter(lambda: cursor.fetchmany(EXPORT_MESSAGE_BATCH), []):
+                    results += [message for message in self._decode_messages(conn, rows)
+                                if search.matches(message, terms)]
+                    if len(results) >= limit:
+                        break
+                results = results[:limit]
+        for result in results:
+            result['user_message'] = search.make_snippet(result['user_message'], terms)
+            result['ai_response'] = search.make_snippet(result['ai_response'], terms)
+        return results
+    
+    def purge_search_index(self, batch_size=500):
+        """从全文索引中删除已删除消息的条目，返回删除的条数
+        
+        无内容的 FTS5 表删除条目时要提供写入时的原文：删除触发器记下的回复可能是压缩存储的，
+        在这里解压后按批删除，每批一个短事务。
+        """
+        total = 0
+        with self.connection() as conn:
+            while True:
+                conn.execute('BEGIN IMMEDIATE')
+                rows = conn.execute('''
+                    SELECT id, user_message, ai_response FROM messages_fts_deleted ORDER BY id LIMIT ?
+                ''', (batch_size,)).fetchall()
+                conn.executemany('''
+                    INSERT INTO messages_fts (messages_fts, rowid, user_message, ai_response)
+                    VALUES ('delete', ?, ?, ?)
+                ''', [(row['id'], row['user_message'], self._decompress(conn, row['ai_response'])) for row in rows])
+                conn.executemany('DELETE FROM messages_fts_deleted WHERE id = ?', [(row['id'],) for row in rows])
+                conn.commit()
+                total += len(rows)
+                if len(rows) < batch_size:
+                    return total
     
     def update_character_avatar(self, character_id, avatar_url):
         """更新角色的生成头像"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE characters 
-            SET generated_avatar_url = ? 
-            WHERE id = ?
-        ''', (avatar_url, character_id))
-        
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE characters 
+                SET generated_avatar_url = ? 
+                WHERE id = ?
+            ''', (avatar_url, character_id))
+            
+            conn.commit()
     
     def add_custom_character(self, character_data, user_id):
         """添加自定义角色"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         try:
-            cursor.execute('''
-                INSERT INTO characters (id, name, description, style, avatar_url, system_prompt, user_id)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                character_data['id'],
-                character_data['name'], 
-                character_data['description'],
-                character_data['style'],
-                character_data.get('avatar_url', ''),
-                character_data['system_prompt'],
-                user_id
-            ))
-            
-            conn.commit()
-            conn.close()
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO characters (id, name, description, style, avatar_url, system_prompt, user_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    character_data['id'],
+                    character_data['name'], 
+                    character_data['description'],
+                    character_data['style'],
+                    character_data.get('avatar_url', ''),
+                    character_data['system_prompt'],
+                    user_id
+                ))
+                
+                conn.commit()
+            self.cache.invalidate()
             return True
             
         except Exception as e:
             print(f"添加角色失败: {e}")
-            conn.close()
             return False
     
-    def delete_custom_character(self, character_id):
-        """删除自定义角色"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+    def delete_custom_character(self, character_id, user_id=None):
+        """删除自定义角色（user_id 供分片存储定位用户所在的分片）
+
+        只设置删除标记，角色立即从列表中消失；对话和消息由 reap_deleted_characters 在后台分批删除。
+        """
         try:
-            # 删除角色相关的所有对话记录
-            cursor.execute('DELETE FROM messages WHERE conversation_id IN (SELECT id FROM conversations WHERE character_id = ?)', (character_id,))
-            cursor.execute('DELETE FROM conversations WHERE character_id = ?', (character_id,))
-            
-            # 删除角色
-            cursor.execute('DELETE FROM characters WHERE id = ?', (character_id,))
-            
-            conn.commit()
-            conn.close()
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE characters SET deleted_at = CURRENT_TIMESTAMP
+                    WHERE id = ? AND user_id IS NOT NULL AND deleted_at IS NULL
+                ''', (character_id,))
+                conn.commit()
+            self.cache.invalidate()
             return True
-            
+
         except Exception as e:
             print(f"删除角色失败: {e}")
-            conn.close()
             return False
-    
-    # ====== 管理员相关方法 ======
+
+    def reap_deleted_characters(self, grace_seconds=60, batch_size=500, pause=0.05):
+        """删除标记删除超过 grace_seconds 秒的角色及其对话和消息，返回 (角色数, 对话数, 消息数)
+
+        每个短事务最多删除 batch_size 条消息或对话，事务之间停顿 pause 秒，不会长时间占用写锁。
+        保留期用于等待写入队列中该角色的消息落库；角色记录最后删除，
+        期间新写入的对话和消息由外键 ON DELETE CASCADE 一并删除。
+        """
+        reaped = total_conversations = total_messages = 0
+        with self.connection() as conn:
+            characters = conn.execute('''
+                SELECT id FROM characters
+                WHERE deleted_at IS NOT NULL AND deleted_at <= datetime('now', ?)
+                ORDER BY deleted_at
+            ''', (f"-{grace_seconds} seconds",)).fetchall()
+
+            for (character_id,) in characters:
+                # 先分批删除消息：对话的级联删除一次会删除它的全部消息
+                while True:
+                    conn.execute('BEGIN IMMEDIATE')
+                    removed = conn.execute('''
+                        DELETE FROM messages WHERE id IN (
+                            SELECT m.id FROM conversations c JOIN messages m ON m.conversation_id = c.id
+                            WHERE c.character_id = ? LIMIT ?
+                        )
+                    ''', (character_id, batch_size)).rowcount
+                    conn.commit()
+                    total_messages += removed
+                    if removed < batch_size:
+                        break
+                    time.sleep(pause)
+
+                while True:
+                    conn.execute('BEGIN IMMEDIATE')
+                    batch = conn.execute('''
+                        SELECT id, archive_month FROM conversations WHERE character_id = ? LIMIT ?
+                    ''', (character_id, batch_size)).fetchall()
+                    ids = [conv['id'] for conv in batch]
+                    conn.execute(f"DELETE FROM conversations WHERE id IN ({','.join('?' * len(ids))})", ids)
+                    conn.commit()
+                    total_conversations += len(ids)
+                    # 对话记录删除后再清理归档库中的消息
+                    by_month = {}
+                    for conv in batch:
+                        if conv['archive_month']:
+                            by_month.setdefault(conv['archive_month'], []).append(conv['id'])
+                    for month, archived_ids in sorted(by_month.items()):
+                        total_messages += archive.purge_archived_conversations(
+                            conn, self.archive_dir, month, archived_ids)
+                    if len(ids) < batch_size:
+                        break
+                    time.sleep(pause)
+
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute('DELETE FROM characters WHERE id = ? AND deleted_at IS NOT NULL', (character_id,))
+                conn.commit()
+                reaped += 1
+        if reaped:
+            self.cache.invalidate()
+        return reaped, total_conversations, total_messages
+
+    # ====== 管理员相关方法（只读连接） ======
     
     def get_admin_stats(self):
         """获取管理员统计数据"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # 总用户数
-        cursor.execute('SELECT COUNT(DISTINCT user_id) FROM conversations')
-        total_users = cursor.fetchone()[0]
-        
-        # 总对话数
-        cursor.execute('SELECT COUNT(*) FROM conversations')
-        total_conversations = cursor.fetchone()[0]
-        
-        # 总消息数
-        cursor.execute('SELECT COUNT(*) FROM messages')
-        total_messages = cursor.fetchone()[0]
-        
-        # 今日新增对话
-        cursor.execute('''
-            SELECT COUNT(*) FROM conversations 
-            WHERE DATE(created_at) = DATE('now')
-        ''')
-        today_conversations = cursor.fetchone()[0]
-        
-        # 最受欢迎的角色
-        cursor.execute('''
-            SELECT c.name, COUNT(conv.id) as conversation_count
-            FROM characters c
-            LEFT JOIN conversations conv ON c.id = conv.character_id
-            GROUP BY c.id, c.name
-            ORDER BY conversation_count DESC
-            LIMIT 5
-        ''')
-        popular_characters = cursor.fetchall()
-        
-        # 用户活跃度（最近7天）
-        cursor.execute('''
-            SELECT DATE(created_at) as date, COUNT(DISTINCT user_id) as active_users
-            FROM conversations
-            WHERE created_at >= datetime('now', '-7 days')
-            GROUP BY DATE(created_at)
-            ORDER BY date
-        ''')
-        user_activity = cursor.fetchall()
-        
-        conn.close()
+        with self.read_connection() as conn:
+            cursor = conn.cursor()
+            
+            # 总用户数、总对话数、总消息数（触发器维护的汇总行）
+            cursor.execute('SELECT users, conversations, messages FROM stats_totals WHERE id = 1')
+            total_users, total_conversations, total_messages = cursor.fetchone()
+            
+            # 今日新增对话（按天汇总表）
+            cursor.execute("SELECT new_conversations FROM stats_daily WHERE day = DATE('now')")
+            row = cursor.fetchone()
+            today_conversations = row[0] if row else 0
+            
+            # 最受欢迎的角色
+            cursor.execute('''
+                SELECT c.name, COALESCE(s.conversation_count, 0) as conversation_count
+                FROM characters c
+                LEFT JOIN character_stats s ON s.character_id = c.id
+                WHERE c.deleted_at IS NULL
+                ORDER BY conversation_count DESC
+                LIMIT 5
+            ''')
+            popular_characters = cursor.fetchall()
+            
+            # 用户活跃度（最近7天，按天汇总表）
+            cursor.execute('''
+                SELECT day as date, active_users
+                FROM stats_daily
+                WHERE day >= DATE('now', '-7 days')
+                ORDER BY day
+            ''')
+            user_activity = cursor.fetchall()
         
         return {
             'total_users': total_users,
@@ -402,78 +676,72 @@ class Database:
             'user_activity': [dict(row) for row in user_activity]
         }
     
-    def get_all_conversations(self, page=1, limit=20):
-        """获取所有对话记录（分页）"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        offset = (page - 1) * limit
-        
-        cursor.execute('''
-            SELECT 
-                conv.id,
-                conv.user_id,
-                conv.title,
-                c.name as character_name,
-                conv.created_at,
-                COUNT(m.id) as message_count
-            FROM conversations conv
-            LEFT JOIN characters c ON conv.character_id = c.id
-            LEFT JOIN messages m ON conv.id = m.conversation_id
-            GROUP BY conv.id
-            ORDER BY conv.created_at DESC
-            LIMIT ? OFFSET ?
-        ''', (limit, offset))
-        
-        conversations = cursor.fetchall()
-        
-        # 获取总数
-        cursor.execute('SELECT COUNT(*) FROM conversations')
-        total = cursor.fetchone()[0]
+    def get_all_conversations(self, page_cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """获取所有对话记录（按最后更新时间倒序，游标分页）"""
+        limit = clamp_limit(limit)
+        keyset, keyset_params, order, direction = keyset_clause(page_cursor, 'conv')
         
-        conn.close()
+        with self.read_connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(f'''
+                SELECT 
+                    conv.id,
+                    conv.user_id,
+                    conv.title,
+                    c.name as character_name,
+                    conv.created_at,
+                    conv.updated_at,
+                    conv.message_count,
+                    conv.last_message_at,
+                    conv.last_message_preview
+                FROM conversations conv
+                LEFT JOIN characters c ON conv.character_id = c.id
+                WHERE 1 = 1{keyset}
+                ORDER BY conv.updated_at {order}, conv.id {order}
+                LIMIT ?
+            ''', keyset_params + [limit + 1])
+            
+            conversations = [dict(row) for row in cursor.fetchall()]
+            
+            # 获取总数（触发器维护的汇总行）
+            cursor.execute('SELECT conversations FROM stats_totals WHERE id = 1')
+            total = cursor.fetchone()[0]
         
-        return {
-            'conversations': [dict(row) for row in conversations],
-            'total': total,
-            'page': page,
-            'limit': limit,
-            'total_pages': (total + limit - 1) // limit
-        }
+        page = build_page(conversations, limit, direction, page_cursor is not None)
+        page['total'] = total
+        return page
     
     def get_user_statistics(self):
         """获取用户统计数据"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # 用户活跃度分析
-        cursor.execute('''
-            SELECT 
-                user_id,
-                COUNT(DISTINCT conversation_id) as conversation_count,
-                COUNT(*) as message_count,
-                MAX(created_at) as last_active
-            FROM messages
-            GROUP BY user_id
-            ORDER BY message_count DESC
-            LIMIT 20
-        ''')
-        active_users = cursor.fetchall()
-        
-        # 用户偏好角色分析
-        cursor.execute('''
-            SELECT 
-                c.name as character_name,
-                COUNT(DISTINCT m.user_id) as user_count,
-                COUNT(m.id) as message_count
-            FROM messages m
-            LEFT JOIN characters c ON m.character_id = c.id
-            GROUP BY m.character_id, c.name
-            ORDER BY user_count DESC
-        ''')
-        character_preferences = cursor.fetchall()
-        
-        conn.close()
+        with self.read_connection() as conn:
+            cursor = conn.cursor()
+            
+            # 用户活跃度分析（用户计数表）
+            cursor.execute('''
+                SELECT 
+                    user_id,
+                    conversation_count,
+                    message_count,
+                    last_active
+                FROM user_stats
+                ORDER BY message_count DESC
+                LIMIT 20
+            ''')
+            active_users = cursor.fetchall()
+            
+            # 用户偏好角色分析（角色计数表）
+            cursor.execute('''
+                SELECT 
+                    c.name as character_name,
+                    s.user_count,
+                    s.message_count
+                FROM character_stats s
+                LEFT JOIN characters c ON s.character_id = c.id
+                WHERE s.message_count > 0
+                ORDER BY s.user_count DESC
+            ''')
+            character_preferences = cursor.fetchall()
         
         return {
             'active_users': [dict(row) for row in active_users],
@@ -482,46 +750,44 @@ class Database:
     
     def get_performance_stats(self):
         """获取AI性能统计"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # 按小时统计消息量
-        cursor.execute('''
-            SELECT 
-                strftime('%H', created_at) as hour,
-                COUNT(*) as message_count,
-                AVG(CASE WHEN ai_response != '' THEN 1 ELSE 0 END) as success_rate
-            FROM messages
-            WHERE created_at >= datetime('now', '-24 hours')
-            GROUP BY strftime('%H', created_at)
-            ORDER BY hour
-        ''')
-        hourly_stats = cursor.fetchall()
-        
-        # 响应成功率
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as total_messages,
-                SUM(CASE WHEN ai_response != '' AND ai_response IS NOT NULL THEN 1 ELSE 0 END) as successful_responses
-            FROM messages
-            WHERE created_at >= datetime('now', '-7 days')
-        ''')
-        response_stats = cursor.fetchone()
-        success_rate = 0
-        if response_stats[0] > 0:
-            success_rate = (response_stats[1] / response_stats[0]) * 100
-        
-        # 图片生成统计
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as total_image_requests,
-                SUM(CASE WHEN image_url IS NOT NULL AND image_url != '' THEN 1 ELSE 0 END) as successful_images
-            FROM messages
-            WHERE is_image_request = 1 AND created_at >= datetime('now', '-7 days')
-        ''')
-        image_stats = cursor.fetchone()
-        
-        conn.close()
+        with self.read_connection() as conn:
+            cursor = conn.cursor()
+            
+            # 按小时统计消息量（最近24个小时桶）
+            cursor.execute('''
+                SELECT 
+                    substr(bucket, 12, 2) as hour,
+                    message_count,
+                    CAST(successful_responses AS REAL) / message_count as success_rate
+                FROM stats_hourly
+                WHERE bucket > strftime('%Y-%m-%d %H:00:00', 'now', '-24 hours')
+                    AND message_count > 0
+                ORDER BY hour
+            ''')
+            hourly_stats = cursor.fetchall()
+            
+            # 响应成功率（最近7天）
+            cursor.execute('''
+                SELECT 
+                    COALESCE(SUM(message_count), 0) as total_messages,
+                    COALESCE(SUM(successful_responses), 0) as successful_responses
+                FROM stats_hourly
+                WHERE bucket >= strftime('%Y-%m-%d %H:00:00', 'now', '-7 days')
+            ''')
+            response_stats = cursor.fetchone()
+            success_rate = 0
+            if response_stats[0] > 0:
+                success_rate = (response_stats[1] / response_stats[0]) * 100
+            
+            # 图片生成统计
+            cursor.execute('''
+                SELECT 
+                    COALESCE(SUM(image_requests), 0) as total_image_requests,
+                    COALESCE(SUM(successful_images), 0) as successful_images
+                FROM stats_hourly
+                WHERE bucket >= strftime('%Y-%m-%d %H:00:00', 'now', '-7 days')
+            ''')
+            image_stats = cursor.fetchone()
         
         return {
             'hourly_stats': [dict(row) for row in hourly_stats],
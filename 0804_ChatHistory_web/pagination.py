@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+键集（游标）分页
+列表按 (updated_at, id) 倒序排列，游标记录翻页起点的键值，
+每一页都是一次索引范围查询，翻到多深耗时都不变。
+游标对前端是不透明的字符串。
+"""
+
+import base64
+import json
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(row, direction):
+    """把翻页起点的键值编码为不透明游标，direction 为 'next' 或 'prev'"""
+    payload = json.dumps([row['updated_at'], row['id'], direction], ensure_ascii=False)
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """解析游标，返回 (updated_at, id, direction)，无效时抛出 ValueError"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        updated_at, row_id, direction = json.loads(base64.urlsafe_b64decode(padded).decode('utf-8'))
+    except Exception:
+        raise ValueError("无效的分页游标")
+    if direction not in ('next', 'prev'):
+        raise ValueError("无效的分页游标")
+    return updated_at, row_id, direction
+
+
+def clamp_limit(limit):
+    """限制每页数量在 1 ~ MAX_PAGE_SIZE 之间"""
+    if not limit:
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(int(limit), MAX_PAGE_SIZE))
+
+
+def keyset_clause(token, alias):
+    """根据游标生成 (WHERE片段, 参数, 排序方向, 翻页方向)
+
+    向后翻页取比游标小的键并倒序读取；向前翻页取比游标大的键并正序读取，
+    取到后再反转，保证页内始终是倒序。
+    """
+    if not token:
+        return '', [], 'DESC', 'next'
+    updated_at, row_id, direction = decode_cursor(token)
+    op, order = ('<', 'DESC') if direction == 'next' else ('>', 'ASC')
+    clause = f" AND ({alias}.updated_at, {alias}.id) {op} (?, ?)"
+    return clause, [updated_at, row_id], order, direction
+
+
+def build_page(rows, limit, direction, has_cursor):
+    """由多取一行的查询结果生成分页响应"""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == 'prev':
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = has_cursor, has_more
+
+    return {
+        'conversations': rows,
+        'limit': limit,
+        'next_cursor': encode_cursor(rows[-1], 'next') if rows and has_next else None,
+        'prev_cursor': encode_cursor(rows[0], 'prev') if rows and has_prev else None,
+    }
@@ -6,42 +6,43 @@
 用于清理共享的默认用户数据，确保用户隐私
 """
 
+import argparse
 import sqlite3
 import os
-from datetime import datetime
+
+from backup import backup_dir_for, take_snapshot
+from chunked_migration import ChunkStep, count_rows, run_migration
+from config import Config
 
 def backup_database(db_path="guyuejinyu.db"):
-    """备份原数据库"""
-    backup_path = f"guyuejinyu_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-    
+    """备份原数据库（备份接口在线创建全量快照，可用 backup.py restore 恢复）"""
     if os.path.exists(db_path):
-        import shutil
-        shutil.copy2(db_path, backup_path)
+        backup_dir = backup_dir_for(db_path, Config.BACKUP_DIR)
+        snapshot = take_snapshot(db_path, backup_dir, full=True,
+                                 step_pages=Config.BACKUP_STEP_PAGES, pause=Config.BACKUP_STEP_PAUSE)
+        backup_path = os.path.join(backup_dir, snapshot['file'])
         print(f"✅ 数据库已备份到: {backup_path}")
         return backup_path
     else:
         print("❌ 数据库文件不存在")
         return None
 
-def clean_default_user_data(db_path="guyuejinyu.db"):
-    """清理default用户的数据"""
+# 清理 default 用户的数据：先删消息，再删对话和用户配置
+DEFAULT_USER_CLEANUP = [
+    ChunkStep('messages', "user_id = 'default'"),
+    ChunkStep('conversations', "user_id = 'default'"),
+    ChunkStep('user_configs', "user_id = 'default'"),
+]
+
+def clean_default_user_data(db_path="guyuejinyu.db", dry_run=False, assume_yes=False):
+    """清理default用户的数据（分批删除，中断后重新执行会继续）"""
     if not os.path.exists(db_path):
         print("❌ 数据库文件不存在")
         return False
     
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
         # 统计要删除的数据
-        cursor.execute("SELECT COUNT(*) FROM user_configs WHERE user_id = 'default'")
-        config_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM conversations WHERE user_id = 'default'")
-        conversation_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM messages WHERE user_id = 'default'")
-        message_count = cursor.fetchone()[0]
+        message_count, conversation_count, config_count = count_rows(db_path, DEFAULT_USER_CLEANUP)
         
         print(f"准备清理数据:")
         print(f"  - 用户配置: {config_count} 条")
@@ -50,23 +51,22 @@ def clean_default_user_data(db_path="guyuejinyu.db"):
         
         if config_count + conversation_count + message_count == 0:
             print("✅ 没有需要清理的default用户数据")
-            conn.close()
+            return True
+        
+        if dry_run:
+            print("💡 试运行，未修改数据")
             return True
         
         # 询问用户确认
-        confirm = input("\n确认清理以上数据吗？(输入 'YES' 确认): ")
-        if confirm != 'YES':
-            print("❌ 操作已取消")
-            conn.close()
-            return False
-        
-        # 清理数据
-        cursor.execute("DELETE FROM messages WHERE user_id = 'default'")
-        cursor.execute("DELETE FROM conversations WHERE user_id = 'default'")
-        cursor.execute("DELETE FROM user_configs WHERE user_id = 'default'")
-        
-        conn.commit()
-        conn.close()
+        if not assume_yes:
+            confirm = input("\n确认清理以上数据吗？(输入 'YES' 确认): ")
+            if confirm != 'YES':
+                print("❌ 操作已取消")
+                return False
+        
+        # 按 rowid 范围分批删除，每批一个短事务，应用运行期间也可以执行
+        run_migration(db_path, 'privacy_fix_default_user', DEFAULT_USER_CLEANUP,
+                      Config.MIGRATION_CHUNK_ROWS, Config.MIGRATION_PAUSE, Config.MIGRATION_MAX_TRANSACTION)
         
         print("✅ 成功清理default用户数据")
         print("✅ 现在每个用户都有独立的数据空间")
@@ -74,6 +74,7 @@ def clean_default_user_data(db_path="guyuejinyu.db"):
         
     except Exception as e:
         print(f"❌ 清理失败: {e}")
+        print("💡 重新执行会从中断的位置继续")
         return False
 
 def verify_user_isolation(db_path="guyuejinyu.db"):
@@ -123,9 +124,18 @@ def verify_user_isolation(db_path="guyuejinyu.db"):
         print(f"❌ 验证失败: {e}")
 
 def main():
+    parser = argparse.ArgumentParser(description='隐私修复工具')
+    parser.add_argument('--dry-run', action='store_true', help='只统计需要清理的数据，不备份、不修改')
+    parser.add_argument('--yes', action='store_true', help='不再询问确认')
+    args = parser.parse_args()
+    
     print("🔒 古月今语 - 隐私修复工具")
     print("=" * 40)
     
+    if args.dry_run:
+        clean_default_user_data(dry_run=True)
+        return
+    
     # 1. 备份数据库
     print("\n1. 备份数据库...")
     backup_path = backup_database()
@@ -138,7 +148,7 @@ def main():
     
     # 3. 清理共享数据
     print("\n3. 清理共享数据...")
-    if clean_default_user_data():
+    if clean_default_user_data(assume_yes=args.yes):
         print("\n4. 验证修复效果...")
         verify_user_isolation()
         
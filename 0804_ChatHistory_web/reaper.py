@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+已删除角色的后台清理
+删除自定义角色的请求只设置 characters.deleted_at，角色立即从列表中消失；
+清理进程定期调用 reap_deleted_characters，按批用短事务删除这些角色的消息、对话和角色记录，
+大量聊天记录的删除不会在HTTP请求中执行，也不会长时间占用写锁。
+每次清理后再调用 purge_search_index，把已删除的消息从全文索引中移除。
+
+gunicorn 由 master 启动唯一的清理进程；单独运行:
+  python3 reaper.py            持续运行
+  python3 reaper.py --once     清理一次后退出
+"""
+
+import argparse
+import multiprocessing
+import signal
+import threading
+
+
+class CharacterReaper:
+    """清理进程：每隔 interval 秒清理一次已删除的角色"""
+
+    def __init__(self, db, interval=30, grace_seconds=60, batch_size=500, pause=0.05):
+        self.db = db
+        self.interval = interval
+        self.grace_seconds = grace_seconds
+        self.batch_size = batch_size
+        self.pause = pause
+        self._stopping = threading.Event()
+
+    def reap_once(self):
+        """清理一次，返回 (角色数, 对话数, 消息数)"""
+        reaped = self.db.reap_deleted_characters(self.grace_seconds, self.batch_size, self.pause)
+        if reaped[0]:
+            print(f"🧹 已清理 {reaped[0]} 个已删除的角色：{reaped[1]} 个对话、{reaped[2]} 条消息")
+        # 删除角色、过期清理、归档删除的消息，都在这里从全文索引中移除
+        self.db.purge_search_index(self.batch_size)
+        return reaped
+
+    def stop(self, *args):
+        """请求停止：当前这次清理结束后退出"""
+        self._stopping.set()
+
+    def run(self):
+        """主循环，收到 SIGTERM/SIGINT 后退出（未清理完的角色下次启动时继续）"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        print(f"🧹 清理进程已启动，每 {self.interval} 秒检查一次已删除的角色")
+        while not self._stopping.is_set():
+            try:
+                self.reap_once()
+            except Exception as e:
+                # 写锁等待超时等错误不退出，下一轮重试
+                print(f"⚠️ 清理已删除角色失败: {e}")
+            self._stopping.wait(self.interval)
+        print("🧹 清理进程退出")
+
+
+def _reaper_main(db, interval, grace_seconds, batch_size, pause):
+    """清理进程入口"""
+    CharacterReaper(db, interval, grace_seconds, batch_size, pause).run()
+
+
+def start_reaper_process(db, interval=30, grace_seconds=60, batch_size=500, pause=0.05):
+    """以fork方式启动清理进程（如在gunicorn master中），db 为单库或分片存储实例"""
+    process = multiprocessing.get_context('fork').Process(
+        target=_reaper_main, args=(db, interval, grace_seconds, batch_size, pause),
+        name='guyuejinyu-reaper', daemon=False)
+    process.start()
+    return process
+
+
+def stop_reaper_process(process, timeout=30):
+    """通知清理进程退出，并等待其结束"""
+    if process is not None and process.is_alive():
+        process.terminate()
+        process.join(timeout)
+
+
+def main():
+    from config import Config
+    from sharding import open_database
+
+    parser = argparse.ArgumentParser(description='清理已删除角色的对话和消息')
+    parser.add_argument('--once', action='store_true', help='清理一次后退出')
+    parser.add_argument('--grace', type=float, default=Config.REAPER_GRACE_SECONDS,
+                        help='角色删除后至少保留多少秒再清理')
+    args = parser.parse_args()
+
+    reaper = CharacterReaper(open_database(), Config.REAPER_INTERVAL, args.grace,
+                             Config.REAPER_BATCH, Config.REAPER_PAUSE)
+    if args.once:
+        characters, conversations, messages = reaper.reap_once()
+        print(f"✅ 清理 {characters} 个角色，{conversations} 个对话，{messages} 条消息")
+    else:
+        reaper.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+热点路径使用的轻量记录
+每次请求都会执行的查询只读取需要的列，结果直接构造为 namedtuple，不为每行创建 dict；
+只在接口边界（jsonify 之前）转换为 dict。
+"""
+
+from collections import namedtuple
+
+# 构建提示词所需的一轮对话
+ChatTurn = namedtuple('ChatTurn', ['user_message', 'ai_response'])
+
+# 角色列表所需的字段（不含较长的 system_prompt，对话时通过 get_character 读取完整角色）
+CharacterSummary = namedtuple('CharacterSummary', [
+    'id', 'name', 'description', 'style', 'avatar_url', 'generated_avatar_url', 'user_id', 'created_at',
+])
+
+
+def as_dicts(records):
+    """接口边界：把记录转换为可序列化为 JSON 的 dict"""
+    return [record._asdict() for record in records]
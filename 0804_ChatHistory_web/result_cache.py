@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+查询结果缓存
+用于管理后台等读多写少的接口：每个条目有各自的过期时间，
+同时记录写入时的代数，数据库发生写入时代数加一，旧条目随即失效；
+代数保存在数据库的 data_generation 表中，由触发器递增，多个进程共享。
+同一个键同时只有一个线程重新查询，其余线程等待并复用结果。
+"""
+
+import threading
+import time
+
+# 条目数超过上限时清理已过期的条目（游标分页会产生许多不同的键）
+MAX_ENTRIES = 256
+
+
+class ResultCache:
+    """带过期时间和写入代数的进程内缓存
+
+    source 返回数据库中由触发器维护的写入代数（所有进程共享），其他 worker、写入进程、
+    清理进程的写入同样会使本进程的条目失效；不提供时只能由 invalidate() 使条目失效。
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, source=None):
+        self.max_entries = max_entries
+        self.source = source
+        self.hits = 0
+        self.misses = 0
+        self._local_generation = 0
+        self._entries = {}  # 键 -> (代数, 过期时刻, 结果)
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self):
+        """当前的写入代数：(本进程代数, 数据库中的代数)"""
+        shared = self.source() if self.source is not None else None
+        return self._local_generation, shared
+
+    def invalidate(self):
+        """本进程写入后调用，不等读取数据库中的代数即使现有条目失效"""
+        with self._lock:
+            self._local_generation += 1
+
+    def get(self, key, ttl, loader):
+        """返回键对应的结果，不存在、过期或已失效时调用 loader 重新查询"""
+        # 每次查找只读取一次代数（source() 是一次数据库查询）；先于查询记下代数，
+        # 查询期间发生的写入会让本次结果在下次读取时失效
+        generation = self.generation
+        value = self._lookup(key, generation)
+        if value is not None:
+            return value
+
+        with self._key_lock(key):
+            # 等锁期间其他线程可能已经查询完毕
+            value = self._lookup(key, generation)
+            if value is not None:
+                return value
+
+            value = loader()
+            with self._lock:
+                self.misses += 1
+                if len(self._entries) >= self.max_entries:
+                    self._prune(generation)
+                self._entries[key] = (generation, time.monotonic() + ttl, value)
+            return value
+
+    def clear(self):
+        """清空所有条目"""
+        with self._lock:
+            self._entries.clear()
+
+    def _lookup(self, key, generation):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry_generation, expires_at, value = entry
+            if entry_generation != generation or time.monotonic() >= expires_at:
+                return None
+            self.hits += 1
+            return value
+
+    def _key_lock(self, key):
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None:
+                lock = self._key_locks[key] = threading.Lock()
+            return lock
+
+    def _prune(self, generation):
+        """删除过期或已失效的条目（调用方持有 self._lock）"""
+        now = time.monotonic()
+        for key, (entry_generation, expires_at, _) in list(self._entries.items()):
+            if entry_generation != generation or now >= expires_at:
+                del self._entries[key]
+                self._key_locks.pop(key, None)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+数据保留策略
+匿名访问的用户每个会话都会得到新的 user_id，被放弃的对话会一直留在数据库中。
+本任务删除超过 idle_days 天没有更新、且其用户超过 inactive_user_days 天没有发送过消息的对话：
+
+- 按 (updated_at, id) 分批查找，每批对话的消息再按 message_batch 条分多个短事务删除，批次之间停顿
+- 已归档对话在月度归档库中的消息一并删除
+- 删除后用 PRAGMA incremental_vacuum 分步释放空闲页，不需要阻塞整个库的 VACUUM
+- 删除的消息和对话由触发器从用户/角色计数和管理后台总数中减去，计数全部清零的用户不再出现在统计中；
+  按天/按小时的统计不变
+
+新建的数据库默认使用 auto_vacuum=INCREMENTAL；已有数据库需要在低峰期执行一次 convert（完整 VACUUM）。
+
+用法:
+  python3 retention.py purge [--idle-days 365] [--inactive-user-days 90] [--dry-run]
+  python3 retention.py vacuum                   只释放空闲页
+  python3 retention.py convert                  把已有数据库转换为增量 auto_vacuum（会阻塞写入）
+"""
+
+import argparse
+import os
+import time
+from datetime import datetime, timedelta
+
+from archive import purge_archived_conversations
+
+# PRAGMA auto_vacuum 的取值
+AUTO_VACUUM_INCREMENTAL = 2
+
+# 过期对话：长时间没有更新，且用户最近没有发送过消息（没有统计记录的用户视为不活跃）
+EXPIRED_CONDITION = '''
+    c.updated_at < :idle_cutoff
+    AND COALESCE((SELECT last_active FROM user_stats WHERE user_id = c.user_id), '') < :active_cutoff
+'''
+
+
+def retention_cutoffs(idle_days, inactive_user_days):
+    """对话更新时间为本地时间，用户最后活跃时间为消息的 UTC 创建时间"""
+    return {
+        'idle_cutoff': (datetime.now() - timedelta(days=idle_days)).strftime('%Y-%m-%d %H:%M:%S'),
+        'active_cutoff': (datetime.utcnow() - timedelta(days=inactive_user_days)).strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def find_expired_conversations(conn, cutoffs, after, limit):
+    """(updated_at, id) 在 after 之后的一批过期对话"""
+    return conn.execute(f'''
+        SELECT c.id, c.updated_at, c.archive_month, c.message_count
+        FROM conversations c
+        WHERE (c.updated_at, c.id) > (:after_updated, :after_id) AND {EXPIRED_CONDITION}
+        ORDER BY c.updated_at, c.id
+        LIMIT :limit
+    ''', dict(cutoffs, after_updated=after[0], after_id=after[1], limit=limit)).fetchall()
+
+
+def _purge_batch(conn, cutoffs, ids, message_batch, pause):
+    """分多个短事务删除一批对话，返回 (删除的对话ID, 删除的消息数)
+
+    每个事务都重新检查对话仍然过期：清理期间用户回到对话时，剩余的消息和对话保留。
+    """
+    params = dict(cutoffs, **{f"id{i}": conversation_id for i, conversation_id in enumerate(ids)})
+    still_expired = f'''
+        SELECT c.id FROM conversations c
+        WHERE c.id IN ({', '.join(f":id{i}" for i in range(len(ids)))}) AND {EXPIRED_CONDITION}
+    '''
+    messages = 0
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            removed = conn.execute(f'''
+                DELETE FROM messages WHERE id IN (
+                    SELECT id FROM messages WHERE conversation_id IN ({still_expired}) LIMIT :message_batch
+                )
+            ''', dict(params, message_batch=message_batch)).rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        messages += removed
+        if removed < message_batch:
+            break
+        time.sleep(pause)
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        expired = [row[0] for row in conn.execute(still_expired, params).fetchall()]
+        conn.execute(f"DELETE FROM conversations WHERE id IN ({','.join('?' * len(expired))})", expired)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return expired, messages
+
+
+def purge_expired(db, idle_days, inactive_user_days, batch_size=200, message_batch=500, pause=0.05,
+                  dry_run=False):
+    """按保留策略删除过期对话，返回 (对话数, 消息数)；dry_run 时只统计"""
+    cutoffs = retention_cutoffs(idle_days, inactive_user_days)
+    after = ('', '')
+    total_conversations = total_messages = 0
+
+    while True:
+        with db.connection() as conn:
+            batch = find_expired_conversations(conn, cutoffs, after, batch_size)
+            if not batch:
+                break
+            after = (batch[-1]['updated_at'], batch[-1]['id'])
+            if dry_run:
+                total_conversations += len(batch)
+                total_messages += sum(conv['message_count'] or 0 for conv in batch)
+                continue
+
+            expired, messages = _purge_batch(conn, cutoffs, [conv['id'] for conv in batch], message_batch, pause)
+            # 对话记录已删除后再清理归档库，归档库中的数据不会再被读到
+            expired = set(expired)
+            by_month = {}
+            for conv in batch:
+                if conv['id'] in expired and conv['archive_month']:
+                    by_month.setdefault(conv['archive_month'], []).append(conv['id'])
+            for month, ids in sorted(by_month.items()):
+                messages += purge_archived_conversations(conn, db.archive_dir, month, ids)
+            total_conversations += len(expired)
+            total_messages += messages
+            print(f"🧹 已删除 {len(expired)} 个对话、{messages} 条消息（已处理到更新时间 {after[0]}）")
+        time.sleep(pause)
+
+    if not dry_run and total_conversations:
+        db.cache.invalidate()
+    return total_conversations, total_messages
+
+
+def incremental_vacuum(db, step_pages=1000, pause=0.05):
+    """分步释放空闲页，每步一个短事务，返回释放的页数；数据库未启用增量 auto_vacuum 时返回 None"""
+    with db.connection() as conn:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            return None
+        free_before = free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        while free_pages:
+            # execute() 每次只释放一页，executescript 会执行到语句结束
+            conn.executescript(f'PRAGMA incremental_vacuum({step_pages})')
+            remaining = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if remaining >= free_pages:
+                break
+            free_pages = remaining
+            time.sleep(pause)
+        released = free_before - free_pages
+    # WAL 模式下文件在检查点之后才会变小
+    db.checkpoint('PASSIVE')
+    return released
+
+
+def convert_to_incremental(db):
+    """把已有数据库转换为增量 auto_vacuum（完整 VACUUM，执行期间阻塞写入）"""
+    with db.connection() as conn:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+            return False
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    return True
+
+
+def _file_size(db_path):
+    return sum(os.path.getsize(path) for path in (db_path, db_path + '-wal') if os.path.exists(path))
+
+
+def main():
+    from config import Config
+    from sharding import open_database
+
+    parser = argparse.ArgumentParser(description='按保留策略清理长期不活跃的对话')
+    parser.add_argument('command', choices=['purge', 'vacuum', 'convert'])
+    parser.add_argument('--idle-days', type=int, default=Config.RETENTION_IDLE_DAYS, help='对话超过多少天没有更新')
+    parser.add_argument('--inactive-user-days', type=int, default=Config.RETENTION_INACTIVE_USER_DAYS,
+                        help='用户超过多少天没有发送消息')
+    parser.add_argument('--batch', type=int, default=Config.RETENTION_BATCH, help='每批处理的对话数')
+    parser.add_argument('--dry-run', action='store_true', help='只统计，不修改数据')
+    args = parser.parse_args()
+
+    if args.command == 'purge' and args.idle_days <= 0:
+        parser.error('未配置保留期限：设置 RETENTION_IDLE_DAYS 或使用 --idle-days')
+
+    db = open_database()
+    # 分片模式下逐个分片处理（共享库不保存对话）
+    for database in getattr(db, 'shards', [db]):
+        size_before = _file_size(database.db_path)
+        if args.command == 'convert':
+            converted = convert_to_incremental(database)
+            print(f"{'✅ 已转换' if converted else '✅ 已是增量模式'}：{database.db_path}")
+            continue
+        if args.command == 'purge':
+            conversations, messages = purge_expired(
+                database, args.idle_days, args.inactive_user_days, args.batch,
+                Config.RETENTION_MESSAGE_BATCH, Config.RETENTION_PAUSE, args.dry_run)
+            if args.dry_run:
+                print(f"🔍 预演：{database.db_path} 有 {conversations} 个对话、{messages} 条消息待清理")
+                continue
+            print(f"✅ {database.db_path}: 清理 {conversations} 个对话，{messages} 条消息")
+        released = incremental_vacuum(database, Config.RETENTION_VACUUM_STEP_PAGES, Config.RETENTION_PAUSE)
+        if released is None:
+            print("💡 数据库未启用增量 auto_vacuum，空闲页会被新数据复用但文件不会变小；"
+                  "可在低峰期执行 python3 retention.py convert")
+        else:
+            print(f"📦 释放 {released} 个空闲页，文件 {size_before / 1024 / 1024:.1f} MB → "
+                  f"{_file_size(database.db_path) / 1024 / 1024:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+聊天记录全文搜索
+messages_fts 使用 FTS5 的 trigram 分词，中文无需分词器即可检索；
+索引是无内容表，不保存原文副本，命中摘要由 messages 中（解压后）的原文生成。
+trigram 索引只能匹配至少3个字符的词，更短的搜索词改为在当前用户的消息中逐条匹配。
+两种方式都只搜索主库中的消息：已归档到月度归档库的消息不在索引中，搜索不到（见 archive.py）。
+"""
+
+# 命中部分的标记，前端按需替换为高亮样式
+HIGHLIGHT_START = '【'
+HIGHLIGHT_END = '】'
+SNIPPET_ELLIPSIS = '…'
+# 摘要长度（字符）
+SNIPPET_TOKENS = 24
+
+MIN_TRIGRAM_LENGTH = 3
+MAX_QUERY_LENGTH = 100
+
+
+def parse_query(query):
+    """把搜索框输入拆成搜索词，空输入或过长时抛出 ValueError"""
+    query = (query or '').strip()
+    if not query:
+        raise ValueError("搜索词不能为空")
+    if len(query) > MAX_QUERY_LENGTH:
+        raise ValueError(f"搜索词不能超过{MAX_QUERY_LENGTH}个字符")
+    return query.split()
+
+
+def uses_index(terms):
+    """所有搜索词都能走 trigram 索引"""
+    return all(len(term) >= MIN_TRIGRAM_LENGTH for term in terms)
+
+
+def match_expression(terms):
+    """生成 FTS5 MATCH 表达式：每个词作为短语，多个词同时命中"""
+    return ' '.join('"%s"' % term.replace('"', '""') for term in terms)
+
+
+def matches(message, terms):
+    """短词匹配：问题或回复中包含全部搜索词（不区分大小写，与 trigram 索引一致）"""
+    text = f"{message['user_message'] or ''}\n{message['ai_response'] or ''}".casefold()
+    return all(term.casefold() in text for term in terms)
+
+
+def _highlight_spans(text, terms):
+    """各搜索词在 text 中的位置 [(起点, 终点)]，与 matches 一样按 casefold 比较；按位置排序并合并重叠的部分
+
+    casefold 可能改变长度（如 ß -> ss），逐字符折叠并记下每个折叠字符对应的原文位置。
+    """
+    folded, owners = [], []
+    for index, char in enumerate(text):
+        for folded_char in char.casefold():
+            folded.append(folded_char)
+            owners.append(index)
+    folded = ''.join(folded)
+
+    spans = []
+    for term in terms:
+        needle = term.casefold()
+        position = folded.find(needle)
+        while position >= 0:
+            spans.append((owners[position], owners[position + len(needle) - 1] + 1))
+            position = folded.find(needle, position + len(needle))
+
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def make_snippet(text, terms, width=SNIPPET_TOKENS):
+    """截取第一个命中词附近的文本并标记命中位置（不区分大小写）"""
+    text = text or ''
+    spans = _highlight_spans(text, terms)
+    if not spans:
+        snippet = text[:width]
+        return snippet + SNIPPET_ELLIPSIS if len(text) > width else snippet
+
+    start = max(0, spans[0][0] - width // 3)
+    end = min(len(text), start + width)
+    parts, position = [], start
+    for span_start, span_end in spans:
+        span_start, span_end = max(span_start, start), min(span_end, end)
+        if span_start >= span_end:
+            continue
+        parts += [text[position:span_start], HIGHLIGHT_START, text[span_start:span_end], HIGHLIGHT_END]
+        position = span_end
+    parts.append(text[position:end])
+    return ((SNIPPET_ELLIPSIS if start > 0 else '') + ''.join(parts) +
+            (SNIPPET_ELLIPSIS if end < len(text) else ''))
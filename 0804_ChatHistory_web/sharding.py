@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+按用户分片存储
+应用的数据都按 user_id 隔离，分片模式下按 user_id 的哈希把每个用户的数据放入 N 个分片库之一，
+每个分片有独立的写锁，写入并发随分片数增长。
+共享库（DATABASE_PATH）保存默认角色和延迟写入队列的位置；
+每个分片库同样包含完整的表结构（含默认角色），单个用户的请求只访问自己的分片，
+管理后台的统计查询并行访问所有分片后合并。
+
+分片数一经确定不能修改（没有重新分片功能），共享库会记录分片数并在不一致时拒绝启动。
+"""
+
+import hashlib
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from models import Database
+from pagination import DEFAULT_PAGE_SIZE, clamp_limit, decode_cursor, encode_cursor
+from result_cache import ResultCache
+from storage import Storage
+
+SHARD_FILE_PREFIX = 'guyuejinyu_shard_'
+
+# 管理后台并行查询分片的线程数上限
+MAX_FAN_OUT_WORKERS = 8
+
+
+def shard_path(shard_dir, index):
+    """分片库文件路径"""
+    return os.path.join(shard_dir, f"{SHARD_FILE_PREFIX}{index:02d}.db")
+
+
+def shard_index(user_id, shard_count):
+    """用户所在的分片（稳定哈希，与进程无关）"""
+    digest = hashlib.blake2b((user_id or '').encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shard_count
+
+
+class ShardPools:
+    """把共享库和各分片的连接池当作一个整体回收、关闭"""
+
+    def __init__(self, pools):
+        self.pools = pools
+
+    def teardown(self, exception=None):
+        for pool in self.pools:
+            pool.teardown(exception)
+
+    def close_all(self):
+        for pool in self.pools:
+            pool.close_all()
+
+
+class ShardedDatabase(Storage):
+    """与 Database 接口一致的分片存储"""
+
+    def __init__(self, db_path, shard_dir, shard_count, pragmas=None, write_queue=None,
+                 compressor_factory=None, archive_dir="archive"):
+        self.db_path = db_path
+        self.shard_dir = shard_dir
+        self.shard_count = shard_count
+        self.write_queue = write_queue
+        self.archive_dir = archive_dir
+
+        # 压缩字典按库保存，每个库使用独立的压缩器
+        def open_database(path, **kwargs):
+            compressor = compressor_factory() if compressor_factory else None
+            return Database(path, pragmas=pragmas, compressor=compressor, **kwargs)
+
+        self.shared = open_database(db_path, archive_dir=archive_dir)
+        self.shards = [
+            open_database(shard_path(shard_dir, i), write_queue=write_queue,
+                          archive_dir=os.path.join(archive_dir, f"shard_{i:02d}"))
+            for i in range(shard_count)
+        ]
+        self.databases = [self.shared] + self.shards
+
+        # 任何分片的写入（包括其他进程的写入）都使管理后台缓存失效
+        self.cache = ResultCache(source=lambda: tuple(database.get_data_generation()
+                                                      for database in self.databases))
+        for database in self.databases:
+            database.cache = self.cache
+        self.pool = ShardPools([database.pool for database in self.databases])
+        self.read_pool = ShardPools([database.read_pool for database in self.databases])
+
+        self._executor = None
+        self._executor_pid = None
+        self._executor_lock = threading.Lock()
+        # 与 Database 一样推迟到第一次访问时初始化
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    def shard_for(self, user_id):
+        """用户所在的分片库"""
+        self._ensure_initialized()
+        return self.shards[shard_index(user_id, self.shard_count)]
+
+    def _ensure_initialized(self):
+        if not self._initialized:
+            self.init_database()
+
+    def _fan_out(self, func):
+        """在所有分片上并行执行 func(shard)，按分片顺序返回结果"""
+        self._ensure_initialized()
+        with self._executor_lock:
+            # fork 后线程池不可用，在子进程中重新创建
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=min(self.shard_count, MAX_FAN_OUT_WORKERS), thread_name_prefix='shard')
+                self._executor_pid = os.getpid()
+        return list(self._executor.map(func, self.shards))
+
+    def init_database(self):
+        """初始化共享库和全部分片库（幂等），并核对分片数"""
+        with self._init_lock:
+            if self._initialized:
+                return
+            os.makedirs(self.shard_dir, exist_ok=True)
+            for database in self.databases:
+                database.init_database()
+
+            with self.shared.connection() as conn:
+                conn.execute('INSERT OR IGNORE INTO shard_layout (id, shard_count) VALUES (1, ?)',
+                             (self.shard_count,))
+                conn.commit()
+                existing = conn.execute('SELECT shard_count FROM shard_layout WHERE id = 1').fetchone()[0]
+            if existing != self.shard_count:
+                raise RuntimeError(f"分片数与已有数据不一致：已有 {existing} 个分片，配置为 {self.shard_count}")
+            self._initialized = True
+
+    def checkpoint(self, mode='PASSIVE'):
+        """对共享库和全部分片执行WAL检查点"""
+        self._ensure_initialized()
+        return [database.checkpoint(mode) for database in self.databases]
+
+    # ====== 按用户路由 ======
+
+    def get_characters(self, user_id=None):
+        """获取角色列表（分片中包含默认角色和该用户的自定义角色）"""
+        if user_id:
+            return self.shard_for(user_id).get_characters(user_id)
+        return self.shared.get_characters()
+
+    def get_character(self, character_id, user_id=None):
+        """获取特定角色，未提供用户时先查默认角色再查各分片"""
+        if user_id:
+            return self.shard_for(user_id).get_character(character_id)
+        character = self.shared.get_character(character_id)
+        if character is None:
+            character = next(filter(None, self._fan_out(lambda shard: shard.get_character(character_id))), None)
+        return character
+
+    def save_user_config(self, user_id, config):
+        return self.shard_for(user_id).save_user_config(user_id, config)
+
+    def get_user_config(self, user_id):
+        return self.shard_for(user_id).get_user_config(user_id)
+
+    def save_message(self, conversation_id, user_id, character_id, user_message, ai_response,
+                     image_url=None, character_name=None):
+        return self.shard_for(user_id).save_message(
+            conversation_id, user_id, character_id, user_message, ai_response, image_url, character_name)
+
+    def write_turns(self, turns, last_queue_id):
+        """按分片批量写入队列中的对话
+
+        每个分片在自己的事务中记录已写入的队列ID，全部分片提交后再推进共享库中的队列位置；
+        中途崩溃时整批会重新读取，已提交的分片按各自记录的位置跳过，不会重复写入。
+        """
+        self._ensure_initialized()
+        by_shard = defaultdict(list)
+        for turn in turns:
+            by_shard[shard_index(turn['user_id'], self.shard_count)].append(turn)
+        for index, shard_turns in sorted(by_shard.items()):
+            shard = self.shards[index]
+            applied = shard.get_last_applied_turn()
+            shard_turns = [turn for turn in shard_turns if turn['id'] > applied]
+            if shard_turns:
+                shard.write_turns(shard_turns, shard_turns[-1]['id'])
+        self.shared.write_turns([], last_queue_id)
+
+    def get_last_applied_turn(self):
+        return self.shared.get_last_applied_turn()
+
+    def get_chat_history(self, conversation_id, limit=50, user_id=None):
+        """获取对话历史，未提供用户时依次查找各分片"""
+        if user_id:
+            return self.shard_for(user_id).get_chat_history(conversation_id, limit)
+        for history in self._fan_out(lambda shard: shard.get_chat_history(conversation_id, limit)):
+            if history:
+                return history
+        return []
+
+    def get_recent_turns(self, conversation_id, limit=6, user_id=None):
+        """获取最近几轮对话，未提供用户时依次查找各分片"""
+        if user_id:
+            return self.shard_for(user_id).get_recent_turns(conversation_id, limit)
+        for turns in self._fan_out(lambda shard: shard.get_recent_turns(conversation_id, limit)):
+            if turns:
+                return turns
+        return []
+
+    def get_conversations(self, user_id, page_cursor=None, limit=DEFAULT_PAGE_SIZE, character_id=None):
+        return self.shard_for(user_id).get_conversations(user_id, page_cursor, limit, character_id)
+
+    def search_messages(self, user_id, query, limit=20):
+        return self.shard_for(user_id).search_messages(user_id, query, limit)
+
+    def export_conversations(self, user_id):
+        return self.shard_for(user_id).export_conversations(user_id)
+
+    def purge_search_index(self, batch_size=500):
+        """逐个分片清理（消息只在分片中）"""
+        self._ensure_initialized()
+        return sum(shard.purge_search_index(batch_size) for shard in self.shards)
+
+    def update_character_avatar(self, character_id, avatar_url):
+        """默认角色在每个库中都有一份，逐库更新"""
+        self._ensure_initialized()
+        for database in self.databases:
+            database.update_character_avatar(character_id, avatar_url)
+
+    def add_custom_character(self, character_data, user_id):
+        return self.shard_for(user_id).add_custom_character(character_data, user_id)
+
+    def delete_custom_character(self, character_id, user_id=None):
+        if user_id:
+            return self.shard_for(user_id).delete_custom_character(character_id)
+        return all(self._fan_out(lambda shard: shard.delete_custom_character(character_id)))
+
+    def reap_deleted_characters(self, grace_seconds=60, batch_size=500, pause=0.05):
+        """逐个分片清理（自定义角色只在所属用户的分片中），不并行以免同时占用多个分片的写锁"""
+        self._ensure_initialized()
+        results = [shard.reap_deleted_characters(grace_seconds, batch_size, pause) for shard in self.shards]
+        return tuple(map(sum, zip(*results)))
+
+    # ====== 管理员查询：并行访问所有分片后合并 ======
+    # 每个用户只在一个分片中，按用户去重的计数（用户数、活跃用户数）可以直接相加
+
+    def get_admin_stats(self):
+        """获取管理员统计数据"""
+        results = self._fan_out(lambda shard: (shard.get_admin_stats(), _character_conversation_counts(shard)))
+        stats = [result[0] for result in results]
+
+        popular = defaultdict(int)
+        for _, counts in results:
+            for name, count in counts:
+                popular[name] += count
+        activity = defaultdict(int)
+        for shard_stats in stats:
+            for row in shard_stats['user_activity']:
+                activity[row['date']] += row['active_users']
+
+        return {
+            'total_users': sum(s['total_users'] for s in stats),
+            'total_conversations': sum(s['total_conversations'] for s in stats),
+            'total_messages': sum(s['total_messages'] for s in stats),
+            'today_conversations': sum(s['today_conversations'] for s in stats),
+            'popular_characters': [
+                {'name': name, 'conversation_count': count}
+                for name, count in sorted(popular.items(), key=lambda item: item[1], reverse=True)[:5]
+            ],
+            'user_activity': [{'date': date, 'active_users': activity[date]} for date in sorted(activity)],
+        }
+
+    def get_all_conversations(self, page_cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """获取所有对话记录（游标为键值，各分片用同一个游标各取一页后归并）"""
+        limit = clamp_limit(limit)
+        direction = decode_cursor(page_cursor)[2] if page_cursor else 'next'
+        pages = self._fan_out(lambda shard: shard.get_all_conversations(page_cursor, limit))
+
+        rows = sorted((row for page in pages for row in page['conversations']),
+                      key=lambda row: (row['updated_at'], row['id']), reverse=True)
+        if direction == 'next':
+            has_next = len(rows) > limit or any(page['next_cursor'] for page in pages)
+            has_prev = page_cursor is not None
+            rows = rows[:limit]
+        else:
+            has_prev = len(rows) > limit or any(page['prev_cursor'] for page in pages)
+            has_next = True
+            rows = rows[-limit:]
+
+        return {
+            'conversations': rows,
+            'limit': limit,
+            'next_cursor': encode_cursor(rows[-1], 'next') if rows and has_next else None,
+            'prev_cursor': encode_cursor(rows[0], 'prev') if rows and has_prev else None,
+            'total': sum(page['total'] for page in pages),
+        }
+
+    def get_user_statistics(self):
+        """获取用户统计数据"""
+        stats = self._fan_out(lambda shard: shard.get_user_statistics())
+
+        active_users = sorted((user for s in stats for user in s['active_users']),
+                              key=lambda user: user['message_count'], reverse=True)[:20]
+        preferences = {}
+        for s in stats:
+            for row in s['character_preferences']:
+                merged = preferences.setdefault(row['character_name'], {
+                    'character_name': row['character_name'], 'user_count': 0, 'message_count': 0})
+                merged['user_count'] += row['user_count']
+                merged['message_count'] += row['message_count']
+
+        return {
+            'active_users': active_users,
+            'character_preferences': sorted(preferences.values(), key=lambda row: row['user_count'], reverse=True),
+        }
+
+    def get_performance_stats(self):
+        """获取AI性能统计"""
+        stats = self._fan_out(lambda shard: shard.get_performance_stats())
+
+        hourly = defaultdict(lambda: [0, 0.0])
+        for s in stats:
+            for row in s['hourly_stats']:
+                hourly[row['hour']][0] += row['message_count']
+                hourly[row['hour']][1] += row['success_rate'] * row['message_count']
+        total = sum(s['response_stats']['total_messages'] for s in stats)
+        successful = sum(s['response_stats']['successful_responses'] for s in stats)
+
+        return {
+            'hourly_stats': [
+                {'hour': hour, 'message_count': count, 'success_rate': successes / count}
+                for hour, (count, successes) in sorted(hourly.items())
+            ],
+            'success_rate': round(successful / total * 100, 2) if total else 0,
+            'response_stats': {'total_messages': total, 'successful_responses': successful},
+            'image_stats': {
+                key: sum(s['image_stats'][key] for s in stats)
+                for key in ('total_image_requests', 'successful_images')
+            },
+        }
+
+
+def _character_conversation_counts(shard):
+    """分片中每个角色的对话数（含为0的角色），用于合并最受欢迎的角色"""
+    with shard.read_connection() as conn:
+        return conn.execute('''
+            SELECT c.name, COALESCE(s.conversation_count, 0)
+            FROM characters c
+            LEFT JOIN character_stats s ON s.character_id = c.id
+            WHERE c.deleted_at IS NULL
+        ''').fetchall()
+
+
+def open_database(write_queue=None, compressor_factory=None):
+    """按配置打开单库或分片存储"""
+    from config import Config
+    compressor_factory = compressor_factory or Config.get_compressor
+    if Config.STORAGE_BACKEND == 'memory':
+        from memory_store import MemoryDatabase
+        if write_queue is not None:
+            raise ValueError("内存存储不支持延迟写入队列（写入进程无法访问worker的内存）")
+        return MemoryDatabase()
+    if Config.STORAGE_BACKEND != 'sqlite':
+        raise ValueError(f"不支持的存储后端: {Config.STORAGE_BACKEND}")
+    if Config.SHARD_COUNT > 1:
+        return ShardedDatabase(Config.DATABASE_PATH, Config.SHARD_DIR, Config.SHARD_COUNT,
+                               pragmas=Config.get_sqlite_pragmas(), write_queue=write_queue,
+                               compressor_factory=compressor_factory, archive_dir=Config.ARCHIVE_DIR)
+    return Database(Config.DATABASE_PATH, pragmas=Config.get_sqlite_pragmas(), write_queue=write_queue,
+                    compressor=compressor_factory(), archive_dir=Config.ARCHIVE_DIR)
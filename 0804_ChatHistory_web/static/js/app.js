@@ -590,14 +590,10 @@ class GuYueJinYu {
     
     async loadCharacterChatHistory(character) {
         try {
-            // 获取该角色的对话列表
-            const response = await fetch('/api/conversations');
-            const conversations = await response.json();
-            
-            // 查找与当前角色的最近对话
-            const characterConversations = conversations.filter(conv => 
-                conv.character_id === character.id
-            );
+            // 获取与当前角色的最近对话
+            const response = await fetch(`/api/conversations?character_id=${encodeURIComponent(character.id)}&limit=1`);
+            const data = await response.json();
+            const characterConversations = data.conversations || [];
             
             if (characterConversations.length > 0) {
                 // 加载最近的一次对话
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+存储后端接口
+应用只通过这里列出的方法访问数据：角色、用户配置、对话与消息、管理后台统计。
+SQLite 实现为 models.Database（分片模式为 sharding.ShardedDatabase），
+内存实现为 memory_store.MemoryDatabase，两者由 test_storage.py 中同一组用例校验行为一致。
+
+实现约定：
+- 返回值均为新建的 dict / list 或不可变的 records 记录，调用方可以随意修改
+- 时间字段为字符串：对话更新时间为本地时间，消息、对话的创建时间为 UTC（与 SQLite 的 CURRENT_TIMESTAMP 一致）
+- 用户/角色计数和管理后台总数是现有记录数：删除角色、数据清理时同步减少，归档（消息移到归档库）不减少；
+  按天/按小时的统计只随写入累加
+- 写入后调用 self.cache.invalidate()，使管理后台缓存失效
+"""
+
+from abc import ABC, abstractmethod
+
+from pagination import DEFAULT_PAGE_SIZE
+
+
+class NullPool:
+    """没有数据库连接需要回收的后端使用的空连接池"""
+
+    def teardown(self, exception=None):
+        pass
+
+    def close_all(self):
+        pass
+
+
+class Storage(ABC):
+    """存储后端基类"""
+
+    # 实现类需提供：cache（ResultCache）、pool 和管理查询用的 read_pool（teardown / close_all）、
+    # write_queue（可为 None）
+    write_queue = None
+
+    def init_database(self):
+        """初始化存储（幂等），默认无需初始化"""
+
+    def checkpoint(self, mode='PASSIVE'):
+        """把缓冲的写入落盘，不支持时返回 None"""
+        return None
+
+    # ====== 角色 ======
+
+    @abstractmethod
+    def get_characters(self, user_id=None):
+        """默认角色和该用户的自定义角色（records.CharacterSummary），按创建时间排序"""
+
+    @abstractmethod
+    def get_character(self, character_id, user_id=None):
+        """单个角色，不存在时返回 None"""
+
+    @abstractmethod
+    def add_custom_character(self, character_data, user_id):
+        """添加自定义角色，成功返回 True，角色ID已存在时返回 False"""
+
+    @abstractmethod
+    def delete_custom_character(self, character_id, user_id=None):
+        """删除角色：之后 get_characters / get_character 不再返回该角色，其对话和消息可以延后删除"""
+
+    @abstractmethod
+    def reap_deleted_characters(self, grace_seconds=60, batch_size=500, pause=0.05):
+        """删除已删除角色遗留的对话和消息，返回 (角色数, 对话数, 消息数)"""
+
+    @abstractmethod
+    def update_character_avatar(self, character_id, avatar_url):
+        """更新角色的生成头像"""
+
+    # ====== 用户配置 ======
+
+    @abstractmethod
+    def save_user_config(self, user_id, config):
+        """保存（覆盖）用户配置"""
+
+    @abstractmethod
+    def get_user_config(self, user_id):
+        """用户配置，不存在时返回 None"""
+
+    # ====== 对话与消息 ======
+
+    @abstractmethod
+    def save_message(self, conversation_id, user_id, character_id, user_message, ai_response,
+                     image_url=None, character_name=None):
+        """保存一轮对话，对话不存在时创建"""
+
+    @abstractmethod
+    def write_turns(self, turns, last_queue_id):
+        """原子地写入一批队列中的对话并记录队列位置"""
+
+    @abstractmethod
+    def get_last_applied_turn(self):
+        """已写入的最后一个队列ID"""
+
+    @abstractmethod
+    def get_chat_history(self, conversation_id, limit=50, user_id=None):
+        """对话最新的 limit 条消息，按时间正序"""
+
+    @abstractmethod
+    def get_recent_turns(self, conversation_id, limit=6, user_id=None):
+        """构建提示词用的最近 limit 轮对话（records.ChatTurn），按时间正序"""
+
+    @abstractmethod
+    def get_conversations(self, user_id, page_cursor=None, limit=DEFAULT_PAGE_SIZE, character_id=None):
+        """用户的对话列表（按最后更新时间倒序，游标分页）"""
+
+    @abstractmethod
+    def search_messages(self, user_id, query, limit=20):
+        """在用户自己的聊天记录中搜索，返回命中摘要（已归档的消息不在搜索范围内）"""
+
+    @abstractmethod
+    def purge_search_index(self, batch_size=500):
+        """从搜索索引中删除已删除消息的条目，返回删除的条数"""
+
+    @abstractmethod
+    def export_conversations(self, user_id):
+        """生成器：逐条生成用户的对话（type=conversation）及其后按时间正序的消息（type=message）"""
+
+    # ====== 管理后台 ======
+
+    @abstractmethod
+    def get_admin_stats(self):
+        """总用户数、对话数、消息数、今日新增对话、热门角色、近7天活跃用户"""
+
+    @abstractmethod
+    def get_all_conversations(self, page_cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """所有用户的对话（游标分页，附总数）"""
+
+    @abstractmethod
+    def get_user_statistics(self):
+        """最活跃的用户和角色偏好"""
+
+    @abstractmethod
+    def get_performance_stats(self):
+        """近24小时按小时的消息量、近7天回复成功率和图片生成统计"""
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+分析导出的增量往返检查：导出、再写入、再次导出后，读回的文件覆盖全部消息和对话的最新快照
+未安装 pyarrow 时跳过
+
+运行: python3 -m pytest -q test_analytics_export.py
+"""
+
+import glob
+import os
+
+import pytest
+
+pyarrow = pytest.importorskip('pyarrow')
+import pyarrow.parquet  # noqa: E402
+
+from analytics_export import export_database  # noqa: E402
+from models import Database  # noqa: E402
+
+
+def turn(conversation_id, text, updated_at):
+    return {'conversation_id': conversation_id, 'user_id': 'alice', 'character_id': 'kongzi',
+            'user_message': text, 'ai_response': '答' + text, 'image_url': None,
+            'character_name': '孔子', 'updated_at': updated_at, 'created_at': updated_at}
+
+
+def read_rows(output_dir, table_name):
+    files = sorted(glob.glob(os.path.join(output_dir, table_name, 'day=*', '*.parquet')))
+    return [row for path in files for row in pyarrow.parquet.read_table(path).to_pylist()]
+
+
+def latest_snapshots(rows):
+    snapshots = {}
+    for row in sorted(rows, key=lambda row: row['change_seq']):
+        snapshots[row['id']] = row
+    return snapshots
+
+
+def test_incremental_export_round_trip(tmp_path):
+    db_path, output_dir = str(tmp_path / 'main.db'), str(tmp_path / 'export')
+    db = Database(db_path, archive_dir=str(tmp_path / 'archive'))
+    db.write_turns([turn('conv-1', '问1', '2026-01-02 10:00:00'),
+                    turn('conv-2', '问2', '2026-01-02 11:00:00')], 2)
+    db.pool.close_all()
+    assert export_database(db_path, output_dir, batch_size=1) == (2, 2)
+
+    # 延迟写入：后提交的对话带着入队时（早于上次导出位置）的 updated_at
+    db.write_turns([turn('conv-late', '问3', '2026-01-02 09:00:00'),
+                    turn('conv-1', '问4', '2026-01-02 12:00:00')], 4)
+    db.pool.close_all()
+    assert export_database(db_path, output_dir) == (2, 2)
+    assert export_database(db_path, output_dir) == (0, 0)
+
+    messages = read_rows(output_dir, 'messages')
+    assert [(m['user_message'], m['ai_response']) for m in messages] == [
+        ('问1', '答问1'), ('问2', '答问2'), ('问3', '答问3'), ('问4', '答问4')]
+    conversations = latest_snapshots(read_rows(output_dir, 'conversations'))
+    assert {conv_id: conv['message_count'] for conv_id, conv in conversations.items()} == {
+        'conv-1': 2, 'conv-2': 1, 'conv-late': 1}
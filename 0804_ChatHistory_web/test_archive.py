@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+冷数据归档检查：把长时间未活跃的对话移到月度归档库后，聊天记录、对话列表和统计不变，
+已归档的消息不再出现在搜索结果中
+
+运行: python3 -m pytest -q test_archive.py
+"""
+
+import os
+
+import pytest
+
+import archive
+from models import Database
+
+CUSTOM_CHARACTER = {
+    'id': 'custom_test',
+    'name': '测试先生',
+    'description': '测试角色',
+    'style': '简练',
+    'system_prompt': '你是测试先生',
+}
+
+
+def turn(conversation_id, user_id, text, updated_at, character_id='kongzi'):
+    return {'conversation_id': conversation_id, 'user_id': user_id, 'character_id': character_id,
+            'user_message': text, 'ai_response': '答' + text, 'image_url': None,
+            'character_name': None, 'updated_at': updated_at, 'created_at': updated_at}
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(str(tmp_path / 'main.db'), archive_dir=str(tmp_path / 'archive'))
+    database.add_custom_character(CUSTOM_CHARACTER, 'alice')
+    # conv-old、conv-custom 早已不活跃，conv-new 仍在使用
+    database.write_turns([
+        turn('conv-old', 'alice', '问1', '2025-01-05 10:00:00'),
+        turn('conv-old', 'alice', '问2', '2025-01-05 10:01:00'),
+        turn('conv-custom', 'alice', '问3', '2025-02-05 10:00:00', character_id='custom_test'),
+        turn('conv-bob', 'bob', '问4', '2025-01-06 10:00:00'),
+    ], 4)
+    database.save_message('conv-new', 'alice', 'kongzi', '问5', '答问5')
+    yield database
+    database.pool.close_all()
+    database.read_pool.close_all()
+
+
+def statistics(db):
+    stats = db.get_admin_stats()
+    users = db.get_user_statistics()
+    return (
+        (stats['total_users'], stats['total_conversations'], stats['total_messages']),
+        sorted((u['user_id'], u['message_count'], u['conversation_count']) for u in users['active_users']),
+        sorted((p['character_name'], p['user_count'], p['message_count']) for p in users['character_preferences']),
+    )
+
+
+def test_archiving_keeps_statistics(db):
+    before = statistics(db)
+    assert before[0] == (2, 4, 5)
+    assert archive.archive_idle_conversations(db, idle_days=30) == (3, 4)
+    assert statistics(db) == before
+
+    # 已归档对话被删除时，归档库中的消息从计数中减去
+    db.delete_custom_character('custom_test', user_id='alice')
+    db.reap_deleted_characters(grace_seconds=0, pause=0)
+    assert statistics(db) == (
+        (2, 3, 4),
+        [('alice', 3, 2), ('bob', 1, 1)],
+        [('孔子', 2, 4)],
+    )
+
+
+# 对话列表页展示的字段
+LIST_FIELDS = ('id', 'title', 'character_name', 'updated_at', 'message_count', 'last_message_at',
+               'last_message_preview')
+
+
+def conversation_list(db, user_id):
+    page = db.get_conversations(user_id)
+    return [{field: conv[field] for field in LIST_FIELDS} for conv in page['conversations']]
+
+
+def test_archive_round_trip(db):
+    history = db.get_chat_history('conv-old', user_id='alice')
+    conversations = conversation_list(db, 'alice')
+    assert [m['user_message'] for m in history] == ['问1', '问2']
+
+    archive.archive_idle_conversations(db, idle_days=30)
+    assert os.path.exists(archive.archive_path(db.archive_dir, '2025-01'))
+    with db.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM messages WHERE conversation_id = 'conv-old'").fetchone()[0] == 0
+
+    # 从归档库读回的聊天记录与归档前相同，列表页不变
+    assert db.get_chat_history('conv-old', user_id='alice') == history
+    assert conversation_list(db, 'alice') == conversations
+
+    # 已归档的对话又有新消息：新消息在主库，与归档库中的消息合并显示
+    db.save_message('conv-old', 'alice', 'kongzi', '问6', '答问6')
+    assert [m['user_message'] for m in db.get_chat_history('conv-old', user_id='alice')] == ['问1', '问2', '问6']
+    assert conversation_list(db, 'alice')[0]['message_count'] == 3
+
+
+def test_archived_messages_are_not_searchable(db):
+    # “答问1” 走全文索引，“问1” 不足3个字符，逐条匹配主库中的消息
+    assert db.search_messages('alice', '答问1') and db.search_messages('alice', '问1')
+    archive.archive_idle_conversations(db, idle_days=30)
+    assert db.search_messages('alice', '答问1') == []
+    assert db.search_messages('alice', '问1') == []
+    assert [r['conversation_id'] for r in db.search_messages('alice', '答问5')] == ['conv-new']
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+在线备份检查：全量 + 增量快照恢复后与当时的数据库一致，保留策略按快照链清理
+
+运行: python3 -m pytest -q test_backup.py
+"""
+
+import os
+import sqlite3
+
+from backup import load_manifest, restore_snapshot, rotate, take_snapshot, verify_snapshot
+from models import Database
+
+
+def message_count(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_incremental_snapshots_restore_and_rotate(tmp_path):
+    db_path = str(tmp_path / 'live.db')
+    backup_dir = str(tmp_path / 'backups')
+    db = Database(db_path, archive_dir=str(tmp_path / 'archive'))
+    for i in range(200):
+        db.save_message(f"conv-{i % 5}", 'alice', 'kongzi', f"问{i}" * 20, f"答{i}" * 50)
+
+    full = take_snapshot(db_path, backup_dir, step_pages=4, pause=0)
+    db.save_message('conv-new', 'bob', 'libai', '新问题', '新回答')
+    delta = take_snapshot(db_path, backup_dir, step_pages=4, pause=0)
+    assert (full['kind'], delta['kind'], delta['parent']) == ('full', 'delta', full['name'])
+    assert 0 < delta['changed_pages'] < delta['page_count']
+    assert os.path.getsize(os.path.join(backup_dir, delta['file'])) < os.path.getsize(
+        os.path.join(backup_dir, full['file']))
+
+    restore_snapshot(backup_dir, full['name'], str(tmp_path / 'full.db'))
+    restore_snapshot(backup_dir, delta['name'], str(tmp_path / 'delta.db'))
+    assert message_count(str(tmp_path / 'full.db')) == 200
+    assert message_count(str(tmp_path / 'delta.db')) == 201
+    assert verify_snapshot(backup_dir)[0]
+
+    for _ in range(4):
+        take_snapshot(db_path, backup_dir, full_every=2, pause=0)
+    assert [s['kind'] for s in load_manifest(backup_dir)['snapshots']] == [
+        'full', 'delta', 'full', 'delta', 'full', 'delta']
+    assert rotate(backup_dir, 1) == 4
+    remaining = load_manifest(backup_dir)['snapshots']
+    assert sorted(os.listdir(backup_dir)) == sorted(
+        ['manifest.json', 'latest.hashes'] + [s['file'] for s in remaining])
+    assert verify_snapshot(backup_dir)[0]
+    db.pool.close_all()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+分批数据修复检查：按 rowid 范围分批、中断后从记录的位置继续、试运行不修改数据
+
+运行: python3 -m pytest -q test_chunked_migration.py
+"""
+
+import sqlite3
+
+import pytest
+
+import chunked_migration
+import privacy_fix
+from chunked_migration import ChunkStep, run_migration
+from models import Database
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'main.db')
+    db = Database(path, archive_dir=str(tmp_path / 'archive'))
+    # rowid 1..10，default 用户的消息是奇数 rowid
+    for i in range(10):
+        user_id = 'default' if i % 2 == 0 else 'alice'
+        db.save_message(f"conv-{user_id}", user_id, 'kongzi', f"问{i}", f"答{i}")
+    db.pool.close_all()
+    return path
+
+
+def message_ids(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return [row[0] for row in conn.execute('SELECT id FROM messages ORDER BY id')]
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def chunks(monkeypatch):
+    """记录每批提交的 rowid 上界"""
+    uppers = []
+    save_progress = chunked_migration._save_progress
+
+    def recording(conn, name, index, step, last_rowid, *args):
+        uppers.append(last_rowid)
+        save_progress(conn, name, index, step, last_rowid, *args)
+    monkeypatch.setattr(chunked_migration, '_save_progress', recording)
+    return uppers
+
+
+def test_steps_run_in_rowid_ranges(db_path, chunks):
+    steps = [ChunkStep('messages', "user_id = ?", ('default',))]
+    assert run_migration(db_path, 'test', steps, chunk_rows=3, pause=0, max_transaction=60) == [5]
+    assert chunks == [3, 6, 9, 10]
+    assert message_ids(db_path) == [2, 4, 6, 8, 10]
+
+
+def test_interrupted_migration_resumes(db_path, chunks, monkeypatch):
+    steps = [ChunkStep('messages', "user_id = 'default'"),
+             ChunkStep('conversations', "user_id = 'default'")]
+    save_progress = chunked_migration._save_progress
+
+    def interrupt(conn, name, index, step, last_rowid, *args):
+        if last_rowid > 6:
+            raise sqlite3.OperationalError('database is locked')
+        save_progress(conn, name, index, step, last_rowid, *args)
+    monkeypatch.setattr(chunked_migration, '_save_progress', interrupt)
+    with pytest.raises(sqlite3.OperationalError):
+        run_migration(db_path, 'test', steps, chunk_rows=3, pause=0, max_transaction=60)
+    # 第三批与进度一起回滚，前两批已提交
+    assert message_ids(db_path) == [2, 4, 6, 7, 8, 9, 10]
+
+    monkeypatch.setattr(chunked_migration, '_save_progress', save_progress)
+    chunks.clear()
+    assert run_migration(db_path, 'test', steps, chunk_rows=3, pause=0, max_transaction=60) == [5, 1]
+    # 从 rowid 6 继续，不再扫描已完成的范围
+    assert chunks[:2] == [9, 10]
+    assert message_ids(db_path) == [2, 4, 6, 8, 10]
+
+
+def test_dry_run_does_not_modify(db_path):
+    assert privacy_fix.clean_default_user_data(db_path, dry_run=True) is True
+    assert len(message_ids(db_path)) == 10
+    conn = sqlite3.connect(db_path)
+    try:
+        assert conn.execute('SELECT COUNT(*) FROM data_migration_progress').fetchone()[0] == 0
+    finally:
+        conn.close()
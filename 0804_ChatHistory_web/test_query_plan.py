@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+查询计划检查
+在临时数据库上调用 Database 的每个方法，记录实际执行的SQL，
+逐条 EXPLAIN QUERY PLAN，发现 messages / conversations 表的全表扫描即失败
+
+运行: python3 -m pytest -q test_query_plan.py  或  python3 test_query_plan.py
+"""
+
+import os
+import re
+import tempfile
+
+import archive
+from models import Database
+
+# 不允许全表扫描的大表
+HOT_TABLES = ('messages', 'conversations')
+
+# 会产生查询计划的语句
+PLANNED_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def exercise_database(db):
+    """依次调用 Database 的全部查询方法"""
+    user_id = 'plan-user'
+    db.save_user_config(user_id, {'api_key': 'sk-plan'})
+    for i in range(30):
+        db.save_message(f"plan-conv-{i % 3}", user_id, 'kongzi', "问", "答")
+    db.save_message('plan-conv-new', user_id, 'libai', "问", "答")
+
+    db.get_characters(user_id)
+    db.get_characters()
+    db.get_character('kongzi')
+    db.get_user_config(user_id)
+    db.get_chat_history('plan-conv-0', limit=10)
+    db.get_recent_turns('plan-conv-0')
+    page = db.get_conversations(user_id, limit=2)
+    page = db.get_conversations(user_id, page_cursor=page['next_cursor'], limit=2)
+    db.get_conversations(user_id, page_cursor=page['prev_cursor'], limit=2)
+    db.get_conversations(user_id, character_id='kongzi', limit=1)
+    db.search_messages(user_id, '问与答')
+    db.search_messages(user_id, '问 答')
+    db.update_character_avatar('kongzi', 'https://example.com/a.png')
+    db.add_custom_character({
+        'id': 'custom_plan',
+        'name': '测试',
+        'description': '测试角色',
+        'style': '简练',
+        'system_prompt': '测试',
+    }, user_id)
+    db.save_message('plan-conv-custom', user_id, 'custom_plan', "问", "答")
+    db.delete_custom_character('custom_plan')
+
+    db.get_admin_stats()
+    page = db.get_all_conversations(limit=2)
+    page = db.get_all_conversations(page_cursor=page['next_cursor'], limit=2)
+    db.get_all_conversations(page_cursor=page['prev_cursor'], limit=2)
+    db.get_user_statistics()
+    db.get_performance_stats()
+
+    # 归档全部对话（截止时间在未来），再读取已归档的对话
+    archive.archive_idle_conversations(db, idle_days=-1)
+    db.get_chat_history('plan-conv-0', limit=10)
+    db.save_message('plan-conv-0', user_id, 'kongzi', "问", "答")
+    list(db.export_conversations(user_id))
+
+
+def capture_statements(db):
+    """记录 exercise_database 期间执行的SQL（参数已展开），返回 (全部语句, 只读连接上的语句)
+
+    迁移（含一次性回填）在记录前完成，不参与检查。
+    """
+    db.init_database()
+    conn = db.get_connection()
+    statements, readonly_statements = [], []
+    conn.set_trace_callback(statements.append)
+
+    def trace_readonly(sql):
+        statements.append(sql)
+        readonly_statements.append(sql)
+
+    # 流式导出等使用独立连接的方法、管理后台使用的只读连接同样记录
+    connect, read_connect = db.pool.connect, db.read_pool.connect
+    def traced_connect():
+        new_conn = connect()
+        new_conn.set_trace_callback(statements.append)
+        return new_conn
+    def traced_read_connect():
+        new_conn = read_connect()
+        new_conn.set_trace_callback(trace_readonly)
+        return new_conn
+    db.pool.connect = traced_connect
+    db.read_pool.connect = traced_read_connect
+    try:
+        exercise_database(db)
+    finally:
+        conn.set_trace_callback(None)
+        db.pool.connect = connect
+        db.read_pool.connect = read_connect
+
+    def planned(sqls):
+        # 归档任务写入归档库的语句在检查时归档库已分离，且不涉及主库的大表
+        return [sql for sql in sqls
+                if sql.lstrip().split(None, 1)[0].upper() in PLANNED_STATEMENTS
+                and 'archive_job.' not in sql]
+    return planned(statements), planned(readonly_statements)
+
+
+def table_aliases(sql):
+    """解析SQL中大表的别名，返回 {别名: 表名}"""
+    aliases = {table: table for table in HOT_TABLES}
+    pattern = r'\b(%s)\s+(?:AS\s+)?(\w+)' % '|'.join(HOT_TABLES)
+    for table, alias in re.findall(pattern, sql, re.IGNORECASE):
+        if alias.upper() not in ('WHERE', 'SET', 'ON', 'LEFT', 'JOIN', 'ORDER', 'GROUP', 'LIMIT', 'VALUES'):
+            aliases[alias] = table
+    return aliases
+
+
+# 允许的索引扫描：(表, 索引) -> 原因。只在语句带 LIMIT、按索引顺序读取且无需额外排序时允许，
+# 扫描读取的行数由 LIMIT 限定；其余对大表的 SCAN（包括覆盖索引扫描）一律失败
+ALLOWED_INDEX_SCANS = {
+    # get_all_conversations 第一页：全部用户的对话按 (updated_at, id) 倒序分页，没有过滤条件，
+    # 从索引末端读取 limit 行即停止
+    ('conversations', 'idx_conversations_updated_id'): '管理后台对话列表第一页',
+}
+
+
+def find_table_scans(conn, sql):
+    """返回查询计划中对大表的扫描（ALLOWED_INDEX_SCANS 中带 LIMIT 的有序索引扫描除外）"""
+    plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+    aliases = table_aliases(sql)
+    ordered_by_index = 'LIMIT' in sql.upper() and not any(
+        'TEMP B-TREE FOR ORDER BY' in detail for detail in plan)
+
+    scans = []
+    for detail in plan:
+        match = re.match(r'SCAN (\w+)(?: USING INDEX (\w+))?', detail)
+        if not match or aliases.get(match.group(1)) not in HOT_TABLES:
+            continue
+        if ordered_by_index and (aliases[match.group(1)], match.group(2)) in ALLOWED_INDEX_SCANS:
+            continue
+        scans.append(detail)
+    return scans
+
+
+def test_no_table_scans_on_hot_tables():
+    with tempfile.TemporaryDirectory() as workdir:
+        db = Database(os.path.join(workdir, 'plan.db'), archive_dir=os.path.join(workdir, 'archive'))
+        statements, admin_statements = capture_statements(db)
+        conn = db.get_connection()
+
+        failures = []
+        for sql in statements:
+            for detail in find_table_scans(conn, sql):
+                failures.append(f"{' '.join(sql.split())}\n    -> {detail}")
+        db.pool.close_all()
+        db.read_pool.close_all()
+
+    assert statements, "没有记录到任何SQL"
+    assert any('stats_daily' in sql for sql in admin_statements), "没有记录到管理后台（只读连接）的SQL"
+    assert not failures, "以下查询对大表做了全表扫描:\n" + '\n'.join(failures)
+
+
+if __name__ == '__main__':
+    try:
+        test_no_table_scans_on_hot_tables()
+        print("✅ 所有查询均走索引")
+    except AssertionError as e:
+        print(f"❌ {e}")
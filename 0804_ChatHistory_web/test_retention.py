@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+数据保留策略检查：长期不活跃用户的过期对话连同消息、搜索索引一并删除，活跃用户的数据保留，
+删除后增量释放空闲页
+
+运行: python3 -m pytest -q test_retention.py
+"""
+
+import random
+
+import retention
+from models import Database
+
+
+def turn(conversation_id, user_id, text, timestamp):
+    return {'conversation_id': conversation_id, 'user_id': user_id, 'character_id': 'kongzi',
+            'user_message': text, 'ai_response': '答' + text, 'image_url': None,
+            'character_name': None, 'updated_at': timestamp, 'created_at': timestamp}
+
+
+def test_purge_expired_users_keeps_active_users(tmp_path):
+    db = Database(str(tmp_path / 'main.db'), archive_dir=str(tmp_path / 'archive'))
+    # 随机文本压缩不掉，删除后留下足够的空闲页
+    rng = random.Random(0)
+    padding = ''.join(chr(rng.randint(0x4e00, 0x9fa5)) for _ in range(2000))
+    # gone 一年多没有发送消息；kept 的旧对话同样很久没有更新，但用户最近还在使用
+    db.write_turns([turn('conv-gone', 'gone', f"床前明月光{i}{padding}", '2024-01-05 10:00:00')
+                    for i in range(50)], 50)
+    db.write_turns([turn('conv-kept-old', 'kept', '床前明月光', '2024-01-05 10:00:00')], 51)
+    db.save_message('conv-kept-new', 'kept', 'kongzi', '疑是地上霜', '答')
+
+    assert retention.purge_expired(db, idle_days=180, inactive_user_days=90, message_batch=20, pause=0) == (1, 50)
+    assert db.get_conversations('gone')['conversations'] == []
+    assert sorted(c['id'] for c in db.get_conversations('kept')['conversations']) == ['conv-kept-new',
+                                                                                      'conv-kept-old']
+    assert db.search_messages('gone', '床前明月光') == []
+    assert [r['conversation_id'] for r in db.search_messages('kept', '床前明月光')] == ['conv-kept-old']
+    assert [u['user_id'] for u in db.get_user_statistics()['active_users']] == ['kept']
+
+    # 删除的消息从全文索引中清除
+    assert db.purge_search_index() == 50
+    with db.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH '床前明月光'").fetchone()[0] == 1
+
+    released = retention.incremental_vacuum(db, step_pages=10, pause=0)
+    assert released > 0
+    with db.connection() as conn:
+        assert conn.execute('PRAGMA freelist_count').fetchone()[0] == 0
+    db.pool.close_all()
+    db.read_pool.close_all()
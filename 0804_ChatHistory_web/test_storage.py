@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+存储后端一致性检查
+同一组用例分别在 SQLite 单库、SQLite 分片和内存存储上运行，确认各后端行为一致
+
+运行: python3 -m pytest -q test_storage.py
+"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+
+import pytest
+from flask import Flask
+
+from memory_store import MemoryDatabase
+from migrations import DEFAULT_CHARACTERS
+from models import Database
+from result_cache import ResultCache
+from sharding import ShardedDatabase
+from write_queue import TurnWriter, WriteQueue
+
+BACKENDS = ('sqlite', 'sharded', 'memory')
+
+
+def open_backend(name, workdir):
+    """在临时目录中打开指定的存储后端"""
+    db_path = os.path.join(workdir, 'storage.db')
+    archive_dir = os.path.join(workdir, 'archive')
+    if name == 'sqlite':
+        return Database(db_path, archive_dir=archive_dir)
+    if name == 'sharded':
+        return ShardedDatabase(db_path, os.path.join(workdir, 'shards'), 3, archive_dir=archive_dir)
+    return MemoryDatabase()
+
+
+@pytest.fixture(params=BACKENDS)
+def db(request):
+    with tempfile.TemporaryDirectory() as workdir:
+        storage = open_backend(request.param, workdir)
+        storage.init_database()
+        yield storage
+        storage.pool.close_all()
+        storage.read_pool.close_all()
+
+
+CUSTOM_CHARACTER = {
+    'id': 'custom_test',
+    'name': '测试先生',
+    'description': '测试角色',
+    'style': '简练',
+    'system_prompt': '你是测试先生',
+}
+
+
+def chat(db, conversation_id, user_id, turns, character_id='kongzi', prefix='问'):
+    for i in range(turns):
+        db.save_message(conversation_id, user_id, character_id, f"{prefix}{i}", f"答{i}")
+
+
+def test_characters_are_isolated_per_user(db):
+    default_ids = {c['id'] for c in DEFAULT_CHARACTERS}
+    assert {c.id for c in db.get_characters()} == default_ids
+
+    assert db.add_custom_character(CUSTOM_CHARACTER, 'alice') is True
+    assert db.add_custom_character(CUSTOM_CHARACTER, 'alice') is False
+    assert {c.id for c in db.get_characters('alice')} == default_ids | {'custom_test'}
+    assert {c.id for c in db.get_characters('bob')} == default_ids
+
+    character = db.get_character('custom_test', user_id='alice')
+    assert character['name'] == '测试先生'
+    assert character['user_id'] == 'alice'
+    assert db.get_character('missing', user_id='alice') is None
+
+    db.update_character_avatar('kongzi', 'https://example.com/kongzi.png')
+    assert db.get_character('kongzi', user_id='bob')['generated_avatar_url'] == 'https://example.com/kongzi.png'
+
+
+def test_user_config_is_overwritten(db):
+    assert db.get_user_config('alice') is None
+    db.save_user_config('alice', {'api_key': 'sk-1'})
+    db.save_user_config('alice', {'api_key': 'sk-2', 'text_model': 'qwen-max'})
+    config = db.get_user_config('alice')
+    assert (config['api_key'], config['text_model'], config['image_model']) == ('sk-2', 'qwen-max', 'wan2.2-t2i-flash')
+
+
+def test_chat_history_returns_latest_messages_in_order(db):
+    chat(db, 'conv-1', 'alice', 5)
+    history = db.get_chat_history('conv-1', limit=3, user_id='alice')
+    assert [m['user_message'] for m in history] == ['问2', '问3', '问4']
+    assert [m['ai_response'] for m in history] == ['答2', '答3', '答4']
+    assert db.get_chat_history('missing', user_id='alice') == []
+
+    turns = db.get_recent_turns('conv-1', limit=2, user_id='alice')
+    assert [tuple(turn) for turn in turns] == [('问3', '答3'), ('问4', '答4')]
+    assert db.get_recent_turns('missing', user_id='alice') == []
+
+
+def test_conversation_pages_cover_every_conversation(db):
+    for i in range(7):
+        chat(db, f"conv-{i}", 'alice', 1, character_id='libai' if i % 2 else 'kongzi')
+    chat(db, 'conv-bob', 'bob', 1)
+
+    page = db.get_conversations('alice', limit=3)
+    first_page = [c['id'] for c in page['conversations']]
+    assert first_page == ['conv-6', 'conv-5', 'conv-4']
+    assert page['conversations'][0]['title'] == '与孔子的对话'
+    assert page['conversations'][0]['character_name'] == '孔子'
+    assert page['conversations'][0]['message_count'] == 1
+
+    seen = list(first_page)
+    while page['next_cursor']:
+        page = db.get_conversations('alice', page_cursor=page['next_cursor'], limit=3)
+        seen += [c['id'] for c in page['conversations']]
+    assert seen == [f"conv-{i}" for i in range(6, -1, -1)]
+
+    second = db.get_conversations('alice', page_cursor=db.get_conversations('alice', limit=3)['next_cursor'], limit=3)
+    back = db.get_conversations('alice', page_cursor=second['prev_cursor'], limit=3)
+    assert [c['id'] for c in back['conversations']] == first_page
+
+    libai = db.get_conversations('alice', character_id='libai')
+    assert [c['id'] for c in libai['conversations']] == ['conv-5', 'conv-3', 'conv-1']
+
+
+def test_search_only_returns_own_messages(db):
+    db.save_message('conv-a', 'alice', 'libai', '举头望明月', '低头思故乡')
+    db.save_message('conv-a', 'alice', 'libai', '床前明月光', '疑是地上霜')
+    db.save_message('conv-b', 'bob', 'libai', '明月几时有', '把酒问青天')
+
+    indexed = db.search_messages('alice', '明月光', limit=10)
+    assert [r['conversation_id'] for r in indexed] == ['conv-a']
+    assert '明月光' in indexed[0]['user_message']
+
+    short = db.search_messages('alice', '明月', limit=10)
+    assert len(short) == 2
+    assert all(r['character_name'] == '李白' for r in short)
+    assert db.search_messages('bob', '故乡') == []
+
+    with pytest.raises(ValueError):
+        db.search_messages('alice', '   ')
+
+
+def test_search_highlights_ignore_case(db):
+    db.save_message('conv-a', 'alice', 'libai', 'Hello World', 'hello again')
+    db.save_message('conv-b', 'bob', 'libai', 'HELLO bob', '')
+
+    # 走全文索引的长词与逐条匹配的短词，命中和高亮都不区分大小写
+    for query in ('HELLO', 'hE'):
+        results = db.search_messages('alice', query)
+        assert [r['conversation_id'] for r in results] == ['conv-a']
+        assert results[0]['user_message'].startswith('【He')
+        assert results[0]['ai_response'].startswith('【he')
+
+
+def test_export_streams_only_own_conversations(db):
+    chat(db, 'conv-1', 'alice', 3)
+    chat(db, 'conv-2', 'alice', 2, character_id='libai')
+    chat(db, 'conv-bob', 'bob', 1)
+
+    records = list(db.export_conversations('alice'))
+    assert [(r['type'], r['id'] if r['type'] == 'conversation' else r['user_message']) for r in records] == [
+        ('conversation', 'conv-1'), ('message', '问0'), ('message', '问1'), ('message', '问2'),
+        ('conversation', 'conv-2'), ('message', '问0'), ('message', '问1'),
+    ]
+    assert records[4]['character_name'] == '李白'
+    assert records[3]['ai_response'] == '答2'
+    assert list(db.export_conversations('carol')) == []
+
+
+def test_delete_character_removes_its_conversations(db):
+    db.add_custom_character(CUSTOM_CHARACTER, 'alice')
+    chat(db, 'conv-custom', 'alice', 2, character_id='custom_test')
+    chat(db, 'conv-kongzi', 'alice', 1)
+
+    assert db.delete_custom_character('custom_test', user_id='alice') is True
+    assert db.get_character('custom_test', user_id='alice') is None
+    assert 'custom_test' not in {c.id for c in db.get_characters('alice')}
+
+    # 对话和消息由后台清理删除
+    db.reap_deleted_characters(grace_seconds=0, pause=0)
+    assert db.reap_deleted_characters(grace_seconds=0, pause=0) == (0, 0, 0)
+    assert db.get_chat_history('conv-custom', user_id='alice') == []
+    assert [c['id'] for c in db.get_conversations('alice')['conversations']] == ['conv-kongzi']
+    assert db.search_messages('alice', '问0') and all(
+        r['conversation_id'] == 'conv-kongzi' for r in db.search_messages('alice', '问0'))
+    stats = db.get_admin_stats()
+    assert (stats['total_users'], stats['total_conversations'], stats['total_messages']) == (1, 1, 1)
+    assert db.get_all_conversations()['total'] == 1
+    # 用户/角色计数与总数一致，随删除减少
+    users = db.get_user_statistics()
+    assert [(u['user_id'], u['message_count'], u['conversation_count']) for u in users['active_users']] == [
+        ('alice', 1, 1)]
+    assert [(p['character_name'], p['user_count'], p['message_count'])
+            for p in users['character_preferences']] == [('孔子', 1, 1)]
+
+
+@pytest.mark.parametrize('user_id', [None, 'alice'])
+def test_deleting_default_character_is_a_no_op(db, user_id):
+    chat(db, 'conv-kongzi', 'alice', 2)
+
+    db.delete_custom_character('kongzi', user_id=user_id)
+    db.reap_deleted_characters(grace_seconds=0, pause=0)
+    assert db.get_character('kongzi', user_id='alice')['name'] == '孔子'
+    assert 'kongzi' in {c.id for c in db.get_characters()}
+    assert 'kongzi' in {c.id for c in db.get_characters('alice')}
+    assert [m['user_message'] for m in db.get_chat_history('conv-kongzi', user_id='alice')] == ['问0', '问1']
+
+
+def test_search_index_keeps_no_copy_of_messages(tmp_path):
+    db = Database(str(tmp_path / 'main.db'), archive_dir=str(tmp_path / 'archive'))
+    db.add_custom_character(CUSTOM_CHARACTER, 'alice')
+    chat(db, 'conv-custom', 'alice', 2, character_id='custom_test', prefix='床前明月光')
+    with db.connection() as conn:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE name LIKE 'messages_fts%'")}
+        assert 'messages_fts_content' not in tables
+
+    db.delete_custom_character('custom_test', user_id='alice')
+    db.reap_deleted_characters(grace_seconds=0, pause=0)
+    assert db.search_messages('alice', '明月光') == []
+    assert db.purge_search_index() == 2
+    with db.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH '明月光'").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM messages_fts_deleted").fetchone()[0] == 0
+    db.pool.close_all()
+
+
+def test_admin_statistics(db):
+    chat(db, 'conv-1', 'alice', 3)
+    chat(db, 'conv-2', 'alice', 1, character_id='libai')
+    chat(db, 'conv-3', 'bob', 2)
+
+    stats = db.get_admin_stats()
+    assert (stats['total_users'], stats['total_conversations'], stats['total_messages']) == (2, 3, 6)
+    assert stats['today_conversations'] == 3
+    assert stats['popular_characters'][0] == {'name': '孔子', 'conversation_count': 2}
+    assert sum(row['active_users'] for row in stats['user_activity']) == 2
+
+    users = db.get_user_statistics()
+    assert [(u['user_id'], u['message_count'], u['conversation_count']) for u in users['active_users']] == [
+        ('alice', 4, 2), ('bob', 2, 1)]
+    assert {(p['character_name'], p['user_count'], p['message_count']) for p in users['character_preferences']} == {
+        ('孔子', 2, 5), ('李白', 1, 1)}
+
+    performance = db.get_performance_stats()
+    assert performance['response_stats'] == {'total_messages': 6, 'successful_responses': 6}
+    assert performance['success_rate'] == 100
+    assert sum(row['message_count'] for row in performance['hourly_stats']) == 6
+
+    page = db.get_all_conversations(limit=2)
+    assert page['total'] == 3
+    assert [c['id'] for c in page['conversations']] == ['conv-3', 'conv-2']
+    rest = db.get_all_conversations(page_cursor=page['next_cursor'], limit=2)
+    assert [c['id'] for c in rest['conversations']] == ['conv-1']
+    assert rest['conversations'][0]['last_message_preview'] == '问2'
+
+
+def test_write_turns_records_queue_position(db):
+    turns = [{
+        'id': i,
+        'conversation_id': f"queued-{i % 2}",
+        'user_id': f"user-{i % 2}",
+        'character_id': 'kongzi',
+        'user_message': f"问{i}",
+        'ai_response': f"答{i}",
+        'image_url': None,
+        'character_name': '孔子',
+        'updated_at': f"2026-01-01 10:00:0{i}",
+        'created_at': f"2026-01-01 10:00:0{i}",
+    } for i in range(1, 5)]
+    assert db.get_last_applied_turn() == 0
+    db.write_turns(turns, 4)
+    assert db.get_last_applied_turn() == 4
+    assert [m['user_message'] for m in db.get_chat_history('queued-1', user_id='user-1')] == ['问1', '问3']
+
+
+def test_request_teardown_rolls_back_every_pool(tmp_path):
+    db = Database(str(tmp_path / 'main.db'), archive_dir=str(tmp_path / 'archive'))
+    db.init_database()
+    with Flask(__name__).app_context():
+        writer, reader = db.pool.acquire(), db.read_pool.acquire()
+        writer.execute("BEGIN")
+        writer.execute("UPDATE write_queue_state SET last_applied_id = 9")
+        reader.execute("BEGIN")
+        reader.execute("SELECT COUNT(*) FROM characters").fetchone()
+        assert writer.in_transaction and reader.in_transaction
+
+        # 与 app.release_db_connection 相同的顺序：读写连接池先回收
+        db.pool.teardown()
+        db.read_pool.teardown()
+        assert not writer.in_transaction and not reader.in_transaction
+    assert db.get_last_applied_turn() == 0
+    db.pool.close_all()
+    db.read_pool.close_all()
+
+
+def test_writer_moves_failing_turn_to_dead_letters(tmp_path):
+    db = Database(str(tmp_path / 'main.db'), archive_dir=str(tmp_path / 'archive'))
+    queue = WriteQueue(str(tmp_path / 'queue.db'))
+    writer = TurnWriter(db, queue, max_attempts=2)
+    turn = {'user_id': 'alice', 'user_message': '问', 'ai_response': '答', 'image_url': None,
+            'character_name': None, 'updated_at': '2026-01-01 10:00:00'}
+    # 角色不存在（如已被后台清理）时外键约束失败
+    queue.enqueue(dict(turn, conversation_id='conv-gone', character_id='custom_gone'))
+    queue.enqueue(dict(turn, conversation_id='conv-ok', character_id='kongzi'))
+
+    with pytest.raises(sqlite3.IntegrityError):
+        writer.flush_once()
+    assert writer.flush_once() == 2
+    assert [(t['id'], t['character_id']) for t in queue.failed()] == [(1, 'custom_gone')]
+    assert queue.size() == 0 and db.get_last_applied_turn() == 2
+    assert [m['user_message'] for m in db.get_chat_history('conv-ok', user_id='alice')] == ['问']
+    db.pool.close_all()
+
+
+def test_concurrent_writes_are_not_lost(db):
+    def worker(n):
+        chat(db, f"conv-{n}", f"user-{n}", 10)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = db.get_admin_stats()
+    assert (stats['total_users'], stats['total_messages']) == (4, 40)
+    assert all(len(db.get_chat_history(f"conv-{n}", user_id=f"user-{n}")) == 10 for n in range(4))
+
+
+def test_writes_invalidate_admin_cache(db):
+    generation = db.cache.generation
+    chat(db, 'conv-1', 'alice', 1)
+    assert db.cache.generation > generation
+
+
+def test_writes_from_other_processes_invalidate_admin_cache(tmp_path):
+    # 两个实例代表两个 gunicorn worker（或 worker 与写入进程），各自有独立的进程内缓存
+    worker, writer = (Database(str(tmp_path / 'main.db'), archive_dir=str(tmp_path / 'archive'))
+                      for _ in range(2))
+    assert worker.cache.get('stats', 60, worker.get_admin_stats)['total_messages'] == 0
+    chat(writer, 'conv-1', 'alice', 2)
+    assert worker.cache.get('stats', 60, worker.get_admin_stats)['total_messages'] == 2
+    assert worker.cache.get('stats', 60, worker.get_admin_stats)['total_messages'] == 2
+    assert (worker.cache.hits, worker.cache.misses) == (1, 2)
+    for database in (worker, writer):
+        database.pool.close_all()
+        database.read_pool.close_all()
+
+
+def test_cache_reads_generation_once_per_lookup():
+    reads = []
+    cache = ResultCache(source=lambda: reads.append(1) or 7)
+    assert cache.get('stats', 60, lambda: 'result') == 'result'
+    assert cache.get('stats', 60, lambda: 'reloaded') == 'result'
+    assert len(reads) == 2
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+延迟写入队列与写入进程
+/api/chat 只把对话写入本地持久化队列（独立的小SQLite文件）即返回，
+由唯一的写入进程把多轮对话合并到一个事务中提交到主数据库（组提交）。
+
+写锁等待超时等暂时性错误按指数退避重试；某一轮对话反复写入失败（如角色已被清理导致外键约束失败）时，
+移到队列库的 failed_turns 表并跳过，不会阻塞后面的对话。
+
+独立运行写入进程: python3 write_queue.py
+"""
+
+import multiprocessing
+import signal
+import sqlite3
+import threading
+import time
+
+from db_pool import ConnectionPool
+
+# 单轮对话连续写入失败的次数上限，超过后移入 failed_turns
+MAX_TURN_ATTEMPTS = 3
+
+# 写入失败后的重试间隔上限（秒）
+MAX_RETRY_DELAY = 30
+
+
+def is_transient_error(error):
+    """写锁冲突（database is locked / busy）等待后可以成功，其他错误与数据本身有关"""
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+
+class WriteQueue:
+    """持久化的本地写入队列"""
+
+    def __init__(self, queue_path, pragmas=None):
+        self.queue_path = queue_path
+        self.pool = ConnectionPool(queue_path, pragmas)
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    def _connection(self):
+        """获取队列连接，首次使用时建表"""
+        conn = self.pool.acquire()
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    journal_mode = self.pool.pragmas.get('journal_mode')
+                    if journal_mode:
+                        conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+                    conn.execute('''
+                        CREATE TABLE IF NOT EXISTS pending_turns (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            conversation_id TEXT,
+                            user_id TEXT,
+                            character_id TEXT,
+                            user_message TEXT,
+                            ai_response TEXT,
+                            image_url TEXT,
+                            character_name TEXT,
+                            updated_at TIMESTAMP,
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        )
+                    ''')
+                    conn.execute('''
+                        CREATE INDEX IF NOT EXISTS idx_pending_turns_conversation
+                        ON pending_turns (conversation_id, id)
+                    ''')
+                    # 多次写入失败的对话（死信），保留原队列ID和最后一次的错误，供人工处理
+                    conn.execute('''
+                        CREATE TABLE IF NOT EXISTS failed_turns (
+                            id INTEGER PRIMARY KEY,
+                            conversation_id TEXT,
+                            user_id TEXT,
+                            character_id TEXT,
+                            user_message TEXT,
+                            ai_response TEXT,
+                            image_url TEXT,
+                            character_name TEXT,
+                            updated_at TIMESTAMP,
+                            created_at TIMESTAMP,
+                            error TEXT,
+                            failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        )
+                    ''')
+                    conn.commit()
+                    self._initialized = True
+        return conn
+
+    def enqueue(self, turn):
+        """写入一轮对话，提交后即返回"""
+        conn = self._connection()
+        conn.execute('''
+            INSERT INTO pending_turns
+            (conversation_id, user_id, character_id, user_message, ai_response,
+             image_url, character_name, updated_at)
+            VALUES (:conversation_id, :user_id, :character_id, :user_message, :ai_response,
+                    :image_url, :character_name, :updated_at)
+        ''', turn)
+        conn.commit()
+
+    def pending(self, conversation_id):
+        """获取某个对话尚在队列中的消息（按入队顺序）"""
+        conn = self._connection()
+        rows = conn.execute('''
+            SELECT * FROM pending_turns WHERE conversation_id = ? ORDER BY id
+        ''', (conversation_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def fetch_batch(self, after_id, limit):
+        """按入队顺序取出一批尚未写入的对话"""
+        conn = self._connection()
+        rows = conn.execute('''
+            SELECT * FROM pending_turns WHERE id > ? ORDER BY id LIMIT ?
+        ''', (after_id, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def discard_applied(self, last_applied_id):
+        """删除已写入主数据库的对话"""
+        conn = self._connection()
+        conn.execute('DELETE FROM pending_turns WHERE id <= ?', (last_applied_id,))
+        conn.commit()
+
+    def size(self):
+        """队列中的对话数量"""
+        conn = self._connection()
+        return conn.execute('SELECT COUNT(*) FROM pending_turns').fetchone()[0]
+
+    def dead_letter(self, turn, error):
+        """把写不进主数据库的对话移到 failed_turns（可重复执行），之后由写入进程跳过"""
+        conn = self._connection()
+        conn.execute('''
+            INSERT OR REPLACE INTO failed_turns
+            (id, conversation_id, user_id, character_id, user_message, ai_response,
+             image_url, character_name, updated_at, created_at, error)
+            VALUES (:id, :conversation_id, :user_id, :character_id, :user_message, :ai_response,
+                    :image_url, :character_name, :updated_at, :created_at, :error)
+        ''', dict(turn, error=str(error)))
+        conn.commit()
+
+    def failed(self):
+        """已移入 failed_turns 的对话（按队列ID排序）"""
+        conn = self._connection()
+        return [dict(row) for row in conn.execute('SELECT * FROM failed_turns ORDER BY id').fetchall()]
+
+
+class TurnWriter:
+    """写入进程：轮询队列，批量提交到主数据库"""
+
+    def __init__(self, db, queue, batch_size=200, poll_interval=0.05, max_attempts=MAX_TURN_ATTEMPTS):
+        self.db = db
+        self.queue = queue
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._stopping = False
+        # 队列ID -> 连续写入失败次数
+        self._attempts = {}
+
+    def flush_once(self):
+        """提交一批对话，返回本批数量
+
+        主数据库在同一事务中记录已写入的队列位置，之后再删除队列中的记录；
+        两步之间崩溃时，重启后会跳过已写入的部分，不会重复写入。
+        暂时性错误直接抛出，由调用方等待后重试；其他错误逐轮重写以找出出错的对话。
+        """
+        last_applied = self.db.get_last_applied_turn()
+        batch = self.queue.fetch_batch(last_applied, self.batch_size)
+        if batch:
+            try:
+                self.db.write_turns(batch, batch[-1]['id'])
+            except Exception as e:
+                if is_transient_error(e):
+                    raise
+                self._write_one_by_one(batch)
+            last_applied = batch[-1]['id']
+        self.queue.discard_applied(last_applied)
+        return len(batch)
+
+    def _write_one_by_one(self, batch):
+        """逐轮写入一批对话，同一轮连续失败 max_attempts 次后移入 failed_turns 并跳过"""
+        for turn in batch:
+            try:
+                self.db.write_turns([turn], turn['id'])
+            except Exception as e:
+                if is_transient_error(e):
+                    raise
+                attempts = self._attempts.get(turn['id'], 0) + 1
+                if attempts < self.max_attempts:
+                    self._attempts[turn['id']] = attempts
+                    raise
+                # 先记录死信再推进队列位置：两步之间崩溃时重新执行也只会覆盖同一条死信
+                self.queue.dead_letter(turn, e)
+                self.db.write_turns([], turn['id'])
+                self._attempts.pop(turn['id'], None)
+                print(f"⚠️ 队列对话 {turn['id']} 写入失败 {attempts} 次，已移入 failed_turns: {e}")
+            else:
+                self._attempts.pop(turn['id'], None)
+
+    def drain(self):
+        """写入队列中的全部对话，返回写入数量"""
+        total = 0
+        while True:
+            count = self.flush_once()
+            if not count:
+                return total
+            total += count
+
+    def stop(self, *args):
+        """请求停止：当前队列写完后退出"""
+        self._stopping = True
+
+    def run(self):
+        """主循环，收到 SIGTERM/SIGINT 后清空队列再退出"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        print(f"✍️  写入进程已启动，批量大小 {self.batch_size}")
+        retry_delay = self.poll_interval
+        while not self._stopping:
+            try:
+                count = self.flush_once()
+            except Exception as e:
+                # 出错时不退出：暂时性错误（写锁被 VACUUM、迁移等长时间占用）和反复失败的对话都在这里重试
+                retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
+                print(f"⚠️ 写入主数据库失败，{retry_delay:.1f} 秒后重试: {e}")
+                time.sleep(retry_delay)
+                continue
+            retry_delay = self.poll_interval
+            if not count:
+                time.sleep(self.poll_interval)
+        try:
+            flushed = self.drain()
+            print(f"✍️  写入进程退出，关闭前写入 {flushed} 轮对话")
+        except Exception as e:
+            print(f"⚠️ 写入进程退出，队列中剩余 {self.queue.size()} 轮对话下次启动后写入: {e}")
+
+
+def _writer_main(db, queue_path, pragmas, batch_size):
+    """写入进程入口"""
+    TurnWriter(db, WriteQueue(queue_path, pragmas), batch_size=batch_size).run()
+
+
+def start_writer_process(db, queue_path, pragmas=None, batch_size=200):
+    """以fork方式启动写入进程（如在gunicorn master中），db 为单库或分片存储实例"""
+    process = multiprocessing.get_context('fork').Process(
+        target=_writer_main, args=(db, queue_path, pragmas, batch_size),
+        name='guyuejinyu-writer', daemon=False)
+    process.start()
+    return process
+
+
+def stop_writer_process(process, timeout=30):
+    """通知写入进程清空队列后退出，并等待其结束"""
+    if process is not None and process.is_alive():
+        process.terminate()
+        process.join(timeout)
+
+
+class WriterSupervisor:
+    """在gunicorn master中看护写入进程：进程意外退出后重新启动"""
+
+    def __init__(self, db, queue_path, pragmas=None, batch_size=200, restart_delay=1):
+        self.args = (db, queue_path, pragmas, batch_size)
+        self.restart_delay = restart_delay
+        self.process = None
+        self.restarts = 0
+        self._stopping = threading.Event()
+        # 重启与停止互斥，避免停止时又启动一个新的写入进程
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self.process = start_writer_process(*self.args)
+        self._thread = threading.Thread(target=self._watch, name='writer-supervisor', daemon=True)
+        self._thread.start()
+
+    def _watch(self):
+        while not self._stopping.is_set():
+            self.process.join()
+            if self._stopping.is_set():
+                return
+            print(f"⚠️ 写入进程意外退出（退出码 {self.process.exitcode}），{self.restart_delay} 秒后重启")
+            if self._stopping.wait(self.restart_delay):
+                return
+            with self._lock:
+                if self._stopping.is_set():
+                    return
+                self.process = start_writer_process(*self.args)
+                self.restarts += 1
+
+    def stop(self, timeout=30):
+        """停止看护，通知写入进程清空队列后退出"""
+        with self._lock:
+            self._stopping.set()
+            process = self.process
+        stop_writer_process(process, timeout)
+
+
+if __name__ == '__main__':
+    from config import Config
+    from sharding import open_database
+    _writer_main(open_database(), Config.WRITE_QUEUE_PATH, Config.get_sqlite_pragmas(), Config.WRITE_BATCH_SIZE)